@@ -21,8 +21,12 @@ setup(name='upax_py',
       py_modules=[],
       include_package_data=False,
       zip_safe=False,
+      install_requires=['crc32c'],
       scripts=['src/check_u_consistency', 'src/import_u_dir',
-               'src/upax_bulk_poster', 'src/upax_update_node_id'],
+               'src/upax_bulk_poster', 'src/upax_compact_log',
+               'src/upax_convert_log', 'src/upax_mirror',
+               'src/upax_rebalance', 'src/upax_update_node_id',
+               'src/upax_zmq_bench'],
       description='full-mesh ring of U store servers',
       url='https://jddixon.github.io/upax_py',
       classifiers=[
@@ -0,0 +1,258 @@
+# ~/dev/py/upax/upax/binlog.py
+
+"""
+Binary (version 2) serialization of the fault-tolerant log.
+
+A binary log begins with a header:
+
+    MAGIC               8 bytes
+    hashtype            uint8
+    digest length       uint8, 20 for SHA1, otherwise 32
+    reserved            uint16, zero
+    timestamp           uint64
+    prev_hash           raw digest
+    prev_master         raw digest
+    CRC32C              uint32, over everything above
+
+and is followed by zero or more records, each of which is
+
+    length              uint32, length of the payload
+    CRC32C              uint32, over the payload
+    payload
+    length              uint32, repeated so that the log can be
+                            walked backwards from its end
+
+where the payload is
+
+    timestamp           uint64
+    key                 raw digest
+    node_id             raw digest
+    src length          uint16
+    src                 UTF-8
+    path length         uint16
+    path                UTF-8
+
+All integers are little-endian.  Keys and nodeIDs are held in memory
+as lower-case hex; anything else cannot be converted losslessly and is
+rejected.
+
+This module knows nothing about LogEntry: records are handled as
+(timestamp, key, node_id, src, path) tuples.
+"""
+
+import struct
+
+from xlattice import HashTypes
+from upax import UpaxError
+
+try:
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
+__all__ = ['MAGIC', 'LOG_FORMAT_TEXT', 'LOG_FORMAT_BINARY',
+           'crc32c_of', 'digest_len', 'is_binary_log',
+           'encode_header', 'decode_header', 'header_len',
+           'encode_record', 'decode_records', 'RECORD_OVERHEAD', ]
+
+MAGIC = b'UPAXL\x00\x02\n'
+
+LOG_FORMAT_TEXT = 1
+LOG_FORMAT_BINARY = 2
+
+# length, CRC32C before the payload; length after it
+RECORD_OVERHEAD = 12
+
+_HEADER_FIXED = struct.Struct('<8sBBHQ')
+_REC_START = struct.Struct('<II')
+_REC_END = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
+# payload prefix (timestamp, key, node_id, src length) by digest length
+_PAYLOAD_FIXED = {
+    20: struct.Struct('<Q20s20sH'),
+    32: struct.Struct('<Q32s32sH'),
+}
+
+# -- CRC32C ----------------------------------------------------------
+
+# Castagnoli polynomial, reflected; used only if the crc32c package,
+# a dependency, cannot be installed
+_CRC32C_POLY = 0x82F63B78
+
+
+def _make_crc32c_table():
+    table = []
+    for ndx in range(256):
+        crc = ndx
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ _CRC32C_POLY
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _py_crc32c(data):
+    """
+    Table-driven CRC32C, a byte at a time.  This is two orders of
+    magnitude slower than the crc32c package, and slower than parsing
+    a text log, so it is only a last resort.
+    """
+    crc = 0xffffffff
+    table = _CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def crc32c_of(data):
+    """ Return the CRC32C checksum of data as an unsigned int. """
+    if crc32c is not None:
+        return crc32c(data)
+    return _py_crc32c(data)
+
+# -- utilities -------------------------------------------------------
+
+
+def digest_len(hashtype):
+    """ Return the length in bytes of keys and nodeIDs for the hash type. """
+    if hashtype == HashTypes.SHA1:
+        return 20
+    return 32
+
+
+def is_binary_log(data):
+    """ Return whether data (bytes) begins with the binary log magic. """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def header_len(hashtype):
+    """ Return the length of the binary log header. """
+    return _HEADER_FIXED.size + 2 * digest_len(hashtype) + _U32.size
+
+
+def _hex_to_raw(hex_val, d_len, what):
+    """ Convert lower-case hex to raw bytes, insisting on a round trip. """
+    if hex_val != hex_val.lower():
+        raise UpaxError(
+            "%s '%s' is not lower-case hex; can't store it losslessly" % (
+                what, hex_val))
+    try:
+        raw = bytes.fromhex(hex_val)
+    except ValueError:
+        raise UpaxError("%s '%s' is not valid hex" % (what, hex_val))
+    if len(raw) != d_len:
+        raise UpaxError("%s '%s' is not %u bytes long" % (
+            what, hex_val, d_len))
+    return raw
+
+# -- header ----------------------------------------------------------
+
+
+def encode_header(hashtype, timestamp, prev_hash, prev_master):
+    """ Return the serialized header of a binary log. """
+    d_len = digest_len(hashtype)
+    body = _HEADER_FIXED.pack(MAGIC, int(hashtype), d_len, 0,
+                              int(timestamp)) + \
+        _hex_to_raw(prev_hash, d_len, 'prev_hash') + \
+        _hex_to_raw(prev_master, d_len, 'prev_master')
+    return body + _U32.pack(crc32c_of(body))
+
+
+def decode_header(data, hashtype):
+    """
+    Parse the header at the beginning of data, returning
+    (timestamp, prev_hash, prev_master, offset of first record).
+    """
+    d_len = digest_len(hashtype)
+    h_len = header_len(hashtype)
+    if len(data) < h_len:
+        raise UpaxError("binary log header is truncated")
+    (magic, h_type, actual_len, _, timestamp) = _HEADER_FIXED.unpack_from(
+        data, 0)
+    if magic != MAGIC:
+        raise UpaxError("not a binary log: bad magic")
+    if h_type != int(hashtype) or actual_len != d_len:
+        raise UpaxError("binary log uses hashtype %u, expected %u" % (
+            h_type, int(hashtype)))
+    body_len = h_len - _U32.size
+    (crc,) = _U32.unpack_from(data, body_len)
+    if crc != crc32c_of(data[:body_len]):
+        raise UpaxError("binary log header fails CRC check")
+    offset = _HEADER_FIXED.size
+    prev_hash = data[offset:offset + d_len].hex()
+    prev_master = data[offset + d_len:offset + 2 * d_len].hex()
+    return (timestamp, prev_hash, prev_master, h_len)
+
+# -- records ---------------------------------------------------------
+
+
+def encode_record(hashtype, timestamp, key, node_id, src, path):
+    """ Return a single serialized record, framing included. """
+    d_len = digest_len(hashtype)
+    b_src = src.encode('utf-8')
+    b_path = path.encode('utf-8')
+    if len(b_src) > 0xffff or len(b_path) > 0xffff:
+        raise UpaxError("src or path too long for a binary log record")
+    payload = _PAYLOAD_FIXED[d_len].pack(
+        int(timestamp),
+        _hex_to_raw(key, d_len, 'key'),
+        _hex_to_raw(node_id, d_len, 'node_id'),
+        len(b_src)) + b_src + _U16.pack(len(b_path)) + b_path
+    p_len = len(payload)
+    return _REC_START.pack(p_len, crc32c_of(payload)) + payload + \
+        _REC_END.pack(p_len)
+
+
+def decode_records(data, hashtype, offset, partial_ok=False):
+    """
+    Generate (timestamp, key, node_id, src, path, end) tuples for the
+    records in data starting at offset, where `end` is the offset just
+    past the record.
+
+    A record which fails its CRC check or is otherwise malformed raises
+    UpaxError.  So does a truncated final record, unless partial_ok is
+    True, in which case decoding just stops there; the caller can tell
+    from the last `end` how much was consumed.
+    """
+    fixed = _PAYLOAD_FIXED[digest_len(hashtype)]
+    f_size = fixed.size
+    rec_start = _REC_START.unpack_from
+    rec_end = _REC_END.unpack_from
+    u16 = _U16.unpack_from
+    data_len = len(data)
+    view = memoryview(data)
+
+    while offset < data_len:
+        if offset + RECORD_OVERHEAD > data_len:
+            if partial_ok:
+                return
+            raise UpaxError("truncated binary log record at %u" % offset)
+        (p_len, crc) = rec_start(data, offset)
+        start = offset + 8
+        end = start + p_len + 4
+        if end > data_len:
+            if partial_ok:
+                return
+            raise UpaxError("truncated binary log record at %u" % offset)
+        payload = view[start:start + p_len]
+        if crc32c_of(payload) != crc or rec_end(data, end - 4)[0] != p_len:
+            raise UpaxError("corrupt binary log record at %u" % offset)
+        if p_len < f_size + 2:
+            raise UpaxError("malformed binary log record at %u" % offset)
+        (tstamp, key, node_id, src_len) = fixed.unpack_from(payload, 0)
+        src_end = f_size + src_len
+        (path_len,) = u16(payload, src_end)
+        if src_end + 2 + path_len != p_len:
+            raise UpaxError("malformed binary log record at %u" % offset)
+        yield (tstamp, key.hex(), node_id.hex(),
+               str(payload[f_size:src_end], 'utf-8'),
+               str(payload[src_end + 2:], 'utf-8'),
+               end)
+        offset = end
@@ -0,0 +1,238 @@
+# ~/dev/py/upax/upax/chunker.py
+
+"""
+Content-defined chunking and chunk manifests.
+
+A large file can be stored as a sequence of chunks, each stored as an
+object under its own content key, plus a manifest listing the chunks,
+stored under the content key of the whole file.  Chunk boundaries are
+chosen by a rolling (gear) hash over the data, so an insertion or
+deletion in one part of a file changes only the chunks around it, and
+near-duplicate files share most of their chunks.
+
+A manifest is stored behind a codec header (see upax.codec) whose codec
+is CODEC_MANIFEST and whose raw length is the length of the whole file.
+The manifest body has one line per chunk:
+
+    CHUNK_KEY LENGTH
+
+If numpy is installed the rolling hash is computed over a block of
+data at a time, more than ten times as fast as byte by byte in Python.
+Both find the same boundaries.
+"""
+
+import hashlib
+import re
+
+from upax import UpaxError
+from upax.codec import CODEC_MANIFEST, HEADER_LEN, make_header, is_manifest
+from upax.hashing import BLOCK_SIZE, new_hash
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['MIN_CHUNK', 'AVG_CHUNK', 'MAX_CHUNK', 'CHUNK_PATH',
+           'chunk_stream', 'encode_manifest', 'decode_manifest',
+           'manifest_hex', 'ChunkedReader', ]
+
+# the path logged for a chunk stored as an object of its own
+CHUNK_PATH = 'z@__chunk__'
+
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024           # must be a power of two
+MAX_CHUNK = 256 * 1024
+
+_MASK64 = 0xffffffffffffffff
+
+# 256 pseudo-random 64-bit values; fixed, because chunk boundaries
+# must not change from one run to the next
+GEAR = [int.from_bytes(hashlib.sha256(b'upax gear %u' % ndx).digest()[:8],
+                       'little') for ndx in range(256)]
+
+MANIFEST_LINE_RE = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64}) (\d+)$')
+
+# the hash depends on the last WINDOW bytes seen
+WINDOW = 64
+
+# bytes hashed at once when scanning with numpy
+SCAN_BLOCK = 32 * 1024
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+
+def _boundary_mask(avg_size):
+    """
+    Return a mask selecting the top log2(avg_size) bits of the hash.
+    The top bits are used because they depend on the last 64 bytes
+    seen, whereas the low bits depend only on the last few.
+    """
+    bits = avg_size.bit_length() - 1
+    if avg_size != 1 << bits:
+        raise UpaxError("average chunk size must be a power of two")
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _py_find_cut(buf, min_size, max_size, mask):
+    """ Return the length of the first chunk in buf, a byte at a time. """
+    length = len(buf)
+    if length <= min_size:
+        return length
+    end = min(length, max_size)
+    gear = GEAR
+    hash_ = 0
+    # bytes before min_size can't end a chunk, so aren't hashed
+    for ndx in range(min_size, end):
+        hash_ = ((hash_ << 1) + gear[buf[ndx]]) & _MASK64
+        if not hash_ & mask:
+            return ndx + 1
+    return end
+
+
+def _np_find_cut(buf, min_size, max_size, mask):
+    """
+    Return the length of the first chunk in buf, hashing SCAN_BLOCK
+    bytes at a time.  The hash at each position is the sum of
+    GEAR[byte] << age over the last WINDOW bytes, counting only bytes
+    from min_size on, as in _py_find_cut(); summing over windows of
+    1, 2, 4 ... WINDOW bytes builds it for the whole block in a few
+    passes.
+    """
+    length = len(buf)
+    if length <= min_size:
+        return length
+    end = min(length, max_size)
+    data = numpy.frombuffer(buf, dtype=numpy.uint8, count=end)
+    mask = numpy.uint64(mask)
+    start = min_size
+    while start < end:
+        stop = min(end, start + SCAN_BLOCK)
+        # the bytes before the block which the hashes in it depend on
+        ctx = max(min_size, start - WINDOW + 1)
+        hashes = _GEAR_ARRAY[data[ctx:stop]]
+        width = 1
+        while width < WINDOW:
+            hashes[width:] += hashes[:-width] << numpy.uint64(width)
+            width *= 2
+        hits = numpy.flatnonzero((hashes[start - ctx:] & mask) == 0)
+        if hits.size:
+            return start + int(hits[0]) + 1
+        start = stop
+    return end
+
+
+def _find_cut(buf, min_size, max_size, mask):
+    """ Return the length of the first chunk in buf. """
+    if numpy is not None:
+        return _np_find_cut(buf, min_size, max_size, mask)
+    return _py_find_cut(buf, min_size, max_size, mask)
+
+
+def chunk_stream(file, min_size=MIN_CHUNK, avg_size=AVG_CHUNK,
+                 max_size=MAX_CHUNK):
+    """
+    Read a binary file-like object to its end, generating the chunks
+    (bytes) into which it divides.  At most max_size bytes are held at
+    once.
+    """
+    if not 0 < min_size < avg_size < max_size:
+        raise UpaxError("need 0 < min_size < avg_size < max_size")
+    mask = _boundary_mask(avg_size)
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            block = file.read(BLOCK_SIZE)
+            if block:
+                buf += block
+            else:
+                eof = True
+        if not buf:
+            return
+        cut = _find_cut(buf, min_size, max_size, mask)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+
+def encode_manifest(chunks, total_len):
+    """
+    Given a list of (key, length) pairs, return the manifest as it is
+    stored, header included.
+    """
+    body = ''.join(['%s %u\n' % (key, length) for (key, length) in chunks])
+    return make_header(CODEC_MANIFEST, total_len) + body.encode('utf-8')
+
+
+def decode_manifest(blob):
+    """ Return the list of (key, length) pairs in a stored manifest. """
+    if not is_manifest(blob):
+        raise UpaxError("not a chunk manifest")
+    chunks = []
+    for line in str(blob[HEADER_LEN:], 'utf-8').splitlines():
+        match = MANIFEST_LINE_RE.match(line)
+        if not match:
+            raise UpaxError("bad line in chunk manifest: '%s'" % line)
+        chunks.append((match.group(1), int(match.group(2))))
+    return chunks
+
+
+class ChunkedReader(object):
+    """
+    Read-only file-like object returning the data described by a
+    manifest, loading one chunk at a time.  `load` is called with a
+    chunk's key and returns the chunk's data.
+    """
+
+    def __init__(self, chunks, load):
+        self._chunks = list(chunks)
+        self._load = load
+        self._next = 0              # index of the next chunk to load
+        self._buf = b''
+
+    def read(self, size=-1):
+        """ Read and return up to size bytes, or everything if size < 0. """
+        pieces = [self._buf]
+        have = len(self._buf)
+        while (size < 0 or have < size) and self._next < len(self._chunks):
+            (key, length) = self._chunks[self._next]
+            self._next += 1
+            data = self._load(key)
+            if data is None or len(data) != length:
+                raise UpaxError("chunk %s is missing or damaged" % key)
+            pieces.append(data)
+            have += length
+        data = b''.join(pieces)
+        if size < 0 or size >= len(data):
+            self._buf = b''
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        """ Nothing to close: chunks are loaded whole. """
+        self._chunks = []
+        self._buf = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def manifest_hex(blob, load, hashtype):
+    """
+    Return the content key of the data described by a stored manifest,
+    loading chunks with load(key).
+    """
+    sha = new_hash(hashtype)
+    with ChunkedReader(decode_manifest(blob), load) as reader:
+        while True:
+            block = reader.read(BLOCK_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
@@ -0,0 +1,282 @@
+# ~/dev/py/upax/upax/codec.py
+
+"""
+Compression of data stored in uDir.
+
+A stored file may begin with a 16-byte header
+
+    MAGIC               4 bytes, b'UPXZ'
+    codec               uint8
+    reserved            3 bytes, zero
+    raw length          uint64, length of the uncompressed data
+
+followed by the data as encoded by the codec.  Files are always named
+by the content key of the uncompressed data.  A file without the
+header holds the data itself, as it always has.  Data which happens to
+begin with MAGIC is stored behind a CODEC_NONE header, so that the
+presence of the header is never ambiguous.
+
+A header whose codec is CODEC_MANIFEST introduces not the data but a
+list of the chunks making it up (see upax.chunker); such files can only
+be decoded with access to the rest of the store.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import struct
+import zlib
+
+from upax import UpaxError
+from upax.hashing import BLOCK_SIZE, stream_hex
+
+__all__ = ['MAGIC', 'HEADER_LEN',
+           'CODEC_NONE', 'CODEC_GZIP', 'CODEC_BZ2', 'CODEC_LZMA',
+           'CODEC_MANIFEST',
+           'choose_codec', 'needs_header', 'is_encoded', 'is_encoded_file',
+           'is_manifest', 'is_manifest_file', 'make_header',
+           'encode', 'decode', 'encode_file', 'new_compressor',
+           'open_decoded', 'file_hex', 'raw_len', ]
+
+MAGIC = b'UPXZ'
+
+CODEC_NONE = 0
+CODEC_GZIP = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_BZ2, CODEC_LZMA)
+CODEC_MANIFEST = 15
+
+_HEADER = struct.Struct('<4sB3xQ')
+HEADER_LEN = _HEADER.size
+
+# data shorter than this is never compressed
+MIN_COMPRESS_LEN = 512
+
+# how much of the data is trial-compressed by choose_codec()
+SAMPLE_LEN = 64 * 1024
+
+# data is stored uncompressed unless the sample shrinks to this fraction
+MAX_RATIO = 0.9
+
+
+def _check_codec(codec):
+    if codec not in CODECS:
+        raise UpaxError("unknown codec %s" % codec)
+
+
+def choose_codec(sample, total_len=None, codec=CODEC_GZIP):
+    """
+    Decide how data should be stored given a sample from its start and
+    its total length (if None, the length of the sample).  Returns
+    codec if a trial compression of the sample suggests that it is
+    worth compressing, otherwise CODEC_NONE.
+    """
+    _check_codec(codec)
+    if total_len is None:
+        total_len = len(sample)
+    if codec == CODEC_NONE or total_len < MIN_COMPRESS_LEN or not sample:
+        return CODEC_NONE
+    sample = sample[:SAMPLE_LEN]
+    if len(zlib.compress(sample, 1)) > MAX_RATIO * len(sample):
+        return CODEC_NONE
+    return codec
+
+
+def needs_header(head):
+    """
+    Return whether data beginning with `head` must be stored behind a
+    header even if it is not compressed.
+    """
+    return head[:len(MAGIC)] == MAGIC
+
+
+def is_encoded(head):
+    """ Return whether stored data beginning with head has a header. """
+    if len(head) < HEADER_LEN or head[:len(MAGIC)] != MAGIC:
+        return False
+    return head[len(MAGIC)] in CODECS or head[len(MAGIC)] == CODEC_MANIFEST
+
+
+def is_encoded_file(path):
+    """ Return whether the stored file begins with a header. """
+    with open(path, 'rb') as file:
+        return is_encoded(file.read(HEADER_LEN))
+
+
+def is_manifest(head):
+    """ Return whether stored data beginning with head is a chunk manifest. """
+    return is_encoded(head) and head[len(MAGIC)] == CODEC_MANIFEST
+
+
+def is_manifest_file(path):
+    """ Return whether the stored file is a chunk manifest. """
+    with open(path, 'rb') as file:
+        return is_manifest(file.read(HEADER_LEN))
+
+# -- compression -----------------------------------------------------
+
+
+class _NullCompressor(object):
+    """ Passes data through unchanged, like the other compressors. """
+
+    @staticmethod
+    def compress(data):
+        return data
+
+    @staticmethod
+    def flush():
+        return b''
+
+
+def new_compressor(codec):
+    """
+    Return an object with compress() and flush() methods, like
+    zlib.compressobj(), implementing the codec.
+    """
+    _check_codec(codec)
+    if codec == CODEC_GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == CODEC_BZ2:
+        return bz2.BZ2Compressor()
+    elif codec == CODEC_LZMA:
+        return lzma.LZMACompressor()
+    return _NullCompressor()
+
+
+def make_header(codec, length):
+    """ Return the header for data of the given (raw) length. """
+    return _HEADER.pack(MAGIC, codec, length)
+
+
+def encode(data, codec):
+    """ Return data, compressed by codec, behind a header. """
+    comp = new_compressor(codec)
+    return make_header(codec, len(data)) + comp.compress(data) + comp.flush()
+
+
+def _no_manifest(head):
+    if is_manifest(head):
+        raise UpaxError("a chunk manifest can't be decoded on its own")
+
+
+def decode(blob):
+    """
+    Given the contents of a stored file, return the original data.
+    Data without a header is returned unchanged.
+    """
+    if not is_encoded(blob):
+        return blob
+    _no_manifest(blob)
+    (_, codec, length) = _HEADER.unpack_from(blob, 0)
+    body = blob[HEADER_LEN:]
+    if codec == CODEC_GZIP:
+        data = gzip.decompress(body)
+    elif codec == CODEC_BZ2:
+        data = bz2.decompress(body)
+    elif codec == CODEC_LZMA:
+        data = lzma.decompress(body)
+    else:
+        data = body
+    if len(data) != length:
+        raise UpaxError("decoded %u bytes, expected %u" % (len(data), length))
+    return data
+
+
+def encode_file(src, dest, codec):
+    """
+    Copy the binary file-like object src to dest, a binary file open
+    for writing, compressing with codec, in constant memory.  The raw
+    length in the header is filled in at the end, so dest must be
+    seekable.  Returns the number of bytes read from src.
+    """
+    start = dest.tell()
+    dest.write(make_header(codec, 0))
+    comp = new_compressor(codec)
+    length = 0
+    while True:
+        block = src.read(BLOCK_SIZE)
+        if not block:
+            break
+        length += len(block)
+        dest.write(comp.compress(block))
+    dest.write(comp.flush())
+    end = dest.tell()
+    dest.seek(start)
+    dest.write(make_header(codec, length))
+    dest.seek(end)
+    return length
+
+# -- decompression ---------------------------------------------------
+
+
+class _DecodedFile(object):
+    """
+    Read-only file-like object returning decoded data.  Closing it
+    closes the underlying file too.
+    """
+
+    def __init__(self, file, reader):
+        self._file = file
+        self._reader = reader
+
+    def read(self, size=-1):
+        """ Read and return up to size bytes, or everything if size < 0. """
+        return self._reader.read(size)
+
+    def close(self):
+        """ Close this and the underlying file. """
+        if self._reader is not self._file:
+            self._reader.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def open_decoded(path):
+    """
+    Open a stored file, returning a file-like object from which the
+    original data can be read as a stream.
+    """
+    file = open(path, 'rb')
+    head = file.read(HEADER_LEN)
+    if not is_encoded(head):
+        file.seek(0)
+        return _DecodedFile(file, file)
+    if is_manifest(head):
+        file.close()
+        _no_manifest(head)
+    codec = head[len(MAGIC)]
+    if codec == CODEC_GZIP:
+        reader = gzip.GzipFile(fileobj=file, mode='rb')
+    elif codec == CODEC_BZ2:
+        reader = bz2.BZ2File(file, mode='rb')
+    elif codec == CODEC_LZMA:
+        reader = lzma.LZMAFile(file, mode='rb')
+    else:
+        reader = file
+    return _DecodedFile(file, reader)
+
+
+def raw_len(path):
+    """ Return the length of the original data in a stored file. """
+    with open(path, 'rb') as file:
+        head = file.read(HEADER_LEN)
+    if is_encoded(head):
+        return _HEADER.unpack_from(head, 0)[2]
+    return os.stat(path).st_size
+
+
+def file_hex(path, hashtype):
+    """
+    Return the content key of the original data in a stored file,
+    compressed or not.
+    """
+    with open_decoded(path) as file:
+        return stream_hex(file, hashtype)
@@ -4,7 +4,10 @@
 """ Funcions for verifying the internal consistency of a upax server. """
 
 from upax import UpaxError
+from upax.evict import read_evictions
 from upax.ftlog import BoundLog, FileReader     # , LogEntry
+from upax.locking import append_lock
+from upax.logmerge import merged_log
 from upax.server import BlockingServer
 from upax.walker import UWalker
 
@@ -59,7 +62,9 @@ def check(options):
     future version of this program will have a map from valid nodeIDs
     to end points (fully qualified domain names and port numbers for
     peers), allowing utilities to fetch files from the source host
-    by content key.
+    by content key.  With --verbose, log entries whose keys are not
+    stored here are listed, distinguishing those recorded as evicted
+    (see upax.evict).
 
     """
     options.uServer = None
@@ -80,9 +85,13 @@ def _do_server_shutdown(options):
     try:
         # LOG: keyed by hash, later entries with same hash should
         # overwrite earlier
+        lock = append_lock(options.u_path)
         options.reader = FileReader(options.u_path, options.hashtype)
-        options.log = BoundLog(options.reader, options.hashtype)
+        options.log = BoundLog(options.reader, options.hashtype, lock=lock)
         log = options.log
+        # what writers with logs of their own have logged is also logged
+        index = merged_log(options.u_path, options.hashtype,
+                           lock=lock).index
 
         # U: sorted content keys
         keys = walk_u(options)
@@ -90,9 +99,9 @@ def _do_server_shutdown(options):
         # for now, just check whether each content key has a log
         # entry
         for key in keys:
-            if key in log.index:
+            if key in index:
                 if verbose:
-                    log_e = log.index[key]
+                    log_e = index[key]
                     print(("%s in ndx, src '%s'" % (key, log_e.src)))
             else:
                 if repairing:
@@ -105,6 +114,17 @@ def _do_server_shutdown(options):
                     if verbose:
                         print(("%s is not in the log" % key))
 
+        # log entries for keys not stored here: fine if evicted since
+        if verbose:
+            evicted = read_evictions(options.u_path)
+            for key in sorted(index):
+                if options.uServer.exists(key):
+                    continue
+                if evicted.get(key, -1) >= index[key].timestamp:
+                    print(("%s was evicted" % key))
+                else:
+                    print(("%s is in the log but not in U" % key))
+
         # DEBUG -------------------------------------------------
         if verbose:
             print(("COUNT OF ITEMS CHECKED IN U: %s" % len(keys)))
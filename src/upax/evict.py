@@ -0,0 +1,288 @@
+# ~/dev/py/upax/upax/evict.py
+
+"""
+Quota-driven eviction for Upax nodes used as caches.
+
+An Evictor keeps the size and recency of every object a Server stores.
+Whenever the store holds more than quota bytes it evicts objects until
+it is back under quota, choosing them by one of two policies:
+
+    POLICY_LRU      least recently used first
+    POLICY_GDSF     Greedy-Dual-Size-Frequency: lowest
+                    clock + frequency / size first, so that large,
+                    rarely read objects go before small, popular ones
+
+Keys in the pin set, persisted in uDir/pins, are never evicted.  Chunks
+of chunked data (see upax.chunker) are never chosen themselves; a chunk
+is evicted with the last stored manifest referring to it, and chunks
+left unreferenced by other deletions are evicted before anything else.
+
+The log is a record of what was put and is not changed.  Instead each
+eviction is appended to uDir/evicted as a line
+
+    TIMESTAMP KEY
+
+so that a log entry for a key which is no longer stored can be told
+apart from a lost file (see read_evictions()).  Recency is not saved:
+when a Server starts, objects are taken to have been used in log order.
+"""
+
+import heapq
+import os
+import time
+from collections import OrderedDict
+
+from upax import UpaxError
+from upax.chunker import CHUNK_PATH
+
+__all__ = ['Evictor', 'POLICY_LRU', 'POLICY_GDSF', 'read_evictions', ]
+
+POLICY_LRU = 'lru'
+POLICY_GDSF = 'gdsf'
+POLICIES = (POLICY_LRU, POLICY_GDSF)
+
+EVICTED_NAME = 'evicted'
+PINS_NAME = 'pins'
+
+
+def read_evictions(u_path):
+    """
+    Return a map key => time of the latest eviction of the key, from
+    the record in uDir/evicted.
+    """
+    path = os.path.join(u_path, EVICTED_NAME)
+    evicted = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 2:
+                    evicted[parts[1]] = float(parts[0])
+    return evicted
+
+
+class Evictor(object):
+    """ Keeps a Server's store under a byte quota. """
+
+    def __init__(self, server, quota, policy=POLICY_LRU):
+        if quota <= 0:
+            raise UpaxError("the eviction quota must be positive")
+        if policy not in POLICIES:
+            raise UpaxError("unknown eviction policy '%s'" % policy)
+        self._server = server
+        self._quota = quota
+        self._policy = policy
+        u_path = server.u_path
+        self._evicted_path = os.path.join(u_path, EVICTED_NAME)
+        self._pins_path = os.path.join(u_path, PINS_NAME)
+
+        self._sizes = {}            # key => bytes stored, chunks included
+        self._used = 0
+        self._chunks_of = {}        # manifest key => list of chunk keys
+        self._refs = {}             # chunk key => number of manifests
+        self._lru = OrderedDict()   # candidate key => None, oldest first
+        self._freq = {}             # candidate key => reads + 1 (GDSF)
+        self._prio = {}             # candidate key => priority (GDSF)
+        self._heap = []             # (priority, key), with stale entries
+        self._clock = 0.0           # GDSF inflation value
+        self._orphans = set()       # chunks no stored manifest refers to
+        self._pins = set()
+        if os.path.exists(self._pins_path):
+            with open(self._pins_path, 'r') as file:
+                self._pins = set(line.strip() for line in file
+                                 if line.strip())
+        self._load()
+
+    def _load(self):
+        """ Account for what is in the store, in log order. """
+        server = self._server
+        seen = set()
+        for entry in server.log.entries:
+            key = entry.key
+            if key in seen or not server.exists(key):
+                continue
+            seen.add(key)
+            self.note_put(key, chunk=entry.path == CHUNK_PATH)
+        self._orphans = set(key for (key, refs) in self._refs.items()
+                            if refs == 0)
+
+    @property
+    def quota(self):
+        """ Return the byte quota. """
+        return self._quota
+
+    @property
+    def policy(self):
+        """ Return the eviction policy. """
+        return self._policy
+
+    @property
+    def used(self):
+        """ Return the number of bytes stored. """
+        return self._used
+
+    @property
+    def pins(self):
+        """ Return a sorted list of the pinned keys. """
+        return sorted(self._pins)
+
+    def __contains__(self, key):
+        return key in self._sizes
+
+    # -- pins --------------------------------------------------------
+
+    def _save_pins(self):
+        tmp_path = self._pins_path + '.new'
+        with open(tmp_path, 'w') as file:
+            for key in sorted(self._pins):
+                file.write(key + '\n')
+        os.replace(tmp_path, self._pins_path)
+
+    def pin(self, key):
+        """ Protect the key from eviction. """
+        if key not in self._pins:
+            self._pins.add(key)
+            self._save_pins()
+
+    def unpin(self, key):
+        """ Allow the key to be evicted again. """
+        if key in self._pins:
+            self._pins.remove(key)
+            self._save_pins()
+
+    # -- bookkeeping -------------------------------------------------
+
+    def _charged(self, key):
+        """ Return the size GDSF charges the key: its data and chunks. """
+        size = self._sizes.get(key, 0)
+        for chunk in self._chunks_of.get(key, ()):
+            size += self._sizes.get(chunk, 0)
+        return max(size, 1)
+
+    def _prioritize(self, key):
+        prio = self._clock + self._freq[key] / self._charged(key)
+        self._prio[key] = prio
+        heapq.heappush(self._heap, (prio, key))
+
+    def note_put(self, key, chunk=False):
+        """
+        Account for an object just stored.  Chunks are counted against
+        the quota but are never eviction candidates themselves.
+        """
+        if key in self._sizes:
+            return
+        size = self._server.stored_len(key)
+        if size is None:
+            return
+        self._sizes[key] = size
+        self._used += size
+        if chunk:
+            # not yet an orphan: its manifest is stored after it
+            self._refs.setdefault(key, 0)
+            return
+        chunks = self._server.chunk_keys(key)
+        if chunks is not None:
+            chunks = list(OrderedDict.fromkeys(chunks))
+            self._chunks_of[key] = chunks
+            for c_key in chunks:
+                self._refs[c_key] = self._refs.get(c_key, 0) + 1
+                # referred to again, as when data is put after a delete
+                self._orphans.discard(c_key)
+        self._lru[key] = None
+        self._freq[key] = 1
+        if self._policy == POLICY_GDSF:
+            self._prioritize(key)
+
+    def touch(self, key):
+        """ Record a read of the key. """
+        if key not in self._lru:
+            return
+        self._lru.move_to_end(key)
+        self._freq[key] += 1
+        if self._policy == POLICY_GDSF:
+            self._prioritize(key)
+
+    def forget(self, key):
+        """ Drop the key from the accounts; it has been deleted. """
+        size = self._sizes.pop(key, None)
+        if size is None:
+            return
+        self._used -= size
+        self._lru.pop(key, None)
+        self._freq.pop(key, None)
+        self._prio.pop(key, None)
+        self._refs.pop(key, None)
+        self._orphans.discard(key)
+        for c_key in self._chunks_of.pop(key, ()):
+            if c_key in self._refs:
+                self._refs[c_key] -= 1
+                if self._refs[c_key] == 0:
+                    self._orphans.add(c_key)
+
+    # -- eviction ----------------------------------------------------
+
+    def _next_victim(self):
+        """ Return the key to evict next, or None if nothing may be. """
+        if self._policy == POLICY_LRU:
+            for key in self._lru:
+                if key not in self._pins:
+                    return key
+            return None
+        pinned = []
+        victim = None
+        while self._heap:
+            (prio, key) = heapq.heappop(self._heap)
+            if self._prio.get(key) != prio:
+                continue                    # stale
+            if key in self._pins:
+                pinned.append((prio, key))
+                continue
+            victim = key
+            self._clock = prio
+            break
+        for item in pinned:
+            heapq.heappush(self._heap, item)
+        return victim
+
+    def _record(self, keys):
+        now = time.time()
+        with open(self._evicted_path, 'a') as file:
+            for key in keys:
+                file.write('%.3f %s\n' % (now, key))
+
+    def evict(self, key):
+        """
+        Evict the key, and any of its chunks no other stored data refers
+        to, recording the eviction.  Return the list of keys deleted.
+        """
+        chunks = self._chunks_of.pop(key, [])
+        gone = []
+        if self._server.delete(key):
+            gone.append(key)
+        self.forget(key)
+        for c_key in chunks:
+            refs = self._refs.get(c_key, 0) - 1
+            if refs > 0:
+                self._refs[c_key] = refs
+                continue
+            self._refs.pop(c_key, None)
+            if self._server.delete(c_key):
+                gone.append(c_key)
+            self.forget(c_key)
+        self._record(gone)
+        return gone
+
+    def enforce(self):
+        """
+        Evict until the store is within its quota or nothing more may be
+        evicted.  Return the list of keys deleted.
+        """
+        gone = []
+        while self._used > self._quota and self._orphans:
+            gone.extend(self.evict(self._orphans.pop()))
+        while self._used > self._quota:
+            victim = self._next_victim()
+            if victim is None:
+                break
+            gone.extend(self.evict(victim))
+        return gone
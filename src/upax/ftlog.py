@@ -2,14 +2,21 @@
 
 """ Fault-tolerant log for a Upax node. """
 
+import io
 import os
 import re
+import struct
+import time
 # import sys
+from bisect import bisect_left, bisect_right, insort
 from collections import Container, Sized
 from xlattice import (HashTypes, check_hashtype,     # u,
                       SHA1_HEX_NONE, SHA2_HEX_NONE, SHA3_HEX_NONE,
                       BLAKE2B_HEX_NONE)
 from upax import UpaxError
+from upax import binlog
+from upax.binlog import LOG_FORMAT_TEXT, LOG_FORMAT_BINARY
+from upax.locking import append_lock
 from upax.node import check_hex_node_id_160, check_hex_node_id_256
 
 __all__ = ['ATEXT', 'AT_FREE',
@@ -17,9 +24,14 @@ __all__ = ['ATEXT', 'AT_FREE',
            'BODY_LINE_1_RE', 'BODY_LINE_256_RE',
            'IGNORABLE_RE',
 
+           'LOG_FORMAT_TEXT', 'LOG_FORMAT_BINARY',
+
+           # functions
+           'convert_log', 'parse_entry_line', 'recover_tail',
+
            # classes
-           'Log', 'BoundLog', 'LogEntry',
-           'Reader', 'FileReader', 'StringReader', ]
+           'Log', 'BoundLog', 'LogEntry', 'LogFollower', 'RecoveryReport',
+           'Reader', 'BinaryReader', 'FileReader', 'StringReader', ]
 
 # -------------------------------------------------------------------
 # CLASS LOG AND SUBCLASSES
@@ -46,11 +58,50 @@ BODY_LINE_256_RE = re.compile(BODY_LINE_256_PAT, re.I)
 IGNORABLE_PAT = '(^ *$)|^ *#'
 IGNORABLE_RE = re.compile(IGNORABLE_PAT)
 
+FIRST_LINE_1_PAT = r'^(\d{13}) ([0-9a-f]{40}) ([0-9a-f]{40})$'
+FIRST_LINE_1_RE = re.compile(FIRST_LINE_1_PAT, re.I)
+
+FIRST_LINE_256_PAT = r'^(\d{13}) ([0-9a-f]{64}) ([0-9a-f]{64})$'
+FIRST_LINE_256_RE = re.compile(FIRST_LINE_256_PAT, re.I)
+
+# Serialization formats.  Field widths are minimums, so a valid key or
+# nodeID is written identically whichever of the two formats is used.
+HEADER_FMT_1 = '%013u %40s %40s\n'
+HEADER_FMT_256 = '%013u %64s %64s\n'
+ENTRY_FMT_1 = '%013u %40s %40s "%s" %s\n'
+ENTRY_FMT_256 = '%013u %64s %64s "%s" %s\n'
+
+# number of entries serialized before each write() when streaming a Log
+WRITE_CHUNK = 4096
+
+
+def _formats(hashtype):
+    """ Return the (header, entry) formats used with this hash type. """
+    if hashtype == HashTypes.SHA1:
+        return (HEADER_FMT_1, ENTRY_FMT_1)
+    return (HEADER_FMT_256, ENTRY_FMT_256)
+
+
+def _is_binary(writer):
+    """ Return whether writer expects bytes rather than str. """
+    if isinstance(writer, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    if isinstance(writer, io.TextIOBase):
+        return False
+    return 'b' in getattr(writer, 'mode', '')
+
 
 class Log(Container, Sized):
-    """a fault-tolerant log"""
+    """
+    a fault-tolerant log
 
-    def __init__(self, reader, hashtype):
+    Entries are always indexed by key and by timestamp.  If `secondary`
+    is True the Log also maintains indexes by node_id, src, and path;
+    these are built on load and then kept current by add_entry().  If
+    not, they are built on the first query which needs them.
+    """
+
+    def __init__(self, reader, hashtype, secondary=False):
         self._hashtype = hashtype
         (timestamp, prev_log_hash, prev_master, entries, index) = reader.read()
         self._timestamp = timestamp     # seconds from epoch
@@ -68,6 +119,20 @@ class Log(Container, Sized):
         self._entries = entries       # a list
         self._index = index         # a map, hash => entry
 
+        # secondary indexes, None until built
+        self._by_node_id = None     # node_id => list of entries
+        self._by_src = None         # src => list of entries
+        self._by_path = None        # path => list of entries
+        self._sorted_paths = None   # distinct paths, sorted
+        if secondary:
+            self.build_secondary_indexes()
+
+        # timestamp index: two parallel arrays sorted by timestamp, the
+        # second holding positions in self._entries
+        self._ts_times = []
+        self._ts_ndx = []
+        self._build_timestamp_index()
+
     def __contains__(self, key):
         """ Return whether this key is in the Log. """
         return key in self._index
@@ -78,18 +143,72 @@ class Log(Container, Sized):
 
     def __str__(self):
         """used for serialization, so includes newline"""
+        buf = io.StringIO()
+        self.write_to(buf)
+        return buf.getvalue()
 
-        # first line
-        if self._hashtype == HashTypes.SHA1:
-            fmt = "%013u %40s %40s\n"
-        else:
-            fmt = "%013u %64s %64s\n"
-        ret = fmt % (self._timestamp, self._prev_hash, self._prev_master)
+    def to_bytes(self, log_format=LOG_FORMAT_TEXT):
+        """
+        Return the serialized Log as bytes: UTF-8 text or, if log_format
+        is LOG_FORMAT_BINARY, the binary format.
+        """
+        buf = io.BytesIO()
+        self.write_to(buf, log_format=log_format)
+        return buf.getvalue()
 
-        # list of entries
-        for entry in self._entries:
-            ret += str(entry)           # woefully inefficient :-)
-        return ret
+    def write_to(self, writer, chunk_size=WRITE_CHUNK,
+                 log_format=LOG_FORMAT_TEXT):
+        """
+        Serialize the Log, streaming it to writer in chunks of chunk_size
+        entries.  The writer may be a text or binary file-like object;
+        anything else with a write() method is treated as text unless
+        its mode contains 'b'.  A callable writer is called with each
+        chunk, as text.
+
+        If log_format is LOG_FORMAT_BINARY the Log is written in the
+        binary format, and the writer must accept bytes.
+
+        The time taken is linear in the number of entries and the extra
+        memory used is proportional to chunk_size.
+        """
+        if hasattr(writer, 'write'):
+            binary = _is_binary(writer)
+            write = writer.write
+        elif callable(writer):
+            binary = log_format == LOG_FORMAT_BINARY
+            write = writer
+        else:
+            raise UpaxError("can't write log to %s" % type(writer))
+
+        if log_format == LOG_FORMAT_BINARY:
+            if not binary:
+                raise UpaxError("binary log needs a binary writer")
+            self._write_binary(write, chunk_size)
+            return
+
+        (header_fmt, entry_fmt) = _formats(self._hashtype)
+        header = header_fmt % (
+            self._timestamp, self._prev_hash, self._prev_master)
+        write(header.encode('utf-8') if binary else header)
+
+        entries = self._entries
+        for start in range(0, len(entries), chunk_size):
+            chunk = ''.join([
+                entry_fmt % (e.timestamp, e.key, e.node_id, e.src, e.path)
+                for e in entries[start:start + chunk_size]])
+            write(chunk.encode('utf-8') if binary else chunk)
+
+    def _write_binary(self, write, chunk_size):
+        """ Stream the Log in the binary format. """
+        hashtype = self._hashtype
+        write(binlog.encode_header(hashtype, self._timestamp,
+                                   self._prev_hash, self._prev_master))
+        encode = binlog.encode_record
+        entries = self._entries
+        for start in range(0, len(entries), chunk_size):
+            write(b''.join([
+                encode(hashtype, e.timestamp, e.key, e.node_id, e.src, e.path)
+                for e in entries[start:start + chunk_size]]))
 
     def add_entry(self, tstamp, key, node_id, src, path):
         """
@@ -106,6 +225,9 @@ class Log(Container, Sized):
                 return existing         # silently ignore duplicates
         self._entries.append(entry)     # increases size of list
         self._index[key] = entry        # overwrites any earlier duplicates
+        self._index_timestamp(entry.timestamp, len(self._entries) - 1)
+        if self._by_node_id is not None:
+            self._index_secondary(entry)
         return entry
 
     def get_entry(self, key):
@@ -114,6 +236,130 @@ class Log(Container, Sized):
             return None
         return self._index[key]
 
+    # secondary indexes -------------------------------------------
+
+    def build_secondary_indexes(self):
+        """
+        Index all entries by node_id, src, and path.  After this call
+        the indexes are maintained incrementally by add_entry().
+        """
+        self._by_node_id = dict()
+        self._by_src = dict()
+        self._by_path = dict()
+        for entry in self._entries:
+            self._by_node_id.setdefault(entry.node_id, []).append(entry)
+            self._by_src.setdefault(entry.src, []).append(entry)
+            self._by_path.setdefault(entry.path, []).append(entry)
+        self._sorted_paths = sorted(self._by_path.keys())
+
+    def _index_secondary(self, entry):
+        """ Add a single entry to the secondary indexes. """
+        self._by_node_id.setdefault(entry.node_id, []).append(entry)
+        self._by_src.setdefault(entry.src, []).append(entry)
+        path = entry.path
+        if path in self._by_path:
+            self._by_path[path].append(entry)
+        else:
+            self._by_path[path] = [entry]
+            insort(self._sorted_paths, path)
+
+    @property
+    def has_secondary_indexes(self):
+        """ Return whether the node_id/src/path indexes have been built. """
+        return self._by_node_id is not None
+
+    def entries_by_node_id(self, node_id):
+        """
+        Return a list of the entries contributed by the node, in the
+        order in which they were added to the Log.
+        """
+        if self._by_node_id is None:
+            self.build_secondary_indexes()
+        return list(self._by_node_id.get(node_id, []))
+
+    def entries_by_src(self, src):
+        """ Return a list of the entries with the given src. """
+        if self._by_src is None:
+            self.build_secondary_indexes()
+        return list(self._by_src.get(src, []))
+
+    def entries_by_path(self, path):
+        """
+        Return a list of the entries whose path is exactly `path`.  If
+        the path has been logged more than once, the latest entry is last.
+        """
+        if self._by_path is None:
+            self.build_secondary_indexes()
+        return list(self._by_path.get(path, []))
+
+    def entries_by_path_prefix(self, prefix):
+        """
+        Return a list of the entries whose path begins with `prefix`,
+        ordered by path and then by position in the Log.
+        """
+        if self._by_path is None:
+            self.build_secondary_indexes()
+        paths = self._sorted_paths
+        ret = []
+        ndx = bisect_left(paths, prefix)
+        while ndx < len(paths) and paths[ndx].startswith(prefix):
+            ret.extend(self._by_path[paths[ndx]])
+            ndx += 1
+        return ret
+
+    # timestamp index ---------------------------------------------
+
+    def _build_timestamp_index(self):
+        """
+        Index entries by timestamp.  Entries are normally appended in
+        time order, in which case this is a single linear pass.
+        """
+        times = [entry.timestamp for entry in self._entries]
+        ndxs = list(range(len(times)))
+        if any(times[i] > times[i + 1] for i in range(len(times) - 1)):
+            ndxs.sort(key=times.__getitem__)        # stable
+            times = [times[i] for i in ndxs]
+        self._ts_times = times
+        self._ts_ndx = ndxs
+
+    def _index_timestamp(self, tstamp, ndx):
+        """ Add the entry at position ndx to the timestamp index. """
+        times = self._ts_times
+        if not times or tstamp >= times[-1]:
+            times.append(tstamp)
+            self._ts_ndx.append(ndx)
+        else:
+            where = bisect_right(times, tstamp)
+            times.insert(where, tstamp)
+            self._ts_ndx.insert(where, ndx)
+
+    def entries_between(self, start=None, end=None):
+        """
+        Return an iterator over the entries with start <= timestamp < end
+        in timestamp order.  Either bound may be None, meaning unbounded.
+        """
+        times = self._ts_times
+        first = 0 if start is None else bisect_left(times, start)
+        last = len(times) if end is None else bisect_left(times, end)
+        entries = self._entries
+        return (entries[ndx] for ndx in self._ts_ndx[first:last])
+
+    def entries_since(self, tstamp):
+        """
+        Return an iterator over the entries whose timestamp is at or
+        after tstamp, in timestamp order.
+        """
+        return self.entries_between(tstamp, None)
+
+    def entries_from(self, seq):
+        """
+        Return an iterator over the entries added at or after position
+        `seq` in the Log.  A caller can use len(log) as a cursor:
+        remember it and later ask for the entries from that point on.
+        """
+        entries = self._entries
+        return (entries[ndx] for ndx in range(seq, len(entries)))
+
     @property
     def entries(self):
         """ Return the list of LogEntries. """
@@ -143,11 +389,29 @@ class Log(Container, Sized):
 
 
 class BoundLog(Log):
-    """ A fult tolerant log bound to a file. """
+    """
+    A fult tolerant log bound to a file.
+
+    The file is written in log_format, which defaults to the format the
+    reader found, so text for a StringReader and whatever is on disk
+    for a FileReader.
+
+    If lock (see upax.locking) is given, every append is made while
+    holding it and is flushed before it is released, so that several
+    processes can append to the same file.  Whatever rewrites the file,
+    such as convert_log(), does so holding the same lock, and if the
+    file has been replaced since it was opened it is opened again, in
+    whatever format it now has, before anything is appended.
+    """
 
     def __init__(self, reader, hashtype=HashTypes.SHA2,
-                 u_path=None, base_name='L'):
-        super(). __init__(reader, hashtype)
+                 u_path=None, base_name='L', secondary=False,
+                 log_format=None, lock=None):
+        super(). __init__(reader, hashtype, secondary)
+        if log_format is None:
+            log_format = reader.log_format
+        self._log_format = log_format
+        self._lock = lock
         self.fd_ = None
         self.is_open = False     # for appending
         overwriting = False
@@ -164,27 +428,141 @@ class BoundLog(Log):
                 msg = "no target uPath/baseName specified"
                 raise UpaxError(msg)
         self.path_to_log = "%s/%s" % (self.u_path, self.base_name)
+        binary = log_format == LOG_FORMAT_BINARY
         if overwriting:
-            with open(self.path_to_log, 'w') as file:
-                log_contents = super(BoundLog, self).__str__()
-                file.write(log_contents)
-                file.close()
-        self.fd_ = open(self.path_to_log, 'a')
+            with open(self.path_to_log, 'wb' if binary else 'w') as file:
+                self.write_to(file, log_format=log_format)
+        self._open()
+
+    def _open(self):
+        """ Open the file for appending in the current format. """
+        binary = self._log_format == LOG_FORMAT_BINARY
+        self.fd_ = open(self.path_to_log, 'ab' if binary else 'a')
+        stat = os.fstat(self.fd_.fileno())
+        self._file_id = (stat.st_dev, stat.st_ino)
         self.is_open = True
 
+    def _reopen_if_replaced(self):
+        """
+        If the file has been replaced since it was opened, open the new
+        one, returning True.  Called holding the lock.
+        """
+        try:
+            stat = os.stat(self.path_to_log)
+        except FileNotFoundError:
+            return False
+        if (stat.st_dev, stat.st_ino) == self._file_id:
+            return False
+        self.fd_.close()
+        with open(self.path_to_log, 'rb') as file:
+            magic = file.read(len(binlog.MAGIC))
+        if binlog.is_binary_log(magic):
+            self._log_format = LOG_FORMAT_BINARY
+        else:
+            self._log_format = LOG_FORMAT_TEXT
+        self._open()
+        return True
+
+    def _encode(self, entries):
+        """ Return the entries serialized in the log's format. """
+        if self._log_format == LOG_FORMAT_BINARY:
+            return b''.join(binlog.encode_record(
+                self._hashtype, e.timestamp, e.key, e.node_id, e.src,
+                e.path) for e in entries)
+        return ''.join(str(e) for e in entries)
+
+    @property
+    def log_format(self):
+        """ Return the format of the log file, text or binary. """
+        return self._log_format
+
     def add_entry(self, tstamp, key, node_id, src, path):
         if not self.is_open:
             msg = "log file %s is not open for appending" % self.path_to_log
             raise UpaxError(msg)
 
         # XXX NEED TO THINK ABOUT THE ORDER OF OPERATIONS HERE
-        entry = super(
-            BoundLog,
-            self).add_entry(tstamp, key, node_id, src, path)
-        stringified = str(entry)
-        self.fd_.write(stringified)
+        if self._log_format == LOG_FORMAT_BINARY:
+            # encode first: this validates fields the text format accepts
+            record = binlog.encode_record(self._hashtype, tstamp, key,
+                                          node_id, src, path)
+            entry = super(
+                BoundLog,
+                self).add_entry(tstamp, key, node_id, src, path)
+            self._append(record, entries=[entry])
+        else:
+            entry = super(
+                BoundLog,
+                self).add_entry(tstamp, key, node_id, src, path)
+            stringified = str(entry)
+            self._append(stringified, entries=[entry])
         return entry
 
+    def _append(self, record, flush=False, entries=None):
+        """
+        Write to the end of the file, under the lock if there is one.
+        record serializes entries; it is serialized again if the file
+        has been replaced by one in another format.
+        """
+        if self._lock is None:
+            self.fd_.write(record)
+            if flush:
+                self.fd_.flush()
+        else:
+            with self._lock:
+                if self._reopen_if_replaced():
+                    record = self._encode(entries)
+                self.fd_.write(record)
+                self.fd_.flush()
+
+    def add_entries(self, items):
+        """
+        Add an entry for each (tstamp, key, node_id, src, path) in items,
+        appending them all to the file in a single write followed by a
+        flush.  Returns the list of LogEntries.
+        """
+        if not self.is_open:
+            msg = "log file %s is not open for appending" % self.path_to_log
+            raise UpaxError(msg)
+        binary = self._log_format == LOG_FORMAT_BINARY
+        records = []
+        entries = []
+        for (tstamp, key, node_id, src, path) in items:
+            if binary:
+                records.append(binlog.encode_record(
+                    self._hashtype, tstamp, key, node_id, src, path))
+            entry = super(
+                BoundLog,
+                self).add_entry(tstamp, key, node_id, src, path)
+            if not binary:
+                records.append(str(entry))
+            entries.append(entry)
+        self._append((b'' if binary else '').join(records), flush=True,
+                     entries=entries)
+        return entries
+
+    @property
+    def end_offset(self):
+        """
+        Return the byte offset of the end of the log file, counting
+        everything written so far.  This flushes the log.
+        """
+        self.fd_.flush()
+        return self.fd_.tell()
+
+    def follower(self, from_start=False):
+        """
+        Return a LogFollower on this log's file.  The follower is
+        positioned at the current end of the log unless from_start is
+        True, in which case its first poll() returns every entry.
+        """
+        if from_start:
+            offset = 0
+        else:
+            offset = self.end_offset
+        return LogFollower(self.path_to_log, self._hashtype, offset,
+                           self._log_format)
+
     def flush(self):
         """
         Flush the log.
@@ -275,9 +653,9 @@ class LogEntry():
     # used in serialization, so newlines are intended
     def __str__(self):
         if self.hashtype == HashTypes.SHA1:
-            fmt = '%013u %40s %40s "%s" %s\n'
+            fmt = ENTRY_FMT_1
         else:
-            fmt = '%013u %64s %64s "%s" %s\n'
+            fmt = ENTRY_FMT_256
         return fmt % (self._timestamp, self._key,
                       self._node_id, self._src, self._path)
 
@@ -298,6 +676,127 @@ class LogEntry():
         """
         return self.__eq__(other)
 
+
+def parse_entry_line(line, hashtype):
+    """
+    Parse a single body line of a serialized log, returning a LogEntry,
+    or None if the line is blank or a comment.  Raises UpaxError if the
+    line is neither.
+    """
+    if IGNORABLE_RE.match(line):
+        return None
+    if hashtype == HashTypes.SHA1:
+        match = BODY_LINE_1_RE.match(line)
+    else:
+        match = BODY_LINE_256_RE.match(line)
+    if not match:
+        msg = "not a valid log entry line: '%s'" % line
+        raise UpaxError(msg)
+    # constructor should catch invalid fields
+    return LogEntry(int(match.group(1)), match.group(2), match.group(3),
+                    match.group(4), match.group(5))
+
+# -------------------------------------------------------------------
+
+
+class LogFollower(object):
+    """
+    Tails a log file, returning entries as they are appended.
+
+    The follower holds a byte offset into the file; poll() reads from
+    there to the end of the last complete line and advances the offset.
+    A partially written line is left for the next poll().  Offsets can
+    be saved and used later to construct a new follower, so a consumer
+    can resume where it left off.  An offset of zero means the start of
+    the file, in which case the first line, describing the previous
+    log, is skipped.
+
+    Binary logs are followed record by record in the same way.  If
+    log_format is None it is determined from the file on the first poll.
+    """
+
+    def __init__(self, path_to_log, hashtype=HashTypes.SHA2, offset=0,
+                 log_format=None):
+        check_hashtype(hashtype)
+        self._path_to_log = path_to_log
+        self._hashtype = hashtype
+        self._offset = offset
+        self._log_format = log_format
+        self._seq = 0               # count of entries returned
+
+    @property
+    def offset(self):
+        """ Return the byte offset of the next unread line. """
+        return self._offset
+
+    @property
+    def seq(self):
+        """ Return the number of entries returned by this follower. """
+        return self._seq
+
+    @property
+    def path_to_log(self):
+        """ Return the path to the log file being followed. """
+        return self._path_to_log
+
+    def poll(self, max_entries=None):
+        """
+        Return a list of the entries appended since the last poll,
+        possibly empty.  If max_entries is not None, return at most
+        that many.
+        """
+        entries = []
+        if not os.path.exists(self._path_to_log):
+            return entries
+        with open(self._path_to_log, 'rb') as file:
+            if self._log_format is None:
+                magic = file.read(len(binlog.MAGIC))
+                if len(magic) < len(binlog.MAGIC) and \
+                        binlog.MAGIC.startswith(magic):
+                    return entries          # can't tell yet
+                if binlog.is_binary_log(magic):
+                    self._log_format = LOG_FORMAT_BINARY
+                else:
+                    self._log_format = LOG_FORMAT_TEXT
+            if self._log_format == LOG_FORMAT_BINARY:
+                return self._poll_binary(file, max_entries)
+            file.seek(self._offset)
+            while max_entries is None or len(entries) < max_entries:
+                raw = file.readline()
+                if not raw.endswith(b'\n'):
+                    break                   # EOF or incomplete line
+                start = self._offset
+                self._offset += len(raw)
+                if start == 0:
+                    continue                # first line describes prev log
+                entry = parse_entry_line(raw[:-1].decode('utf-8'),
+                                         self._hashtype)
+                if entry is not None:
+                    entries.append(entry)
+        self._seq += len(entries)
+        return entries
+
+    def _poll_binary(self, file, max_entries):
+        """ poll() for a binary log. """
+        entries = []
+        if self._offset == 0:
+            h_len = binlog.header_len(self._hashtype)
+            if len(file.read(h_len)) < h_len:
+                return entries              # header not yet complete
+            self._offset = h_len
+        file.seek(self._offset)
+        data = file.read()
+        for (tstamp, key, node_id, src, path, end) in binlog.decode_records(
+                data, self._hashtype, 0, partial_ok=True):
+            entries.append(LogEntry(tstamp, key, node_id, src, path))
+            consumed = end
+            if max_entries is not None and len(entries) >= max_entries:
+                break
+        if entries:
+            self._offset += consumed
+        self._seq += len(entries)
+        return entries
+
 # -------------------------------------------------------------------
 # CLASS READER AND SUBCLASSES
 # -------------------------------------------------------------------
@@ -323,10 +822,9 @@ class Reader(object):
         check_hashtype(hashtype)
         self._hashtype = hashtype
         if hashtype == HashTypes.SHA1:
-            first_line_pat = r'^(\d{13}) ([0-9a-f]{40}) ([0-9a-f]{40})$'
+            self.first_line_re = FIRST_LINE_1_RE
         else:
-            first_line_pat = r'^(\d{13}) ([0-9a-f]{64}) ([0-9a-f]{64})$'
-        self.first_line_re = re.compile(first_line_pat, re.I)
+            self.first_line_re = FIRST_LINE_256_RE
 
         # XXX verify that argument is an array of strings
         self._lines = lines
@@ -346,6 +844,11 @@ class Reader(object):
         """ Return the type of SHA hash used. """
         return self._hashtype
 
+    @property
+    def log_format(self):
+        """ Return the format of the serialized log, text or binary. """
+        return LOG_FORMAT_TEXT
+
     def read(self):
         """
         The first line contains timestamp, hash, nodeID for previous Log.
@@ -394,38 +897,56 @@ class Reader(object):
             # Read each successive line, creating an entry for each and
             # indexing each.  Ignore blank lines and those beginning with
             # a hash ('#')
-            match = re.match(IGNORABLE_RE, line)
-            if match:
-                continue
-            if self._hashtype == HashTypes.SHA1:
-                match = re.match(BODY_LINE_1_RE, line)
-            else:
-                match = re.match(BODY_LINE_256_RE, line)
-            if match:
-                tstamp = int(match.group(1))
-                key = match.group(2)
-                node_id = match.group(3)
-                src = match.group(4)
-                path = match.group(5)
-                # constructor should catch invalid fields
-                entry = LogEntry(tstamp, key, node_id, src, path)
+            entry = parse_entry_line(line, self._hashtype)
+            if entry is not None:
                 entries.append(entry)
-                index[key] = entry
-            else:
-                msg = "not a valid log entry line: '%s'" % line
-                raise UpaxError(msg)
+                index[entry.key] = entry
 
         return (timestamp, prev_log_hash, prev_master, entries, index)
 
 # -------------------------------------------------------------------
 
 
+def _read_binary(data, hashtype):
+    """ Parse a binary log, returning what Reader.read() returns. """
+    (timestamp, prev_log_hash, prev_master, offset) = \
+        binlog.decode_header(data, hashtype)
+    entries = []
+    index = dict()
+    for (tstamp, key, node_id, src, path, _) in binlog.decode_records(
+            data, hashtype, offset):
+        entry = LogEntry(tstamp, key, node_id, src, path)
+        entries.append(entry)
+        index[key] = entry
+    return (timestamp, prev_log_hash, prev_master, entries, index)
+
+
+class BinaryReader(Reader):
+    """
+    Accept the bytes of a binary (version 2) log.
+    """
+
+    def __init__(self, data, hashtype=False):
+        super().__init__([], hashtype)
+        self._data = data
+
+    @property
+    def log_format(self):
+        return LOG_FORMAT_BINARY
+
+    def read(self):
+        return _read_binary(self._data, self._hashtype)
+
+
 class FileReader(Reader):
     """
     Accept uPath and optionally log file name, read entire file into
     a string array, pass to Reader.
+
+    If the file begins with the binary log magic it is parsed as a
+    binary log instead.
     """
-    __slots__ = ['_u_path', '_base_name', '_log_file', ]
+    __slots__ = ['_u_path', '_base_name', '_log_file', '_data', ]
 
     # XXX CHECK ORDER OF ARGUMENTS
     def __init__(self, u_path, hashtype=False, base_name="L"):
@@ -434,11 +955,27 @@ class FileReader(Reader):
         self._u_path = u_path
         self._base_name = base_name
         self._log_file = "%s/%s" % (self._u_path, base_name)
-        with open(self._log_file, 'r') as file:
-            contents = file.read()
-        lines = contents.split('\n')
+        with open(self._log_file, 'rb') as file:
+            data = file.read()
+        if binlog.is_binary_log(data):
+            self._data = data
+            lines = []
+        else:
+            self._data = None
+            lines = str(data, 'utf-8').split('\n')
         super(FileReader, self).__init__(lines, hashtype)
 
+    @property
+    def log_format(self):
+        if self._data is None:
+            return LOG_FORMAT_TEXT
+        return LOG_FORMAT_BINARY
+
+    def read(self):
+        if self._data is None:
+            return super().read()
+        return _read_binary(self._data, self._hashtype)
+
     @property
     def base_name(self):
         """ Return the base name of the log file. """
@@ -468,3 +1005,265 @@ class StringReader(Reader):
         lines = bigString.split('\n')
 
         super().__init__(lines, hashtype)
+
+# -------------------------------------------------------------------
+
+
+def convert_log(u_path, hashtype, log_format, base_name='L', lock=None):
+    """
+    Rewrite u_path/base_name in log_format, text or binary.  Return
+    False if the log was already in that format, True otherwise.
+
+    The conversion must be lossless: the converted log is read back and
+    serialized in the original format, and unless that reproduces the
+    original file byte for byte the log is left unchanged and UpaxError
+    is raised.  Comments and blank lines in a text log, upper-case hex,
+    and non-integer timestamps all cause this.
+
+    The log is read and replaced holding its append lock, so Servers
+    may go on appending to it; lock is that FileLock, if the caller
+    already holds it.
+    """
+    if lock is None:
+        lock = append_lock(u_path, base_name)
+    with lock:
+        reader = FileReader(u_path, hashtype, base_name)
+        old_format = reader.log_format
+        if old_format == log_format:
+            return False
+        log = Log(reader, hashtype)
+        path_to_log = os.path.join(u_path, base_name)
+        tmp_name = base_name + '.convert'
+        path_to_tmp = os.path.join(u_path, tmp_name)
+        try:
+            with open(path_to_tmp, 'wb') as file:
+                log.write_to(file, log_format=log_format)
+                file.flush()
+                os.fsync(file.fileno())
+            check = Log(FileReader(u_path, hashtype, tmp_name), hashtype)
+            with open(path_to_log, 'rb') as file:
+                original = file.read()
+            if check.to_bytes(old_format) != original:
+                raise UpaxError("can't convert %s losslessly" % path_to_log)
+            os.replace(path_to_tmp, path_to_log)
+        finally:
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+    return True
+
+# -------------------------------------------------------------------
+# CRASH RECOVERY
+# -------------------------------------------------------------------
+
+# how much of the end of the log recover_tail() will look at
+TAIL_WINDOW = 256 * 1024
+
+
+class RecoveryReport(object):
+    """ Describes what, if anything, recover_tail() removed from a log. """
+
+    def __init__(self, path_to_log, log_size, truncated_at,
+                 dropped, quarantine_path=None):
+        self._path_to_log = path_to_log
+        self._log_size = log_size
+        self._truncated_at = truncated_at
+        self._dropped = dropped
+        self._quarantine_path = quarantine_path
+
+    @property
+    def path_to_log(self):
+        """ Return the path to the log examined. """
+        return self._path_to_log
+
+    @property
+    def clean(self):
+        """ Return whether the log was intact, so that nothing was dropped. """
+        return not self._dropped
+
+    @property
+    def log_size(self):
+        """ Return the length of the log file before recovery. """
+        return self._log_size
+
+    @property
+    def truncated_at(self):
+        """ Return the length of the log file after recovery. """
+        return self._truncated_at
+
+    @property
+    def dropped(self):
+        """ Return the bytes removed from the end of the log. """
+        return self._dropped
+
+    @property
+    def quarantine_path(self):
+        """ Return the path to the file holding the dropped bytes, if any. """
+        return self._quarantine_path
+
+    def __str__(self):
+        if self.clean:
+            return "%s: clean, %u bytes" % (self._path_to_log, self._log_size)
+        msg = "%s: dropped %u bytes at offset %u" % (
+            self._path_to_log, len(self._dropped), self._truncated_at)
+        if self._quarantine_path:
+            msg += ", saved in %s" % self._quarantine_path
+        return msg
+
+
+def _text_line_ok(line, at_start, hashtype):
+    """ Return whether a complete line (without newline) is valid. """
+    try:
+        string = str(line, 'utf-8')
+        if at_start:
+            if hashtype == HashTypes.SHA1:
+                return FIRST_LINE_1_RE.match(string) is not None
+            return FIRST_LINE_256_RE.match(string) is not None
+        parse_entry_line(string, hashtype)
+        return True
+    except (UnicodeDecodeError, UpaxError):
+        return False
+
+
+def _text_tail_cut(data, start, hashtype):
+    """
+    Given the tail of a text log beginning at file offset start, return
+    the offset at which the valid part of the log ends.  Only an
+    unterminated last line, or else a damaged last line, is dropped: if
+    any other complete line in the window is damaged, UpaxError is
+    raised and the log is left to be repaired by hand.
+    """
+    last_nl = data.rfind(b'\n')
+    if last_nl == -1:
+        if start > 0:
+            raise UpaxError("damage extends beyond the tail window")
+        return 0                        # not even the first line is complete
+    # the first line in the window may begin before it
+    line_start = 0 if start == 0 else data.find(b'\n') + 1
+    if line_start > last_nl:
+        raise UpaxError("damage extends beyond the tail window")
+    bad = []                            # offsets of damaged lines
+    while line_start <= last_nl:
+        line_end = data.find(b'\n', line_start)
+        if not _text_line_ok(data[line_start:line_end],
+                             start + line_start == 0, hashtype):
+            bad.append(line_start)
+        line_start = line_end + 1
+    if not bad:
+        return start + last_nl + 1      # drop any unterminated last line
+    if start + bad[0] == 0:
+        raise UpaxError("log header is damaged or of another hash type")
+    if len(bad) > 1 or last_nl + 1 < len(data) or \
+            data.find(b'\n', bad[0]) != last_nl:
+        raise UpaxError("log is damaged before its last record")
+    return start + bad[0]
+
+
+def _binary_tail_cut(data, start, hashtype):
+    """
+    Given the tail of a binary log beginning at file offset start, return
+    the offset at which the last intact record ends.  Records repeat
+    their length after the payload, so this works backwards from the
+    end, trying each position until one ends a record with the right
+    lengths and CRC.  Only the last record may be dropped: if any
+    earlier record in the window is damaged, UpaxError is raised.
+    """
+    h_len = binlog.header_len(hashtype)
+    floor = max(h_len - start, 0)       # no records before the header
+    rec_len = binlog.RECORD_OVERHEAD
+
+    def begins(end):
+        """
+        Return where the record ending at end begins, None if it is
+        damaged, or -1 if it begins before the window.
+        """
+        if end - 4 < floor:
+            return -1 if floor == 0 else None
+        (p_len,) = struct.unpack_from('<I', data, end - 4)
+        rec_start = end - p_len - rec_len
+        if rec_start < floor:
+            return -1 if floor == 0 else None
+        (head_len, crc) = struct.unpack_from('<II', data, rec_start)
+        if head_len == p_len and crc == binlog.crc32c_of(
+                data[rec_start + 8:end - 4]):
+            return rec_start
+        return None
+
+    cut = len(data)
+    while cut > floor and begins(cut) in (None, -1):
+        cut -= 1
+    if cut == 0 and floor == 0:
+        raise UpaxError("damage extends beyond the tail window")
+    torn = data[cut:]
+    if len(torn) >= 8:
+        # what is dropped must be all or part of a single record
+        (p_len,) = struct.unpack_from('<I', torn, 0)
+        if p_len + rec_len < len(torn):
+            raise UpaxError("log is damaged before its last record")
+    end = cut
+    while start + end > h_len:
+        rec_start = begins(end)
+        if rec_start is None:
+            raise UpaxError("log is damaged before its last record")
+        if rec_start == -1:
+            break
+        end = rec_start
+    return start + cut
+
+
+def recover_tail(u_path, hashtype=HashTypes.SHA2, base_name='L',
+                 quarantine=True, window=TAIL_WINDOW):
+    """
+    Check the end of u_path/base_name for a partially written or
+    damaged final record, such as a process dying during a write leaves
+    behind, and truncate the log just after the last intact record.
+    Only the last `window` bytes of the log are read, so this takes the
+    same time whatever the size of the log.
+
+    If quarantine is True, any bytes dropped are saved in a file named
+    like base_name.torn.TIMESTAMP in u_path.  Returns a RecoveryReport.
+    Nothing but a torn or damaged last record is ever dropped: UpaxError
+    is raised, and the log left as it is, if the damage extends beyond
+    the window, if any earlier record in the window is damaged, or if
+    the header is not that of a log of the hashtype.
+    """
+    path_to_log = os.path.join(u_path, base_name)
+    with open(path_to_log, 'r+b') as file:
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        head = file.read(binlog.header_len(hashtype))
+        magic = head[:len(binlog.MAGIC)]
+        start = max(0, size - window)
+        file.seek(start)
+        data = file.read()
+        if size == 0:
+            cut = 0
+        elif binlog.is_binary_log(magic):
+            if size < binlog.header_len(hashtype):
+                # header is torn; the rest of recovery can't help here
+                raise UpaxError("%s: binary log header is truncated" %
+                                path_to_log)
+            binlog.decode_header(head, hashtype)
+            cut = _binary_tail_cut(data, start, hashtype)
+        else:
+            if start > 0:
+                # the header lies outside the window; check it here
+                file.seek(0)
+                first = file.readline()
+                if not first.endswith(b'\n') or not _text_line_ok(
+                        first[:-1], True, hashtype):
+                    raise UpaxError("%s: log header is damaged or of "
+                                    "another hash type" % path_to_log)
+            cut = _text_tail_cut(data, start, hashtype)
+
+        dropped = data[cut - start:]
+        q_path = None
+        if dropped:
+            if quarantine:
+                q_path = os.path.join(u_path, '%s.torn.%u' % (
+                    base_name, int(time.time() * 1000)))
+                with open(q_path, 'wb') as q_file:
+                    q_file.write(dropped)
+            file.truncate(cut)
+            file.flush()
+            os.fsync(file.fileno())
+    return RecoveryReport(path_to_log, size, cut, dropped, q_path)
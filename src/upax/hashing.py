@@ -0,0 +1,127 @@
+# ~/dev/py/upax/upax/hashing.py
+
+"""
+Incremental content hashing.
+
+xlu's file_sha*hex functions hash a file given its path; the functions
+here hash data as it goes by, so that it can be hashed while being
+copied or decompressed.  HashingReader does the same for data read
+from a stream, and IterReader turns an iterable of bytes into a stream.
+"""
+
+import hashlib
+
+from xlattice import HashTypes
+
+__all__ = ['BLOCK_SIZE', 'new_hash', 'hash_hex', 'stream_hex',
+           'read_fully', 'HashingReader', 'IterReader', ]
+
+# size of the blocks read when hashing or copying a stream
+BLOCK_SIZE = 64 * 1024
+
+
+def new_hash(hashtype):
+    """ Return a new hashlib object for the hash type. """
+    if hashtype == HashTypes.SHA1:
+        return hashlib.sha1()
+    elif hashtype == HashTypes.SHA2:
+        return hashlib.sha256()
+    elif hashtype == HashTypes.SHA3:
+        return hashlib.sha3_256()
+    elif hashtype == HashTypes.BLAKE2B:
+        return hashlib.blake2b(digest_size=32)
+    raise NotImplementedError
+
+
+def hash_hex(data, hashtype):
+    """ Return the content key, as hex, of data (bytes). """
+    sha = new_hash(hashtype)
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def stream_hex(file, hashtype):
+    """
+    Read a binary file-like object to its end, returning the hex
+    content key of what was read.
+    """
+    sha = new_hash(hashtype)
+    while True:
+        block = file.read(BLOCK_SIZE)
+        if not block:
+            break
+        sha.update(block)
+    return sha.hexdigest()
+
+
+def read_fully(file, size):
+    """
+    Read from a binary file-like object until size bytes have been
+    read or the end is reached.
+    """
+    pieces = []
+    have = 0
+    while have < size:
+        block = file.read(size - have)
+        if not block:
+            break
+        pieces.append(block)
+        have += len(block)
+    return b''.join(pieces)
+
+
+class HashingReader(object):
+    """
+    Wraps a binary file-like object, hashing and counting the bytes as
+    they are read.
+    """
+
+    def __init__(self, file, hashtype):
+        self._file = file
+        self._sha = new_hash(hashtype)
+        self._length = 0
+
+    @property
+    def length(self):
+        """ Return the number of bytes read so far. """
+        return self._length
+
+    def hexdigest(self):
+        """ Return the hex content key of what has been read so far. """
+        return self._sha.hexdigest()
+
+    def read(self, size=-1):
+        """ Read and return up to size bytes, or everything if size < 0. """
+        data = self._file.read(size)
+        self._sha.update(data)
+        self._length += len(data)
+        return data
+
+
+class IterReader(object):
+    """
+    Read-only binary file-like object returning head followed by the
+    bytes produced by an iterable.
+    """
+
+    def __init__(self, iterable, head=b''):
+        self._iter = iter(iterable)
+        self._buf = bytes(head)
+
+    def read(self, size=-1):
+        """ Read and return up to size bytes, or everything if size < 0. """
+        pieces = [self._buf]
+        have = len(self._buf)
+        while size < 0 or have < size:
+            try:
+                piece = next(self._iter)
+            except StopIteration:
+                break
+            pieces.append(piece)
+            have += len(piece)
+        data = b''.join(pieces)
+        if size < 0 or size >= len(data):
+            self._buf = b''
+            return data
+        self._buf = data[size:]
+        return data[:size]
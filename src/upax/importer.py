@@ -1,5 +1,6 @@
 # upax/__init__.py
 
+import os
 import re
 try:
     from os.scandir import scandir
@@ -7,7 +8,12 @@ except BaseException:
     from scandir import scandir
 
 from xlattice import HashTypes
+from upax import codec
+from upax.chunker import ChunkedReader, decode_manifest
+from upax.hashing import hash_hex
+from upax.pack import PackStore, PACK_DIR
 from upax.server import BlockingServer
+from upax.walker import load_object
 
 __all__ = ['Importer', ]
 
@@ -89,7 +95,15 @@ class Importer(object):
                     count += 1
                     if self._verbose:
                         print('      ' + entry.path)
-                    (_, actual_hash) = string.put(entry.path, name, src)
+                    if codec.is_manifest_file(entry.path):
+                        # stored in chunks in the source uDir
+                        (_, actual_hash) = self.put_chunked(entry.path, name,
+                                                            src)
+                    elif codec.is_encoded_file(entry.path):
+                        # compressed in the source uDir
+                        (_, actual_hash) = self.put_encoded(entry.path, src)
+                    else:
+                        (_, actual_hash) = string.put(entry.path, name, src)
                     if actual_hash != name:
                         print(
                             "%s has content key %s" %
@@ -100,6 +114,56 @@ class Importer(object):
                 print("not a proper leaf file: " + entry.path)
         self._count += count
 
+    def put_encoded(self, path, src):
+        """
+        Import a file stored compressed in the source uDir, returning
+        (len, hash) where hash is the key of the uncompressed data.
+        """
+        with codec.open_decoded(path) as file:
+            return self._server.put_stream(file, None, src, 'z@' + path)
+
+    def put_chunked(self, path, name, src):
+        """
+        Import a file stored as a chunk manifest in the source uDir,
+        returning (len, hash) where hash is the key of the reassembled
+        data.  The data is streamed, one chunk in memory at a time.
+        """
+        packs = None
+        if os.path.exists(os.path.join(self._src_dir, PACK_DIR)):
+            packs = PackStore(self._src_dir)
+        try:
+            with open(path, 'rb') as file:
+                chunks = decode_manifest(file.read())
+            with ChunkedReader(chunks, lambda key: load_object(
+                    self._src_dir, key, packs)) as reader:
+                return self._server.put_stream(reader, None, src,
+                                               'z@' + path)
+        finally:
+            if packs is not None:
+                packs.close()
+
+    def import_packs(self, pack_dir):
+        """ Import the objects in the pack files of the source uDir. """
+        src = self._pgm_name_and_version
+        packs = PackStore(self._src_dir)
+        try:
+            count = 0
+            for key in packs.keys():
+                data = load_object(self._src_dir, key, packs)
+                actual_hash = hash_hex(data, self._hashtype)
+                if actual_hash != key:
+                    print("%s in %s has content key %s" % (
+                        key, pack_dir, actual_hash))
+                    continue
+                count += 1
+                if self._verbose:
+                    print('      packed ' + key)
+                if not self._server.exists(key):
+                    self._server.put_data(data, key, src, 'z@' + key)
+            self._count += count
+        finally:
+            packs.close()
+
     def import_sub_dir(self, sub_dir):
         """ Import the files in a subdirectory of a content-keyed store. """
         for entry in scandir(sub_dir):
@@ -138,6 +202,9 @@ class Importer(object):
                 if sub_dir == 'L' or sub_dir == 'in' or \
                         sub_dir == 'node_id' or sub_dir == 'tmp':
                     continue
+                if sub_dir == PACK_DIR and entry.is_dir():
+                    self.import_packs(entry.path)
+                    continue
                 ok_ = False
                 if entry.is_dir():
                     if DIR_NAME_RE.match(sub_dir):
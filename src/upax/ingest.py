@@ -0,0 +1,210 @@
+# ~/dev/py/upax/upax/ingest.py
+
+"""
+Ingestion of files dropped into a store's in/ directory.
+
+A producer on the same filesystem writes a file into uDir/in under a
+name beginning with a dot, which the Ingester ignores, and renames it
+when complete.  The Ingester drains in/ in batches: it hashes the files
+in a pool of worker threads, renames each into its slot in uDir (or
+stores it as put() would if it is to be compressed, packed, or
+chunked), and appends the log entries for the whole batch at once.
+Files whose content is already present are deleted; files which cannot
+be ingested are moved to uDir/quarantine.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from upax.ftlog import PATH_RE
+from upax.hashing import stream_hex
+
+__all__ = ['Ingester', 'IngestStats', 'QUARANTINE_DIR', ]
+
+QUARANTINE_DIR = 'quarantine'
+
+# logged as the path of a file whose name can't be logged
+INGESTED_PATH = 'z@__ingested__'
+
+
+class IngestStats(object):
+    """ Counts and timings for an Ingester. """
+
+    def __init__(self):
+        self.queue_depth = 0        # files waiting at the last scan
+        self.batches = 0
+        self.ingested = 0
+        self.duplicates = 0
+        self.quarantined = 0
+        self.bytes_ingested = 0
+        self.total_latency = 0.0    # seconds from arrival to ingestion
+        self.max_latency = 0.0
+        self.last_batch_secs = 0.0
+
+    @property
+    def mean_latency(self):
+        """ Return the mean seconds from arrival in in/ to ingestion. """
+        done = self.ingested + self.duplicates
+        return self.total_latency / done if done else 0.0
+
+    def __str__(self):
+        return ('queue %u, batches %u, ingested %u (%u bytes), '
+                'duplicates %u, quarantined %u, latency mean %.3fs '
+                'max %.3fs' % (
+                    self.queue_depth, self.batches, self.ingested,
+                    self.bytes_ingested, self.duplicates, self.quarantined,
+                    self.mean_latency, self.max_latency))
+
+
+class Ingester(object):
+    """
+    Drains a Server's in/ directory.  If lock is given it is held while
+    the Server is used, so that other threads can share the Server.
+    """
+
+    def __init__(self, server, workers=4, batch_size=256, interval=1.0,
+                 source='upax_ingest', lock=None):
+        self._server = server
+        self._in_path = os.path.join(server.u_path, 'in')
+        self._quarantine_path = os.path.join(server.u_path, QUARANTINE_DIR)
+        self._workers = workers
+        self._batch_size = batch_size
+        self._interval = interval
+        self._source = source
+        self._lock = lock if lock is not None else threading.Lock()
+        self._stats = IngestStats()
+        self._pool = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def stats(self):
+        """ Return the IngestStats. """
+        return self._stats
+
+    @property
+    def in_path(self):
+        """ Return the path to the directory drained. """
+        return self._in_path
+
+    def _waiting(self):
+        """
+        Return a list of (arrival, name) for the complete files in in/,
+        oldest first.  Renaming a file into in/ sets its ctime.
+        """
+        waiting = []
+        for entry in os.scandir(self._in_path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            try:
+                waiting.append((entry.stat().st_ctime, entry.name))
+            except FileNotFoundError:
+                continue
+        waiting.sort()
+        return waiting
+
+    def _hash(self, name):
+        """ Return the content key of a file in in/, or None on failure. """
+        try:
+            with open(os.path.join(self._in_path, name), 'rb') as file:
+                return stream_hex(file, self._server.hashtype)
+        except OSError:
+            return None
+
+    def _quarantine(self, name):
+        os.makedirs(self._quarantine_path, exist_ok=True)
+        dest = os.path.join(self._quarantine_path, name)
+        if os.path.exists(dest):
+            dest += '.%d' % int(time.time() * 1000)
+        try:
+            os.rename(os.path.join(self._in_path, name), dest)
+        except FileNotFoundError:
+            return
+        self._stats.quarantined += 1
+
+    @staticmethod
+    def _logged_path(name):
+        path = 'z@in/' + name
+        if PATH_RE.fullmatch(path):
+            return path
+        return INGESTED_PATH
+
+    def drain_once(self):
+        """
+        Ingest up to batch_size of the files waiting in in/.  Returns the
+        number of files dealt with.
+        """
+        start = time.time()
+        waiting = self._waiting()
+        self._stats.queue_depth = len(waiting)
+        batch = waiting[:self._batch_size]
+        if not batch:
+            return 0
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers)
+        keys = list(self._pool.map(self._hash, [n for (_, n) in batch]))
+
+        items = []
+        arrivals = []
+        for ((arrival, name), key) in zip(batch, keys):
+            if key is None:
+                self._quarantine(name)
+                continue
+            items.append((os.path.join(self._in_path, name), key,
+                          self._logged_path(name)))
+            arrivals.append(arrival)
+        if items:
+            with self._lock:
+                results = self._server.ingest_batch(items, self._source)
+            now = time.time()
+            for (item, result, arrival) in zip(items, results, arrivals):
+                if result is None:
+                    self._quarantine(os.path.basename(item[0]))
+                    continue
+                if result[0] < 0:
+                    self._stats.duplicates += 1
+                else:
+                    self._stats.ingested += 1
+                    self._stats.bytes_ingested += result[0]
+                latency = max(0.0, now - arrival)
+                self._stats.total_latency += latency
+                self._stats.max_latency = max(self._stats.max_latency,
+                                              latency)
+        self._stats.batches += 1
+        self._stats.queue_depth = len(waiting) - len(batch)
+        self._stats.last_batch_secs = time.time() - start
+        return len(batch)
+
+    def drain(self):
+        """ Ingest until in/ is empty.  Returns the number of files. """
+        count = 0
+        while True:
+            done = self.drain_once()
+            if not done:
+                return count
+            count += done
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self.drain_once():
+                self._stopping.wait(self._interval)
+
+    def start(self):
+        """ Start draining in/ in a background thread. """
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='upax-ingest', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread, if any, and the worker pool. """
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
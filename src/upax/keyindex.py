@@ -0,0 +1,322 @@
+# ~/dev/py/upax/upax/keyindex.py
+
+"""
+A sorted index of the keys in a log, shared between processes.
+
+Opening a Server parses the whole of uDir/L into a dict, which takes a
+while for a big log and gives every process its own copy.  A read-only
+Server (see upax.server) uses a KeyIndex instead: the key of each entry
+in L and the byte offset of the entry, sorted by key, in the file
+uDir/L.idx, which is mapped read-only so that every process reading the
+store shares the one copy in the page cache.  A key is found by binary
+search, and its entry read from L at the offset.
+
+L.idx is
+
+    MAGIC           8 bytes
+    digest length   uint8, 20 for SHA1, otherwise 32
+    reserved        7 bytes, zero
+    inode           uint64, of the L indexed
+    covered         uint64, how many bytes of L are indexed
+    count           uint64, number of records
+    records         count of them, each a raw key and a uint64 offset
+
+all little-endian.  Where a key is logged more than once the last entry
+is indexed, as in a Log.
+
+publish_index() writes L.idx under a temporary name and renames it into
+place, so a process never maps a partial index.  KeyIndex.open() maps
+the published index, first publishing one if there is none or if it
+describes another L, such as one convert_log() has since replaced.
+Entries appended to L after the index was written are read from L and
+kept in a dict of their own; refresh() reads any more, and publishes
+the index again once there are more than max_tail of them.  A KeyIndex
+follows the L it opened: if L is replaced, open another.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from xlattice import HashTypes, check_hashtype
+from upax import UpaxError
+from upax import binlog
+from upax.ftlog import LogEntry, parse_entry_line
+
+__all__ = ['KeyIndex', 'publish_index', 'INDEX_NAME', 'MAX_TAIL', ]
+
+INDEX_NAME = 'L.idx'
+MAGIC = b'UPAXIDX\x01'
+
+# entries appended to L since the index was published, beyond which
+# refresh() publishes it again
+MAX_TAIL = 64 * 1024
+
+_HEADER = struct.Struct('<8sB7xQQQ')
+_OFFSET = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')       # of a binary log record's payload
+
+# bytes read at a time when looking for the end of a text entry
+READ_AHEAD = 1024
+
+
+def _scan(path_to_log, hashtype, start=0):
+    """
+    Return (entries, end), where entries is a list of (offset, entry)
+    for the complete entries in the log file from byte offset start,
+    and end is the offset just past the last of them.  An offset of
+    zero means the start of the file, whose header is skipped.
+    """
+    found = []
+    with open(path_to_log, 'rb') as file:
+        binary = binlog.is_binary_log(file.read(len(binlog.MAGIC)))
+        if binary and start == 0:
+            start = binlog.header_len(hashtype)
+        file.seek(start)
+        data = file.read()
+    if binary:
+        end = 0
+        for (tstamp, key, node_id, src, path, rec_end) in \
+                binlog.decode_records(data, hashtype, 0, partial_ok=True):
+            found.append((start + end,
+                          LogEntry(tstamp, key, node_id, src, path)))
+            end = rec_end
+        return (found, start + end)
+    offset = 0
+    if start == 0:
+        offset = data.find(b'\n') + 1  # first line describes prev log
+        if offset == 0:
+            return (found, 0)
+    while True:
+        newline = data.find(b'\n', offset)
+        if newline < 0:
+            break                       # EOF or an incomplete line
+        entry = parse_entry_line(data[offset:newline].decode('utf-8'),
+                                 hashtype)
+        if entry is not None:
+            found.append((start + offset, entry))
+        offset = newline + 1
+    return (found, start + offset)
+
+
+def publish_index(u_path, hashtype=HashTypes.SHA2, base_name='L'):
+    """
+    Index the keys in uDir's log, writing the index to uDir/L.idx.
+    Returns the number of keys indexed.
+    """
+    check_hashtype(hashtype)
+    path_to_log = os.path.join(u_path, base_name)
+    inode = os.stat(path_to_log).st_ino
+    (found, covered) = _scan(path_to_log, hashtype)
+    latest = {}
+    for (offset, entry) in found:
+        latest[bytes.fromhex(entry.key)] = offset
+    path = os.path.join(u_path, base_name + '.idx')
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, binlog.digest_len(hashtype), inode,
+                                covered, len(latest)))
+        file.write(b''.join(raw + _OFFSET.pack(latest[raw])
+                            for raw in sorted(latest)))
+    os.replace(tmp_path, path)
+    return len(latest)
+
+
+class KeyIndex(object):
+    """
+    Finds the entries of a log by key through the index of it published
+    in uDir.  Use KeyIndex.open() rather than constructing one.
+    """
+
+    def __init__(self, u_path, hashtype=HashTypes.SHA2, base_name='L',
+                 max_tail=MAX_TAIL):
+        check_hashtype(hashtype)
+        self._u_path = u_path
+        self._hashtype = hashtype
+        self._base_name = base_name
+        self._max_tail = max_tail
+        self.path_to_log = os.path.join(u_path, base_name)
+        self._lock = threading.Lock()
+        self._log_fd = os.open(self.path_to_log, os.O_RDONLY)
+        self._binary = binlog.is_binary_log(
+            os.pread(self._log_fd, len(binlog.MAGIC), 0))
+        self._map = None
+        self._count = 0
+        self._covered = 0
+        self._tail = {}             # key => entry appended since
+        self._end = 0               # offset in L after the tail
+
+    @classmethod
+    def open(cls, u_path, hashtype=HashTypes.SHA2, base_name='L',
+             max_tail=MAX_TAIL):
+        """
+        Return a KeyIndex mapping the index published in uDir, after
+        publishing it if it is missing or stale.
+        """
+        index = cls(u_path, hashtype, base_name, max_tail)
+        try:
+            if not index._attach():
+                publish_index(u_path, hashtype, base_name)
+                if not index._attach():
+                    raise UpaxError("cannot attach to the index of %s" %
+                                    index.path_to_log)
+            index.refresh()
+        except BaseException:
+            index.close()
+            raise
+        return index
+
+    @property
+    def path(self):
+        """ Return the path to the index file. """
+        return os.path.join(self._u_path, self._base_name + '.idx')
+
+    @property
+    def hashtype(self):
+        """ Return the type of SHA hash used. """
+        return self._hashtype
+
+    @property
+    def covered(self):
+        """ Return how many bytes of the log the mapped index covers. """
+        return self._covered
+
+    def _attach(self):
+        """
+        Map the published index, returning False if there is none or
+        it does not describe the log opened.
+        """
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        with file:
+            head = file.read(_HEADER.size)
+            if len(head) < _HEADER.size:
+                return False
+            (magic, d_len, inode, covered, count) = _HEADER.unpack(head)
+            stat = os.fstat(self._log_fd)
+            rec_len = d_len + _OFFSET.size
+            if magic != MAGIC or \
+                    d_len != binlog.digest_len(self._hashtype) or \
+                    inode != stat.st_ino or covered > stat.st_size or \
+                    os.fstat(file.fileno()).st_size != \
+                    _HEADER.size + count * rec_len:
+                return False
+            new_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        old_map = self._map
+        self._map = new_map
+        self._d_len = d_len
+        self._rec_len = rec_len
+        self._count = count
+        self._covered = covered
+        self._tail = {}
+        self._end = covered
+        if old_map is not None:
+            old_map.close()
+        return True
+
+    def _read_tail(self):
+        """ Read entries appended to the log, returning how many. """
+        (found, self._end) = _scan(self.path_to_log, self._hashtype,
+                                   self._end)
+        for (_, entry) in found:
+            self._tail[entry.key] = entry
+        return len(found)
+
+    def refresh(self):
+        """
+        Read the entries appended to the log since last looked at,
+        returning how many there were.
+        """
+        with self._lock:
+            count = self._read_tail()
+            if len(self._tail) > self._max_tail:
+                publish_index(self._u_path, self._hashtype, self._base_name)
+                if self._attach():
+                    self._read_tail()
+            return count
+
+    def _find(self, raw):
+        """ Return the offset in the log of the raw key's entry, or None. """
+        (lo_, hi_) = (0, self._count)
+        d_len = self._d_len
+        rec_len = self._rec_len
+        base = _HEADER.size
+        while lo_ < hi_:
+            mid = (lo_ + hi_) // 2
+            pos = base + mid * rec_len
+            found = self._map[pos:pos + d_len]
+            if found < raw:
+                lo_ = mid + 1
+            elif found > raw:
+                hi_ = mid
+            else:
+                return _OFFSET.unpack_from(self._map, pos + d_len)[0]
+        return None
+
+    def _read_entry(self, offset):
+        """ Return the LogEntry at the offset in the log. """
+        if self._binary:
+            (p_len,) = _LENGTH.unpack(os.pread(self._log_fd, _LENGTH.size,
+                                               offset))
+            data = os.pread(self._log_fd, p_len + binlog.RECORD_OVERHEAD,
+                            offset)
+            (tstamp, key, node_id, src, path, _) = next(
+                binlog.decode_records(data, self._hashtype, 0))
+            return LogEntry(tstamp, key, node_id, src, path)
+        data = b''
+        size = READ_AHEAD
+        while b'\n' not in data:
+            data = os.pread(self._log_fd, size, offset)
+            if len(data) < size:
+                break
+            size *= 2
+        line = data.split(b'\n', 1)[0]
+        return parse_entry_line(line.decode('utf-8'), self._hashtype)
+
+    def get_entry(self, key):
+        """ Return the latest LogEntry for the key, or None. """
+        with self._lock:
+            entry = self._tail.get(key)
+            if entry is not None:
+                return entry
+            try:
+                raw = bytes.fromhex(key)
+            except ValueError:
+                return None
+            offset = self._find(raw)
+        if offset is None:
+            return None
+        return self._read_entry(offset)
+
+    def __contains__(self, key):
+        """ Return whether the key is in the log. """
+        with self._lock:
+            if key in self._tail:
+                return True
+            try:
+                return self._find(bytes.fromhex(key)) is not None
+            except ValueError:
+                return False
+
+    def __len__(self):
+        """
+        Return the number of distinct keys indexed; unlike a Log's, this
+        does not count a key logged twice twice.
+        """
+        with self._lock:
+            return self._count + sum(1 for key in self._tail
+                                     if self._find(bytes.fromhex(key))
+                                     is None)
+
+    def close(self):
+        """ Unmap the index and close the log. """
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._log_fd is not None:
+                os.close(self._log_fd)
+                self._log_fd = None
@@ -0,0 +1,73 @@
+# ~/dev/py/upax/upax/locking.py
+
+"""
+Short-held locks letting several processes write to one uDir.
+
+Data files are placed in uDir by renaming complete files from uDir/tmp,
+which needs no lock: rename is atomic, and two writers placing the same
+key place the same bytes.  What must be serialized is appending to
+shared files, the log and the pack files, and a FileLock is held just
+long enough to do that.
+"""
+
+import fcntl
+import os
+import threading
+
+__all__ = ['FileLock', 'append_lock', ]
+
+
+class FileLock(object):
+    """
+    An exclusive advisory lock on a lock file, excluding other processes
+    (by flock) and other threads (by a threading lock).  It may be taken
+    again by the thread holding it.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    @property
+    def path(self):
+        """ Return the path to the lock file. """
+        return self._path
+
+    def acquire(self):
+        """ Take the lock, waiting for it if necessary. """
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        """ Release the lock. """
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def append_lock(u_path, base_name='L'):
+    """ Return the FileLock serializing appends to the log in uDir. """
+    return FileLock(os.path.join(u_path, base_name + '.lock'))
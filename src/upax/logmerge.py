@@ -0,0 +1,243 @@
+# ~/dev/py/upax/upax/logmerge.py
+
+"""
+Per-writer log files, and merging them into the canonical Log.
+
+A Server opened with per_writer_log=True does not append to uDir/L.
+Each writer process instead appends, without taking any lock, to a log
+of its own in uDir, named
+
+    L.NODE_ID.PID
+
+in the ftlog text format.  The log of the store is L together with all
+of the writer logs.  merged_log() combines them for readers while the
+writers carry on; compact_logs() folds into L the writer logs of
+processes which have exited, and removes them.
+
+Entries are merged in timestamp order, ties being broken by key,
+node_id, src and path, so that the result does not depend on the order
+in which the files are read.  Every entry already in L is kept.  Where
+the writer logs log the same key with the same node_id, src and path
+more than once, as when two writers race to store the same data, only
+the first entry is kept, and an entry L already holds, as it does if
+compacting was interrupted, is not added again.
+"""
+
+import heapq
+import os
+import re
+
+from xlattice import HashTypes, check_hashtype
+from upax.ftlog import (BoundLog, FileReader, Log, LogFollower, Reader,
+                        LOG_FORMAT_TEXT, recover_tail)
+from upax.locking import append_lock
+
+__all__ = ['WriterLog',
+           'compact_logs', 'merge_entries', 'merged_log',
+           'writer_log_name', 'writer_logs', ]
+
+
+def writer_log_name(node_id, pid=None, base_name='L'):
+    """ Return the name of the log of the writer process pid. """
+    if pid is None:
+        pid = os.getpid()
+    return '%s.%s.%u' % (base_name, node_id, pid)
+
+
+def writer_logs(u_path, base_name='L'):
+    """ Return a sorted list of (name, pid) of the writer logs in uDir. """
+    pat = re.compile(r'^%s\.([0-9a-f]{40}|[0-9a-f]{64})\.(\d+)$' %
+                     re.escape(base_name))
+    found = []
+    for name in os.listdir(u_path):
+        match = pat.match(name)
+        if match:
+            found.append((name, int(match.group(2))))
+    found.sort()
+    return found
+
+
+def _merge_key(entry):
+    return (entry.timestamp, entry.key, entry.node_id, entry.src, entry.path)
+
+
+def merge_entries(*streams, main=()):
+    """
+    Merge lists of LogEntries into one list in canonical order.  The
+    entries of main, those of L, are all kept; duplicates among those
+    of the other streams, the writer logs, are dropped.
+    """
+    in_main = set(_merge_key(entry) for entry in main)
+    added = []
+    seen = set()
+    for entry in heapq.merge(*[sorted(s, key=_merge_key) for s in streams],
+                             key=_merge_key):
+        ident = (entry.key, entry.node_id, entry.src, entry.path)
+        if ident not in seen:
+            seen.add(ident)
+            if _merge_key(entry) not in in_main:
+                added.append(entry)
+    return list(heapq.merge(sorted(main, key=_merge_key), added,
+                            key=_merge_key))
+
+
+class _MergedReader(Reader):
+    """ Supplies a Log with a header and a list of entries. """
+
+    def __init__(self, header, entries, hashtype):
+        super().__init__([], hashtype)
+        self._header = header
+        self._merged = entries
+
+    def read(self):
+        index = dict()
+        for entry in self._merged:
+            index[entry.key] = entry
+        (timestamp, prev_hash, prev_master) = self._header
+        return (timestamp, prev_hash, prev_master, self._merged, index)
+
+
+def _read_main(u_path, hashtype, base_name, lock):
+    """
+    Return (header, entries, log_format) for the shared log, reading it
+    under the append lock.
+    """
+    path = os.path.join(u_path, base_name)
+    with lock:
+        if os.path.exists(path):
+            reader = FileReader(u_path, hashtype, base_name)
+        else:
+            reader = Reader([], hashtype)
+        (timestamp, prev_hash, prev_master, entries, _) = reader.read()
+    return ((timestamp, prev_hash, prev_master), entries, reader.log_format)
+
+
+def _read_writer_log(u_path, name, hashtype):
+    """
+    Return the complete entries in a writer log; a line still being
+    written is left out.
+    """
+    return LogFollower(os.path.join(u_path, name), hashtype, 0,
+                       LOG_FORMAT_TEXT).poll()
+
+
+def merged_log(u_path, hashtype=HashTypes.SHA2, base_name='L', lock=None):
+    """
+    Return a Log holding the entries of L and of every writer log in
+    uDir, merged.  This may be called while writers are appending.  The
+    append lock on L is taken briefly; lock is that FileLock, if the
+    caller already holds it.
+    """
+    check_hashtype(hashtype)
+    if lock is None:
+        lock = append_lock(u_path, base_name)
+    (header, entries, _) = _read_main(u_path, hashtype, base_name, lock)
+    streams = [_read_writer_log(u_path, name, hashtype)
+               for (name, _) in writer_logs(u_path, base_name)]
+    return Log(_MergedReader(header,
+                             merge_entries(*streams, main=entries),
+                             hashtype),
+               hashtype)
+
+
+def _running(pid):
+    """ Return whether a process with this pid may still be running. """
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def compact_logs(u_path, hashtype=HashTypes.SHA2, base_name='L'):
+    """
+    Merge into L the writer logs of processes no longer running, then
+    remove them.  L keeps its format.  Returns the number of writer
+    logs removed.
+
+    L is replaced holding its append lock, and Servers appending to L
+    open the new file before appending again.  Servers writing their own
+    logs may run, and their logs are left alone.
+    """
+    check_hashtype(hashtype)
+    path = os.path.join(u_path, base_name)
+    lock = append_lock(u_path, base_name)
+    with lock:
+        done = [name for (name, pid) in writer_logs(u_path, base_name)
+                if not _running(pid)]
+        if not done:
+            return 0
+        (header, entries, log_format) = _read_main(u_path, hashtype,
+                                                   base_name, lock)
+        streams = [_read_writer_log(u_path, name, hashtype)
+                   for name in done]
+        log = Log(_MergedReader(header,
+                                merge_entries(*streams, main=entries),
+                                hashtype),
+                  hashtype)
+        tmp_path = path + '.compact'
+        with open(tmp_path, 'wb') as file:
+            log.write_to(file, log_format=log_format)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        # if we die here the entries are in L and in the writer logs,
+        # and the next merge does not add them to L again
+        for name in done:
+            os.remove(os.path.join(u_path, name))
+    return len(done)
+
+
+class WriterLog(BoundLog):
+    """
+    The log of a Server with a log file of its own.  In memory it holds
+    the merged log of the store as it was when opened, plus whatever
+    has been added since; new entries are appended only to the writer's
+    own file, so no lock is needed.  lock is the append lock on L, if
+    the caller already holds it.
+    """
+
+    def __init__(self, u_path, hashtype, node_id, base_name='L',
+                 lock=None):
+        check_hashtype(hashtype)
+        name = writer_log_name(node_id, base_name=base_name)
+        path_to_log = os.path.join(u_path, name)
+        self._recovery = None
+        if os.path.exists(path_to_log):
+            # left by an earlier process with the same pid
+            self._recovery = recover_tail(u_path, hashtype, name)
+        else:
+            with open(path_to_log, 'w') as file:
+                Log(Reader([], hashtype), hashtype).write_to(file)
+        merged = merged_log(u_path, hashtype, base_name, lock)
+
+        # the file is this writer's alone and not a serialization of the
+        # merged Log, so BoundLog's constructor, which writes one, is
+        # not used
+        Log.__init__(self, _MergedReader(
+            (merged.timestamp, merged.prev_hash, merged.prev_master),
+            merged.entries, hashtype), hashtype)
+        self._log_format = LOG_FORMAT_TEXT
+        self._lock = None
+        self.u_path = u_path
+        self.base_name = name
+        self.path_to_log = path_to_log
+        self.fd_ = open(path_to_log, 'a')
+        self.is_open = True
+
+    @property
+    def recovery(self):
+        """
+        Return the RecoveryReport for the writer's file if it existed
+        when opened, or None.
+        """
+        return self._recovery
+
+    def _append(self, record, flush=False, entries=None):
+        """ Write to the end of the file, flushing for merged readers. """
+        self.fd_.write(record)
+        self.fd_.flush()
@@ -0,0 +1,293 @@
+# ~/dev/py/upax/upax/merkle.py
+
+"""
+Merkle summaries of a log, and anti-entropy synchronization of two
+logs by comparing them.
+
+A LogSummary buckets a Log's entries by the first `depth` hex digits of
+their keys, giving a tree in which every interior node has 16 children.
+The hash of a bucket is the XOR of the SHA256 digests of its entries'
+text lines, so it does not depend on the order in which entries were
+added; the hash of an interior node is the SHA256 digest of its
+children's hashes, or all zeroes if every child is empty.  The summary
+follows the Log as it grows: refresh() hashes only the entries added
+since the last call, and rehashes only the nodes above them.
+
+sync_log() compares a local summary with a peer's, a level at a time,
+over a ZClient (see upax.zserver).  Only buckets whose hashes differ are
+descended into, and only the entries one side lacks are exchanged, so
+the traffic is proportional to the difference between the logs rather
+than to their size.  Logs which already agree cost a single request.
+
+A KeySummary is the same tree over a set of content keys, and
+differing_buckets() compares two such trees held locally; upax.mirror
+uses them to find the objects one store lacks.
+"""
+
+import hashlib
+from bisect import insort
+
+from upax import UpaxError
+
+__all__ = ['PrefixTree', 'LogSummary', 'KeySummary', 'differing_buckets',
+           'sync_log', 'DEPTH', 'FANOUT', 'EMPTY', ]
+
+HEX_DIGITS = '0123456789abcdef'
+FANOUT = len(HEX_DIGITS)
+
+# levels of buckets below the root; 16**3 buckets suit logs of up to a
+# few hundred thousand entries
+DEPTH = 3
+MAX_DEPTH = 8
+
+DIGEST_LEN = hashlib.sha256().digest_size
+EMPTY = bytes(DIGEST_LEN)
+
+
+def _digest(entry):
+    """ Return the digest of the entry's text line. """
+    return hashlib.sha256(str(entry).encode('utf-8')).digest()
+
+
+class PrefixTree(object):
+    """
+    A Merkle tree over items bucketed by the first depth hex digits of
+    their keys.  Subclasses decide what the items are and what digest
+    stands for each.
+    """
+
+    def __init__(self, depth=DEPTH):
+        if not 1 <= depth <= MAX_DEPTH:
+            raise UpaxError("summary depth must be from 1 to %u" %
+                            MAX_DEPTH)
+        self._depth = depth
+        self._buckets = {}          # prefix => {digest: item}
+        self._sums = {}             # prefix => XOR of digests, as int
+        self._cache = {}            # interior prefix => hash
+
+    @property
+    def depth(self):
+        """ Return the length of the key prefixes naming buckets. """
+        return self._depth
+
+    @property
+    def root(self):
+        """ Return the hash of the whole tree. """
+        return self.node_hash('')
+
+    def __len__(self):
+        """ Return the number of items summarized. """
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def _insert(self, key, digest, item):
+        """ Add an item, returning False if its digest was present. """
+        prefix = key[:self._depth]
+        bucket = self._buckets.setdefault(prefix, {})
+        if digest in bucket:
+            return False
+        bucket[digest] = item
+        self._toggle(prefix, digest)
+        return True
+
+    def _remove(self, key, digest):
+        """ Remove an item, returning False if its digest was absent. """
+        prefix = key[:self._depth]
+        bucket = self._buckets.get(prefix)
+        if bucket is None or digest not in bucket:
+            return False
+        del bucket[digest]
+        self._toggle(prefix, digest)
+        return True
+
+    def _toggle(self, prefix, digest):
+        self._sums[prefix] = self._sums.get(prefix, 0) ^ \
+            int.from_bytes(digest, 'big')
+        for ndx in range(self._depth):
+            self._cache.pop(prefix[:ndx], None)
+
+    def _has(self, key, digest):
+        bucket = self._buckets.get(key[:self._depth])
+        return bucket is not None and digest in bucket
+
+    def _items(self, prefix):
+        self.check_prefix(prefix)
+        if len(prefix) != self._depth:
+            raise UpaxError("'%s' does not name a bucket" % prefix)
+        return self._buckets.get(prefix, {}).values()
+
+    def check_prefix(self, prefix):
+        """ Raise UpaxError unless prefix names a node of the tree. """
+        if len(prefix) > self._depth or \
+                prefix.strip(HEX_DIGITS) != '':
+            raise UpaxError("not a valid summary prefix: '%s'" %
+                            prefix[:80])
+
+    def node_hash(self, prefix):
+        """ Return the hash of the node named by the key prefix. """
+        self.check_prefix(prefix)
+        if len(prefix) == self._depth:
+            return self._sums.get(prefix, 0).to_bytes(DIGEST_LEN, 'big')
+        hash_ = self._cache.get(prefix)
+        if hash_ is None:
+            children = self.children(prefix)
+            if children.count(EMPTY) == FANOUT:
+                hash_ = EMPTY
+            else:
+                hash_ = hashlib.sha256(b''.join(children)).digest()
+            self._cache[prefix] = hash_
+        return hash_
+
+    def children(self, prefix):
+        """ Return a list of the hashes of an interior node's children. """
+        self.check_prefix(prefix)
+        if len(prefix) == self._depth:
+            raise UpaxError("bucket '%s' has no children" % prefix)
+        return [self.node_hash(prefix + digit) for digit in HEX_DIGITS]
+
+
+class LogSummary(PrefixTree):
+    """ A Merkle tree over the entries of a Log, bucketed by key prefix. """
+
+    def __init__(self, log, depth=DEPTH):
+        super(LogSummary, self).__init__(depth)
+        self._log = log
+        self._seq = 0               # entries of the Log summarized
+        self.refresh()
+
+    def __contains__(self, entry):
+        """ Return whether an entry with the same text is summarized. """
+        return self._has(entry.key, _digest(entry))
+
+    def refresh(self):
+        """
+        Summarize the entries added to the Log since the last refresh,
+        returning the number which were new.
+        """
+        count = 0
+        for entry in self._log.entries_from(self._seq):
+            self._seq += 1
+            if self._insert(entry.key, _digest(entry), entry):
+                count += 1
+        return count
+
+    def entries(self, prefix):
+        """
+        Return a list of the entries in the bucket named by prefix, in
+        timestamp order.
+        """
+        entries = []
+        for entry in self._items(prefix):
+            insort(entries, (entry.timestamp, str(entry), entry))
+        return [entry for (_, _, entry) in entries]
+
+
+class KeySummary(PrefixTree):
+    """
+    A Merkle tree over a set of content keys.  The keys are themselves
+    digests, so each stands for itself in its bucket's hash.
+    """
+
+    def __init__(self, keys=(), depth=DEPTH):
+        super(KeySummary, self).__init__(depth)
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return self._has(key, bytes.fromhex(key))
+
+    def add(self, key):
+        """ Add a key, returning False if it was already present. """
+        return self._insert(key, bytes.fromhex(key), key)
+
+    def discard(self, key):
+        """ Remove a key, returning False if it was absent. """
+        return self._remove(key, bytes.fromhex(key))
+
+    def keys(self, prefix):
+        """ Return a sorted list of the keys in the bucket named by prefix. """
+        return sorted(self._items(prefix))
+
+
+def _descend(summary, children, fetch):
+    """
+    Return a list of the buckets in which summary differs from another
+    tree of the same depth, whose root has the child hashes children.
+    fetch(prefixes) returns a list of the other tree's child hashes for
+    each of the interior nodes named, and is called once per level.
+    """
+    level = [('', children)]
+    while level:
+        below = []
+        for (prefix, other) in level:
+            mine = summary.children(prefix)
+            for (digit, o_hash, m_hash) in zip(HEX_DIGITS, other, mine):
+                if o_hash != m_hash:
+                    below.append(prefix + digit)
+        if not below or len(below[0]) == summary.depth:
+            return below
+        level = list(zip(below, fetch(below)))
+    return []
+
+
+def differing_buckets(first, second):
+    """
+    Return a sorted list of the prefixes of the buckets in which two
+    summaries of the same depth differ.
+    """
+    if first.depth != second.depth:
+        raise UpaxError("can't compare summaries of depths %u and %u" % (
+            first.depth, second.depth))
+    if first.root == second.root:
+        return []
+    return _descend(first, second.children(''),
+                    lambda prefixes: [second.children(p) for p in prefixes])
+
+
+def _add_entries(log, entries):
+    """ Add the entries to the log, in timestamp order. """
+    items = [(e.timestamp, e.key, e.node_id, e.src, e.path)
+             for e in sorted(entries, key=lambda e: e.timestamp)]
+    if not items:
+        return
+    if hasattr(log, 'add_entries'):
+        log.add_entries(items)          # a BoundLog: written at once
+    else:
+        for item in items:
+            log.add_entry(*item)
+
+
+def sync_log(log, client, summary=None, push=True):
+    """
+    Bring log and the log of the peer which client (a ZClient) reaches
+    into agreement: entries the peer has and log lacks are added to log,
+    keeping their timestamps, nodeIDs, sources and paths, and if push is
+    True entries log has and the peer lacks are sent to it.  summary,
+    if given, is a LogSummary of log, which is kept current.  Returns
+    (pulled, pushed), the numbers of entries added on either side.
+    """
+    if summary is None:
+        summary = LogSummary(log)
+    else:
+        summary.refresh()
+    (depth, root, children) = client.tree('')
+    if depth != summary.depth:
+        raise UpaxError("peer summarizes its log at depth %u, not %u" % (
+            depth, summary.depth))
+    if root == summary.root:
+        return (0, 0)
+
+    buckets = _descend(
+        summary, children,
+        lambda prefixes: [kids for (_, _, kids) in client.trees(prefixes)])
+    pulled = []
+    pushed = []
+    for (prefix, remote) in zip(buckets, client.bucket_entries(buckets)):
+        lines = set(str(entry) for entry in remote)
+        pulled.extend(e for e in remote if e not in summary)
+        pushed.extend(e for e in summary.entries(prefix)
+                      if str(e) not in lines)
+    _add_entries(log, pulled)
+    summary.refresh()
+    if push and pushed:
+        client.add_entries(pushed)
+    return (len(pulled), len(pushed) if push else 0)
@@ -0,0 +1,245 @@
+# ~/dev/py/upax/upax/mirror.py
+
+"""
+Mirroring one content-keyed store into another.
+
+Rather than diffing the full key lists of the two stores, a Mirror
+summarizes each store's keys as a KeySummary (see upax.merkle) and
+compares the trees, looking at the keys themselves only in the buckets
+whose hashes differ.  When the stores are nearly identical almost every
+bucket agrees, and the work of finding the difference is a walk of each
+store plus a comparison of a few thousand bucket hashes.
+
+The objects the destination lacks are then copied by a pool of worker
+threads.  Each reads an object as it is stored, checks it against its
+key, and stores it in the destination with the source's log entry
+unchanged; the chunks of chunked data are copied before their manifest.
+
+The keys still to be copied are written to uDir/mirror.pending in the
+destination before copying begins, and each key copied is appended to
+uDir/mirror.done.  A mirror which is interrupted resumes from these
+without summarizing the stores again; they are removed once every key
+has been copied.
+"""
+
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from xlattice import HashTypes
+from upax import UpaxError
+from upax.chunker import CHUNK_PATH, decode_manifest
+from upax.codec import decode, is_manifest
+from upax.ftlog import LogEntry
+from upax.hashing import hash_hex
+from upax.merkle import KeySummary, differing_buckets, DEPTH
+
+__all__ = ['Mirror', 'store_keys', 'PENDING_NAME', 'DONE_NAME', ]
+
+PENDING_NAME = 'mirror.pending'
+DONE_NAME = 'mirror.done'
+
+# logged as the path of an object the source has no log entry for
+MIRRORED_PATH = 'z@__mirrored__'
+
+KEY_1_RE = re.compile('^[0-9a-f]{40}$')
+KEY_256_RE = re.compile('^[0-9a-f]{64}$')
+
+
+def _loose_keys(u_path, key_re):
+    """ Yield the keys of the objects stored in files in a uDir. """
+    for top in sorted(os.listdir(u_path)):
+        top_path = os.path.join(u_path, top)
+        if len(top) != 2 or not os.path.isdir(top_path):
+            continue
+        for mid in sorted(os.listdir(top_path)):
+            mid_path = os.path.join(top_path, mid)
+            if len(mid) != 2 or not os.path.isdir(mid_path):
+                continue
+            for entry in os.scandir(mid_path):
+                if key_re.match(entry.name) and entry.is_file():
+                    yield entry.name
+
+
+def store_keys(server):
+    """
+    Yield the key of every object a Server holds: in files of their
+    own, in either tier, and in packs.
+    """
+    if server.hashtype == HashTypes.SHA1:
+        key_re = KEY_1_RE
+    else:
+        key_re = KEY_256_RE
+    for key in _loose_keys(server.u_path, key_re):
+        yield key
+    if server.tiers is not None:
+        for key in _loose_keys(server.tiers.cold_path, key_re):
+            yield key
+    if server.packs is not None:
+        for key in server.packs.keys():
+            yield key
+
+
+class Mirror(object):
+    """
+    Copies into dest, a Server, the objects held by src, another Server,
+    which dest lacks.  If locks are given they are held while the
+    Servers are used, so that other threads can share them.
+    """
+
+    def __init__(self, src, dest, workers=4, depth=DEPTH,
+                 source='upax_mirror', src_lock=None, dest_lock=None):
+        if src.hashtype != dest.hashtype:
+            raise UpaxError("can't mirror between stores using different "
+                            "hash types")
+        if workers < 1:
+            raise UpaxError("a Mirror needs at least one worker")
+        self._src = src
+        self._dest = dest
+        self._workers = workers
+        self._depth = depth
+        self._source = source
+        self._src_lock = src_lock if src_lock is not None \
+            else threading.Lock()
+        self._dest_lock = dest_lock if dest_lock is not None \
+            else threading.Lock()
+        self._pending_path = os.path.join(dest.u_path, PENDING_NAME)
+        self._done_path = os.path.join(dest.u_path, DONE_NAME)
+        self._done_lock = threading.Lock()
+        self._copied = 0
+        self._failed = {}           # key => error message
+
+    @property
+    def copied(self):
+        """ Return the number of objects copied by the last run(). """
+        return self._copied
+
+    @property
+    def failed(self):
+        """
+        Return a map key => error message for the objects the last run()
+        could not copy.
+        """
+        return dict(self._failed)
+
+    def summaries(self):
+        """ Return KeySummaries of the source's and destination's keys. """
+        with self._src_lock:
+            src = KeySummary(store_keys(self._src), self._depth)
+        with self._dest_lock:
+            dest = KeySummary(store_keys(self._dest), self._depth)
+        return (src, dest)
+
+    def missing(self):
+        """
+        Return a sorted list of the keys the source holds and the
+        destination lacks.
+        """
+        (src, dest) = self.summaries()
+        keys = []
+        for prefix in differing_buckets(src, dest):
+            keys.extend(key for key in src.keys(prefix) if key not in dest)
+        return keys
+
+    # -- the journal -------------------------------------------------
+
+    def _resume(self):
+        """
+        Return the keys left pending by an interrupted mirror from the
+        same source, or None.
+        """
+        if not os.path.exists(self._pending_path):
+            return None
+        with open(self._pending_path, 'r') as file:
+            lines = file.read().split('\n')
+        if lines[0] != os.path.abspath(self._src.u_path):
+            return None
+        done = set()
+        if os.path.exists(self._done_path):
+            with open(self._done_path, 'r') as file:
+                done = set(file.read().split())
+        return [key for key in lines[1:] if key and key not in done]
+
+    def _plan(self, keys):
+        """ Record the keys to be copied, replacing any earlier record. """
+        tmp_path = self._pending_path + '.new'
+        with open(tmp_path, 'w') as file:
+            file.write(os.path.abspath(self._src.u_path) + '\n')
+            for key in keys:
+                file.write(key + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(self._done_path):
+            os.remove(self._done_path)
+        os.replace(tmp_path, self._pending_path)
+
+    def _note_done(self, key):
+        with self._done_lock:
+            with open(self._done_path, 'a') as file:
+                file.write(key + '\n')
+
+    def _finish(self):
+        for path in (self._pending_path, self._done_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # -- copying -----------------------------------------------------
+
+    def _copy(self, key, path=MIRRORED_PATH):
+        """
+        Copy an object, and first any chunks of it, unless the
+        destination already holds it.  Returns the number of objects
+        copied.
+        """
+        with self._dest_lock:
+            if self._dest.exists(key):
+                return 0
+        with self._src_lock:
+            blob = self._src.get_stored(key)
+            entry = self._src.log.get_entry(key)
+        if blob is None:
+            raise UpaxError("%s is no longer in the source" % key)
+        copied = 0
+        if is_manifest(blob):
+            for (c_key, _) in decode_manifest(blob):
+                copied += self._copy(c_key, CHUNK_PATH)
+        elif hash_hex(decode(blob), self._src.hashtype) != key:
+            raise UpaxError("%s does not hold what its key says" % key)
+        if entry is None:
+            entry = LogEntry(time.time(), key, self._src.node_id,
+                             self._source, path)
+        with self._dest_lock:
+            if self._dest.exists(key):
+                return copied
+            self._dest.put_stored(blob, entry)
+        return copied + 1
+
+    def _copy_pending(self, key):
+        try:
+            copied = self._copy(key)
+        except (UpaxError, OSError) as exc:
+            self._failed[key] = str(exc)
+            return 0
+        self._note_done(key)
+        return copied
+
+    def run(self):
+        """
+        Copy the objects the destination lacks, resuming an interrupted
+        mirror if there is one.  Returns the number copied.  Keys which
+        could not be copied are left pending for the next run; see
+        failed.
+        """
+        self._copied = 0
+        self._failed = {}
+        keys = self._resume()
+        if keys is None:
+            keys = self.missing()
+            self._plan(keys)
+        with ThreadPoolExecutor(self._workers) as pool:
+            self._copied = sum(pool.map(self._copy_pending, keys))
+        if not self._failed:
+            self._finish()
+        return self._copied
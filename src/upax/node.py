@@ -7,12 +7,20 @@ of the Java implementation such as the use of text strings to store
 byte arrays.  So get it right here and then backport to XLattice.
 """
 
+import os
 import re
+import threading
 
-from Crypto.PublicKey import RSA            # new 2016-11-10
 from upax import UpaxError
 from xlattice import HashTypes
 
+# The RSA module is imported only when key material is needed: the log
+# and the Server import this module for the nodeID checkers, and
+# importing the crypto library slows the start of every tool using them.
+
+KEY_NAME = 'node.key'       # the node's RSA key, in its uDir
+KEY_BITS = 2048
+
 NODE_ID_1_PAT = '^[A-Z0-9]{40}$'
 NODE_ID_1_RE = re.compile(NODE_ID_1_PAT, re.I)
 NODE_ID_2_PAT = '^[A-Z0-9]{64}$'
@@ -52,6 +60,10 @@ class Peer(object):
     Specifications for an XLattice Peer, a Node with which we communicate.
 
     The node_ndx used here is a 32-bit value unique to the object.
+
+    A Peer serving its store over ZeroMQ (see upax.zserver) is reached at
+    its endpoints through a ConnectionPool (see upax.pool), opened on
+    first use and shared by every thread talking to the Peer.
     """
 
     def __init__(self, node_id, rsa_pub_key, hash_type=HashTypes.SHA2):
@@ -62,7 +74,8 @@ class Peer(object):
         self._rsa_pub_key = rsa_pub_key
         self._node_ndx = None       # will be uInt32
 
-        self._cnx = []              # list of open connections
+        self._pool = None           # ConnectionPool, opened on first use
+        self._endpoints = []        # list of ZeroMQ endpoints
         self._ip_addr = []          # list of ipV4 addresses (uInt32)
         self._fqdn = []             # list of fully qualified domain names
 
@@ -98,14 +111,44 @@ class Peer(object):
 
     @property
     def cnx(self):
+        """ Return a list of the open connections to the Peer. """
+        if self._pool is None:
+            return []
+        return self._pool.connections
+
+    @property
+    def endpoints(self):
+        """
+        Return a reference to the list of ZeroMQ endpoints at which the
+        Peer may be reached, such as 'tcp://host:port'.  Changes made
+        after the pool is opened have no effect on it.
         """
-        Return a reference to a list.
+        return self._endpoints
 
-        This is quite insecure and nothing prevents users from adding arbitrary
-        trash to a list. A better API would expose get/set/del methods,
-        with validation on the getters.
+    def open_pool(self, **kwargs):
+        """
+        Return the ConnectionPool to the Peer, opening it with the
+        keyword arguments (see upax.pool.ConnectionPool) if it is not
+        already open.
         """
-        return self._cnx
+        if self._pool is None:
+            # imported here: upax.pool depends on modules which import
+            # this one
+            from upax.pool import ConnectionPool
+            self._pool = ConnectionPool(self._endpoints, self._hash_type,
+                                        **kwargs)
+        return self._pool
+
+    @property
+    def pool(self):
+        """ Return the ConnectionPool to the Peer, opening it if need be. """
+        return self.open_pool()
+
+    def close(self):
+        """ Close any connections to the Peer. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
     @property
     def ip_addr(self):
@@ -118,25 +161,82 @@ class Peer(object):
         return self._fqdn
 
 
+def load_rsa_key(u_path, bits=KEY_BITS):
+    """
+    Return the RSA key kept in uDir/node.key, generating and saving one
+    first if there is none.  If several processes race to do so, the
+    first key saved is the one they all use.
+    """
+    from Crypto.PublicKey import RSA
+    path = os.path.join(u_path, KEY_NAME)
+    if not os.path.exists(path):
+        key = RSA.generate(bits)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        fd_ = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd_, 'wb') as file:
+            file.write(key.export_key('PEM'))
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.link(tmp_path, path)     # fails if another got there first
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, 'rb') as file:
+        return RSA.import_key(file.read())
+
+
 class UpaxNode(Peer):
-    """ Upax version of the XLattice node. """
+    """
+    Upax version of the XLattice node.
 
-    def __init__(self, node_id=None, rsa_priv_key=None):
+    If no RSA key is given, one is obtained when first needed: from
+    uDir/node.key if u_path is given, generating and saving it there
+    the first time, and otherwise freshly generated.
+    """
 
-        if rsa_priv_key is None:
-            rsa_priv_key = RSA.generate(2048)   # XXX RSA key fixed at 2K bits
+    def __init__(self, node_id=None, rsa_priv_key=None, u_path=None):
+        super(UpaxNode, self).__init__(node_id, None)
         self._rsa_priv_key = rsa_priv_key
-        # extract the public key from the private key
-        rsa_pub_key = rsa_priv_key.publickey()
-        super(UpaxNode, self).__init__(node_id, rsa_pub_key)
+        self._u_path = u_path
+        self._key_lock = threading.Lock()
 
-        self._peers = {}    # nodeNdx (uInt32)    => Peer object
+        # imported here: upax.registry imports this module
+        from upax.registry import PeerRegistry
+        self._peers = PeerRegistry(self._hash_type)
         self._l_hashes = {}  # nodeNdx + timestamp => LHash object
         self._l_map = {}    # L hash + timestamp  => text (bytearray)
 
+    @property
+    def rsa_priv_key(self):
+        """
+        Return the node's RSA key, which signs its log (see
+        upax.signing), loading or generating it if need be.
+        """
+        with self._key_lock:
+            if self._rsa_priv_key is None:
+                if self._u_path is not None:
+                    self._rsa_priv_key = load_rsa_key(self._u_path)
+                else:
+                    from Crypto.PublicKey import RSA
+                    self._rsa_priv_key = RSA.generate(KEY_BITS)
+            return self._rsa_priv_key
+
+    @property
+    def rsa_pub_key(self):
+        """ Return the public part of the node's RSA key. """
+        if self._rsa_pub_key is None:
+            # extract the public key from the private key
+            self._rsa_pub_key = self.rsa_priv_key.publickey()
+        return self._rsa_pub_key
+
     @property
     def peers(self):
-        """ Return a map of Peers. """
+        """
+        Return the PeerRegistry of the Peers known to the node, which
+        finds them by nodeID, node index, address or name.
+        """
         return self._peers
 
     @property
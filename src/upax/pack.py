@@ -0,0 +1,313 @@
+# ~/dev/py/upax/upax/pack.py
+
+"""
+Pack files for small objects.
+
+Rather than giving every small object a file of its own in uDir, a
+PackStore appends them to a few large files in uDir/packs/, named
+pack-000000, pack-000001, and so on.  An append-only text index,
+uDir/packs/index, locates each object.  Each line of the index is either
+
+    KEY PACK_NO OFFSET LENGTH
+
+recording that the object with that content key is stored in that pack
+file at that offset, or
+
+    KEY -
+
+recording that the object has been deleted.  Later lines override
+earlier ones.  Data is always written to the pack before the index
+line describing it, so a crash can at worst leave unreferenced bytes in
+a pack; repack() discards these along with deleted objects.
+
+What is stored is whatever the caller hands over, so data compressed by
+upax.codec stays compressed in the pack.
+
+Several processes may share the packs.  Appends to the packs and the
+index are made holding a lock on uDir/packs/lock, and before answering
+any question about a key each PackStore reads the index lines written
+by others since it last looked, so that it sees their deletions as
+well as their additions.  When nothing has been written this costs a
+stat() of the index.  repack() needs the packs to itself.
+"""
+
+import os
+import re
+
+from upax import UpaxError
+from upax.codec import decode, is_manifest
+from upax.hashing import hash_hex
+from upax.locking import FileLock
+
+__all__ = ['PackStore', 'PACK_DIR', 'MAX_PACK_SIZE', 'PACK_THRESHOLD', ]
+
+PACK_DIR = 'packs'
+INDEX_NAME = 'index'
+LOCK_NAME = 'lock'
+
+# a new pack file is started when the current one reaches this size
+MAX_PACK_SIZE = 64 * 1024 * 1024
+
+# by default objects smaller than this are packed
+PACK_THRESHOLD = 4096
+
+PACK_NAME_RE = re.compile(r'^pack-(\d{6})$')
+INDEX_LINE_RE = re.compile(
+    r'^([0-9a-f]{40}|[0-9a-f]{64}) (?:(\d+) (\d+) (\d+)|-)$')
+
+
+class PackStore(object):
+    """ The pack files and their index in a uDir. """
+
+    def __init__(self, u_path, max_pack_size=MAX_PACK_SIZE):
+        self._u_path = u_path
+        self._pack_path = os.path.join(u_path, PACK_DIR)
+        self._index_path = os.path.join(self._pack_path, INDEX_NAME)
+        self._max_pack_size = max_pack_size
+        if not os.path.exists(self._pack_path):
+            os.makedirs(self._pack_path)
+
+        self._lock = FileLock(os.path.join(self._pack_path, LOCK_NAME))
+
+        self._index = {}            # key => (pack_no, offset, length)
+        self._index_offset = 0      # how much of the index has been read
+        self._readers = {}          # pack_no => file open for reading
+        with self._lock:
+            self._load_index()
+
+        pack_nos = self._pack_nos()
+        self._pack_no = pack_nos[-1] if pack_nos else 0
+        self._writer = None         # current pack, open for appending
+        self._index_fd = open(self._index_path, 'a')
+
+    def _pack_nos(self):
+        """ Return a sorted list of the numbers of existing pack files. """
+        nos = []
+        for name in os.listdir(self._pack_path):
+            match = PACK_NAME_RE.match(name)
+            if match:
+                nos.append(int(match.group(1)))
+        return sorted(nos)
+
+    def _pack_file(self, pack_no):
+        return os.path.join(self._pack_path, 'pack-%06u' % pack_no)
+
+    def _load_index(self):
+        """
+        Read the index.  An unterminated last line, left by a crash,
+        is truncated away.
+        """
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, 'rb') as file:
+            data = file.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            with open(self._index_path, 'r+b') as file:
+                file.truncate(end)
+        self._apply_index_lines(data[:end])
+        self._index_offset = end
+
+    def _apply_index_lines(self, data):
+        for line in str(data, 'utf-8').splitlines():
+            match = INDEX_LINE_RE.match(line)
+            if not match:
+                raise UpaxError("bad line in pack index: '%s'" % line)
+            key = match.group(1)
+            if match.group(2) is None:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (int(match.group(2)),
+                                    int(match.group(3)),
+                                    int(match.group(4)))
+
+    def _catch_up(self):
+        """ Read any complete index lines written since we last looked. """
+        try:
+            size = os.path.getsize(self._index_path)
+        except FileNotFoundError:
+            return
+        if size <= self._index_offset:
+            return
+        with open(self._index_path, 'rb') as file:
+            file.seek(self._index_offset)
+            data = file.read(size - self._index_offset)
+        end = data.rfind(b'\n') + 1
+        self._apply_index_lines(data[:end])
+        self._index_offset += end
+
+    @property
+    def pack_path(self):
+        """ Return the path to the directory holding the pack files. """
+        return self._pack_path
+
+    def __contains__(self, key):
+        return self.exists(key)
+
+    def __len__(self):
+        self._catch_up()
+        return len(self._index)
+
+    def exists(self, key):
+        """ Return whether the key is in a pack. """
+        self._catch_up()
+        return key in self._index
+
+    def keys(self):
+        """ Return a sorted list of the keys of the packed objects. """
+        self._catch_up()
+        return sorted(self._index.keys())
+
+    def length(self, key):
+        """ Return the stored length of a packed object, or None. """
+        self._catch_up()
+        where = self._index.get(key)
+        if where is None:
+            return None
+        return where[2]
+
+    def put(self, key, data):
+        """
+        Append data to the current pack under the key.  Return False if
+        the key was already present, in which case nothing is written.
+        """
+        with self._lock:
+            self._catch_up()
+            if key in self._index:
+                return False
+            writer = self._current_writer()
+            offset = writer.tell()
+            writer.write(data)
+            writer.flush()
+            self._index_fd.write('%s %u %u %u\n' % (
+                key, self._pack_no, offset, len(data)))
+            self._index_fd.flush()
+            self._index[key] = (self._pack_no, offset, len(data))
+        return True
+
+    def _current_writer(self):
+        """
+        Return the pack being appended to, positioned at its end, starting
+        a new one if it is full.  Other processes may have appended to it
+        or started a newer one.
+        """
+        while True:
+            if self._writer is None:
+                self._writer = open(self._pack_file(self._pack_no), 'ab')
+            self._writer.seek(0, os.SEEK_END)
+            if self._writer.tell() < self._max_pack_size:
+                return self._writer
+            self._writer.close()
+            self._writer = None
+            self._pack_no = max(self._pack_no + 1, self._pack_nos()[-1])
+
+    def get(self, key):
+        """ Return the data stored under the key, or None. """
+        self._catch_up()
+        where = self._index.get(key)
+        if where is None:
+            return None
+        (pack_no, offset, length) = where
+        if self._writer is not None and pack_no == self._pack_no:
+            self._writer.flush()
+        reader = self._readers.get(pack_no)
+        if reader is None:
+            reader = open(self._pack_file(pack_no), 'rb')
+            self._readers[pack_no] = reader
+        data = os.pread(reader.fileno(), length, offset)
+        if len(data) != length:
+            raise UpaxError("pack %u is truncated" % pack_no)
+        return data
+
+    def delete(self, key):
+        """
+        Forget the object stored under the key.  Its space is recovered
+        by the next repack().  Return whether the key was present.
+        """
+        with self._lock:
+            self._catch_up()
+            if key not in self._index:
+                return False
+            self._index_fd.write('%s -\n' % key)
+            self._index_fd.flush()
+            del self._index[key]
+        return True
+
+    def verify(self, hashtype):
+        """
+        Return a list of the keys whose (decoded) data does not hash to
+        the key.  Chunk manifests are skipped, as their chunks need not
+        be packed; UWalker checks them.
+        """
+        bad = []
+        for key in self.keys():
+            blob = self.get(key)
+            if is_manifest(blob):
+                continue
+            if hash_hex(decode(blob), hashtype) != key:
+                bad.append(key)
+        return bad
+
+    def repack(self):
+        """
+        Copy all live objects into new pack files, in key order, write a
+        new index to match, and delete the old packs.  This discards
+        deleted objects and any bytes orphaned by a crash.  Return the
+        number of bytes recovered.
+        """
+        with self._lock:
+            return self._repack()
+
+    def _repack(self):
+        old_nos = self._pack_nos()
+        old_size = sum(os.path.getsize(self._pack_file(no))
+                       for no in old_nos)
+        first_new = old_nos[-1] + 1 if old_nos else 0
+
+        new_index = {}
+        pack_no = first_new
+        new_pack = open(self._pack_file(pack_no), 'wb')
+        try:
+            for key in self.keys():
+                if new_pack.tell() >= self._max_pack_size:
+                    new_pack.close()
+                    pack_no += 1
+                    new_pack = open(self._pack_file(pack_no), 'wb')
+                data = self.get(key)
+                new_index[key] = (pack_no, new_pack.tell(), len(data))
+                new_pack.write(data)
+            new_pack.flush()
+            os.fsync(new_pack.fileno())
+        finally:
+            new_pack.close()
+
+        tmp_index = self._index_path + '.new'
+        with open(tmp_index, 'w') as file:
+            for key in sorted(new_index):
+                file.write('%s %u %u %u\n' % ((key,) + new_index[key]))
+            file.flush()
+            os.fsync(file.fileno())
+        self.close()
+        os.replace(tmp_index, self._index_path)
+        for no in old_nos:
+            os.remove(self._pack_file(no))
+
+        self._index = new_index
+        self._index_offset = os.path.getsize(self._index_path)
+        self._pack_no = pack_no
+        self._index_fd = open(self._index_path, 'a')
+        new_size = sum(os.path.getsize(self._pack_file(no))
+                       for no in self._pack_nos())
+        return old_size - new_size
+
+    def close(self):
+        """ Close any open files. """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        if self._index_fd is not None:
+            self._index_fd.close()
+            self._index_fd = None
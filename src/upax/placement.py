@@ -0,0 +1,174 @@
+# ~/dev/py/upax/upax/placement.py
+
+"""
+Placing objects on several peers of a ring of U stores.
+
+A Placement maps each content key to `replicas` peers by consistent
+hashing over the nodeIDs of the Peers a node knows (see upax.registry
+and upax.ring).  A put is sent to all of them at once and succeeds as
+soon as `write_quorum` have stored the object, a majority of them by
+default; the others finish in the background.  A get goes to the
+local store if it is one of the replicas, and otherwise to the replica
+with the fewest of this Placement's requests in flight, trying the
+others in turn if it fails or does not have the object.
+
+Remote peers are reached through their ConnectionPools (see upax.pool).
+The node itself may be one of its own Peers, in which case the Server
+given for it is used directly.
+"""
+
+import threading
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+                                wait as wait_for)
+
+from upax import UpaxError
+from upax.hashing import hash_hex
+from upax.zserver import POSTED_PATH
+
+__all__ = ['Placement', 'REPLICAS', ]
+
+REPLICAS = 3
+
+
+class Placement(object):
+    """
+    Places objects on the Peers of node, an UpaxNode, keeping replicas
+    copies of each.  server, if given, is the node's own Server, and
+    lock is held while it is used.
+    """
+
+    def __init__(self, node, replicas=REPLICAS, write_quorum=None,
+                 server=None, lock=None, workers=None):
+        if replicas < 1:
+            raise UpaxError("need at least one replica")
+        if write_quorum is None:
+            write_quorum = replicas // 2 + 1
+        if not 1 <= write_quorum <= replicas:
+            raise UpaxError("write quorum must be from 1 to %u" % replicas)
+        self._node = node
+        self._replicas = replicas
+        self._write_quorum = write_quorum
+        self._server = server
+        self._lock = lock if lock is not None else threading.Lock()
+        self._workers = workers if workers is not None else 4 * replicas
+        self._pool = None
+        self._load_lock = threading.Lock()
+        self._in_flight = {}        # raw nodeID => requests outstanding
+
+    @property
+    def replicas(self):
+        """ Return the number of copies kept of each object. """
+        return self._replicas
+
+    @property
+    def write_quorum(self):
+        """ Return the number of replicas a put must reach. """
+        return self._write_quorum
+
+    def in_flight(self, peer):
+        """ Return the number of requests outstanding to the Peer. """
+        with self._load_lock:
+            return self._in_flight.get(bytes(peer.node_id), 0)
+
+    def place(self, key):
+        """ Return a list of the Peers which should hold the key. """
+        return self._node.peers.replicas(key, self._replicas)
+
+    def _is_local(self, peer):
+        return self._server is not None and \
+            bytes(peer.node_id) == bytes(self._node.node_id)
+
+    def _call(self, peer, local, remote):
+        """
+        Call local with the node's Server if the Peer is the node, and
+        otherwise remote with the Peer's ConnectionPool, counting the
+        request as in flight meanwhile.
+        """
+        node_id = bytes(peer.node_id)
+        with self._load_lock:
+            self._in_flight[node_id] = self._in_flight.get(node_id, 0) + 1
+        try:
+            if self._is_local(peer):
+                with self._lock:
+                    return local(self._server)
+            return remote(peer.pool)
+        finally:
+            with self._load_lock:
+                self._in_flight[node_id] -= 1
+
+    def put_data(self, data, key=None, source='', logged_path=POSTED_PATH):
+        """
+        Store data on its replicas, returning (len, hash) once the write
+        quorum has.  Raises UpaxError if too few of them can.
+        """
+        if key is None:
+            key = hash_hex(data, self._node.hash_type)
+        peers = self.place(key)
+        if len(peers) < self._write_quorum:
+            raise UpaxError("only %u peers for a write quorum of %u" % (
+                len(peers), self._write_quorum))
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers)
+        pending = {self._pool.submit(
+            self._call, peer,
+            lambda server: server.put_data(data, key, source, logged_path),
+            lambda pool: pool.put_data(data, key, source, logged_path))
+                   for peer in peers}
+        stored = []
+        errors = []
+        while pending:
+            (done, pending) = wait_for(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    stored.append(future.result())
+                except UpaxError as exc:
+                    errors.append(str(exc))
+            if len(stored) >= self._write_quorum:
+                return stored[0]
+            if len(peers) - len(errors) < self._write_quorum:
+                break
+        raise UpaxError("%s stored on %u of %u peers: %s" % (
+            key, len(stored), len(peers), '; '.join(errors)))
+
+    def _read_order(self, key):
+        """
+        Return the key's replicas in the order to read from them: the
+        node itself first, then the least loaded.
+        """
+        peers = self.place(key)
+        with self._load_lock:
+            return sorted(peers, key=lambda p: (
+                not self._is_local(p),
+                self._in_flight.get(bytes(p.node_id), 0)))
+
+    def get(self, key):
+        """ Return the data stored under the key, or None. """
+        for peer in self._read_order(key):
+            try:
+                data = self._call(peer, lambda server: server.get(key),
+                                  lambda pool: pool.get(key))
+            except UpaxError:
+                continue
+            if data is not None:
+                return data
+        return None
+
+    def exists(self, key):
+        """ Return whether any of the key's replicas holds it. """
+        for peer in self._read_order(key):
+            try:
+                if self._call(peer, lambda server: server.exists(key),
+                              lambda pool: pool.exists(key)):
+                    return True
+            except UpaxError:
+                continue
+        return False
+
+    def close(self):
+        """
+        Wait for puts still under way, then shut down the worker pool.
+        The Peers' connections are left open.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
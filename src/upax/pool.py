@@ -0,0 +1,339 @@
+# ~/dev/py/upax/upax/pool.py
+
+"""
+Pooled connections to a peer.
+
+A ConnectionPool keeps up to max_connections ZClients (see upax.zserver)
+connected to a peer's endpoints and shares them among the threads making
+requests, so that fetching many objects pays for connecting once rather
+than once per object.  Requests from different threads are multiplexed
+over each connection, each carrying its own number, and at most
+max_in_flight requests are outstanding to the peer at any time.
+
+A connection which fails a request, or does not answer it within
+timeout seconds, is closed and replaced, and the request is tried once
+more on another connection; every request in the protocol may safely
+be repeated.  A connection idle for health_interval seconds is pinged
+before it is used again.
+"""
+
+import threading
+import time
+from collections import deque
+
+from xlattice import HashTypes, check_hashtype
+from upax import UpaxError
+from upax.zserver import (ZClient, OP_EXISTS, OP_GET, OP_PING, OP_PUT,
+                          STATUS_ERROR, STATUS_NOT_FOUND, STATUS_OK,
+                          POSTED_PATH)
+
+__all__ = ['Connection', 'ConnectionPool',
+           'MAX_CONNECTIONS', 'MAX_IN_FLIGHT', 'TIMEOUT',
+           'HEALTH_INTERVAL', ]
+
+MAX_CONNECTIONS = 4
+MAX_IN_FLIGHT = 64
+TIMEOUT = 10.0              # seconds to wait for a reply
+HEALTH_INTERVAL = 30.0      # seconds idle before a connection is pinged
+PING_TIMEOUT = 1.0
+
+# milliseconds a waiting thread holds a connection to receive replies;
+# other threads may send on it in between
+RECV_MS = 5
+
+
+class Connection(object):
+    """ A ZClient shared by several threads. """
+
+    def __init__(self, endpoint, hashtype, context=None, timeout=TIMEOUT):
+        self._endpoint = endpoint
+        self._client = ZClient(endpoint, hashtype, context, timeout)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last_used = time.time()
+        self._healthy = True
+
+    @property
+    def endpoint(self):
+        """ Return the endpoint connected to. """
+        return self._endpoint
+
+    @property
+    def in_flight(self):
+        """ Return the number of requests awaiting replies. """
+        return self._in_flight
+
+    @property
+    def healthy(self):
+        """ Return False once a request has failed on the connection. """
+        return self._healthy
+
+    @property
+    def last_used(self):
+        """ Return the time a request was last sent or answered. """
+        return self._last_used
+
+    def submit(self, op, *args):
+        """ Send a request, returning its number. """
+        with self._lock:
+            if not self._healthy:
+                raise UpaxError("connection to %s has failed" %
+                                self._endpoint)
+            try:
+                req_id = self._client.submit(op, *args)
+            except UpaxError:
+                self._healthy = False
+                raise
+            self._in_flight += 1
+            self._last_used = time.time()
+        return req_id
+
+    def wait(self, req_id, timeout=TIMEOUT):
+        """
+        Wait up to timeout seconds for the reply to the request,
+        returning (status, payload).  Whichever waiting thread holds the
+        connection receives the replies for all of them.  On timeout the
+        connection is marked unhealthy and UpaxError raised.
+        """
+        deadline = time.time() + timeout
+        try:
+            while True:
+                with self._lock:
+                    if self._client.done(req_id):
+                        self._last_used = time.time()
+                        return self._client.result(req_id)
+                    if not self._healthy:
+                        raise UpaxError("connection to %s has failed" %
+                                        self._endpoint)
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._healthy = False
+                        raise UpaxError("no reply from %s in %.1fs" % (
+                            self._endpoint, timeout))
+                    self._client.receive(min(RECV_MS, remaining * 1000))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def ping(self, timeout=PING_TIMEOUT):
+        """ Return whether the peer answers a ping within timeout. """
+        try:
+            (status, _) = self.wait(self.submit(OP_PING), timeout)
+        except UpaxError:
+            return False
+        return status == STATUS_OK
+
+    def close(self):
+        """ Close the connection; requests awaiting replies fail. """
+        with self._lock:
+            self._healthy = False
+            self._client.close()
+
+
+class ConnectionPool(object):
+    """
+    Connections to a peer reachable at any of endpoints, shared among
+    threads.  Connections are opened as they are needed, in turn to each
+    endpoint.
+    """
+
+    def __init__(self, endpoints, hashtype=HashTypes.SHA2,
+                 max_connections=MAX_CONNECTIONS,
+                 max_in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT,
+                 health_interval=HEALTH_INTERVAL, context=None):
+        check_hashtype(hashtype)
+        if not endpoints:
+            raise UpaxError("a ConnectionPool needs at least one endpoint")
+        if max_connections < 1 or max_in_flight < 1:
+            raise UpaxError("connection and in-flight limits must be "
+                            "positive")
+        self._endpoints = list(endpoints)
+        self._hashtype = hashtype
+        self._max_connections = max_connections
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._health_interval = health_interval
+        self._context = context
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._connections = []
+        self._next_endpoint = 0
+        self._connects = 0
+        self._failures = 0
+
+    @property
+    def endpoints(self):
+        """ Return a copy of the list of endpoints. """
+        return list(self._endpoints)
+
+    @property
+    def connections(self):
+        """ Return a list of the open connections. """
+        with self._lock:
+            return list(self._connections)
+
+    @property
+    def max_in_flight(self):
+        """ Return the most requests which may be outstanding at once. """
+        return self._max_in_flight
+
+    @property
+    def connects(self):
+        """ Return the number of connections opened so far. """
+        return self._connects
+
+    @property
+    def failures(self):
+        """ Return the number of connections dropped after failing. """
+        return self._failures
+
+    # -- connections -------------------------------------------------
+
+    def _drop(self, conn):
+        """ Close and forget a connection.  Called holding the lock. """
+        if conn in self._connections:
+            self._connections.remove(conn)
+            self._failures += 1
+        conn.close()
+
+    def _choose(self):
+        """
+        Return the healthy connection with the fewest requests in
+        flight, opening another if all are busy and there is room.
+        """
+        while True:
+            with self._lock:
+                for conn in [c for c in self._connections if not c.healthy]:
+                    self._drop(conn)
+                conn = None
+                if self._connections:
+                    conn = min(self._connections, key=lambda c: c.in_flight)
+                if conn is None or (conn.in_flight and len(
+                        self._connections) < self._max_connections):
+                    endpoint = self._endpoints[self._next_endpoint]
+                    self._next_endpoint = (self._next_endpoint + 1) % len(
+                        self._endpoints)
+                    conn = Connection(endpoint, self._hashtype,
+                                      self._context, self._timeout)
+                    self._connections.append(conn)
+                    self._connects += 1
+                    return conn
+            if conn.in_flight or \
+                    time.time() - conn.last_used < self._health_interval:
+                return conn
+            if conn.ping():
+                return conn
+            with self._lock:
+                self._drop(conn)
+
+    def check(self):
+        """
+        Ping every idle connection, dropping those which do not answer.
+        Returns the number still open.
+        """
+        for conn in self.connections:
+            if not conn.in_flight and not conn.ping():
+                with self._lock:
+                    self._drop(conn)
+        with self._lock:
+            return len(self._connections)
+
+    # -- requests ----------------------------------------------------
+
+    def request(self, op, *args):
+        """
+        Send a request to the peer and wait for the reply, returning
+        (status, payload) as ZClient.result() does.
+        """
+        with self._slots:
+            try:
+                conn = self._choose()
+                return conn.wait(conn.submit(op, *args), self._timeout)
+            except UpaxError:
+                conn = self._choose()
+                return conn.wait(conn.submit(op, *args), self._timeout)
+
+    @staticmethod
+    def _payload(reply):
+        (status, payload) = reply
+        if status == STATUS_OK:
+            return payload
+        if status == STATUS_NOT_FOUND:
+            return None
+        if status == STATUS_ERROR and payload:
+            raise UpaxError(payload[0].bytes.decode('utf-8'))
+        raise UpaxError("request failed: %s" %
+                        status.decode('ascii', 'replace'))
+
+    def get(self, key):
+        """ Return the data the peer holds under the key, or None. """
+        payload = self._payload(self.request(OP_GET, key.encode('ascii')))
+        return None if payload is None else payload[0].bytes
+
+    def exists(self, key):
+        """ Return whether the peer holds the key. """
+        payload = self._payload(self.request(OP_EXISTS,
+                                             key.encode('ascii')))
+        return payload[0].bytes == b'1'
+
+    def put_data(self, data, key=None, source='', logged_path=POSTED_PATH):
+        """ Store data on the peer, returning (len, hash). """
+        payload = self._payload(self.request(
+            OP_PUT, (key or '').encode('ascii'), source.encode('utf-8'),
+            logged_path.encode('utf-8'), data))
+        return (int(payload[0].bytes), payload[1].bytes.decode('ascii'))
+
+    def get_many(self, keys):
+        """
+        Return a list of the data the peer holds under each of the keys,
+        None where absent.  Requests are spread over the connections
+        with up to max_in_flight outstanding.
+        """
+        results = [None] * len(keys)
+        pending = deque()               # (ndx, connection, req_id)
+
+        def finish():
+            (ndx, conn, req_id) = pending.popleft()
+            try:
+                reply = conn.wait(req_id, self._timeout)
+            except UpaxError:
+                self._slots.release()
+                # retried as a request of its own
+                results[ndx] = self.get(keys[ndx])
+                return
+            self._slots.release()
+            payload = self._payload(reply)
+            results[ndx] = None if payload is None else payload[0].bytes
+
+        try:
+            for (ndx, key) in enumerate(keys):
+                if len(pending) >= self._max_in_flight:
+                    finish()
+                self._slots.acquire()
+                try:
+                    conn = self._choose()
+                    req_id = conn.submit(OP_GET, key.encode('ascii'))
+                except BaseException:
+                    self._slots.release()
+                    raise
+                pending.append((ndx, conn, req_id))
+            while pending:
+                finish()
+        finally:
+            # after an error, collect what is still outstanding
+            while pending:
+                (_, conn, req_id) = pending.popleft()
+                try:
+                    conn.wait(req_id, self._timeout)
+                except UpaxError:
+                    pass
+                finally:
+                    self._slots.release()
+        return results
+
+    def close(self):
+        """ Close every connection. """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -0,0 +1,183 @@
+# ~/dev/py/upax/upax/registry.py
+
+"""
+The set of Peers a node knows, indexed every way they are looked up.
+
+A PeerRegistry finds a Peer by nodeID, by node index, by IPv4 address
+or by domain name in constant time, and refuses a Peer which would
+share any of these with one already registered.  NodeIDs are kept as
+raw bytes, 20 or 32 of them, rather than as hex.  The registry also
+keeps a HashRing (see upax.ring) over its Peers, so that placement
+decisions need not rebuild one.
+
+A Peer's addresses are indexed when it is added; after changing them,
+call update() to index them again.
+"""
+
+import ipaddress
+
+from upax import UpaxError
+from upax.node import check_node_id
+from upax.ring import HashRing
+from xlattice import HashTypes
+
+__all__ = ['PeerRegistry', ]
+
+
+def _raw_id(node_id):
+    """ Return a nodeID, given as bytes or hex, as bytes. """
+    if isinstance(node_id, str):
+        try:
+            return bytes.fromhex(node_id)
+        except ValueError:
+            raise UpaxError("not a hex nodeID: '%s'" % node_id[:80])
+    return bytes(node_id)
+
+
+def _ip(addr):
+    """ Return an IPv4 address, given as an int or dotted, as an int. """
+    try:
+        return int(ipaddress.IPv4Address(addr))
+    except ValueError:
+        raise UpaxError("not an IPv4 address: %s" % str(addr)[:80])
+
+
+class PeerRegistry(object):
+    """ The Peers known to a node, whose nodeIDs suit hashtype. """
+
+    def __init__(self, hashtype=HashTypes.SHA2):
+        self._hashtype = hashtype
+        self._by_id = {}            # raw nodeID => Peer
+        self._by_ndx = {}           # node_ndx => Peer
+        self._by_ip = {}            # IPv4 address as int => Peer
+        self._by_fqdn = {}          # lower-cased name => Peer
+        self._indexed = {}          # raw nodeID => (addresses, names)
+        self._next_ndx = 0
+        self._ring = HashRing()     # members are hex nodeIDs
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        """ Iterate over the Peers in nodeID order. """
+        return iter([self._by_id[raw] for raw in sorted(self._by_id)])
+
+    def __contains__(self, node_id):
+        """ Return whether a Peer has the nodeID, as bytes or hex. """
+        return _raw_id(node_id) in self._by_id
+
+    @property
+    def ids(self):
+        """ Return a sorted list of the raw nodeIDs. """
+        return sorted(self._by_id)
+
+    @property
+    def ring(self):
+        """
+        Return the HashRing over the Peers, whose members are their
+        nodeIDs in hex.  It must not be changed.
+        """
+        return self._ring
+
+    @staticmethod
+    def _addresses(peer):
+        return ([_ip(addr) for addr in peer.ip_addr],
+                [name.lower() for name in peer.fqdn])
+
+    def _check_addresses(self, peer, ips, names):
+        """ Raise UpaxError if another Peer has an address or name. """
+        for addr in ips:
+            if self._by_ip.get(addr, peer) is not peer:
+                raise UpaxError("another peer has address %s" %
+                                ipaddress.IPv4Address(addr))
+        for name in names:
+            if self._by_fqdn.get(name, peer) is not peer:
+                raise UpaxError("another peer has name %s" % name)
+
+    def _index(self, raw, peer, ips, names):
+        for addr in ips:
+            self._by_ip[addr] = peer
+        for name in names:
+            self._by_fqdn[name] = peer
+        self._indexed[raw] = (ips, names)
+
+    def _unindex(self, raw):
+        (ips, names) = self._indexed.pop(raw)
+        for addr in ips:
+            del self._by_ip[addr]
+        for name in names:
+            del self._by_fqdn[name]
+
+    def add(self, peer):
+        """
+        Register a Peer, giving it the next free node index if it has
+        none.  Raises UpaxError if another Peer has its nodeID, node
+        index, an address or a name.
+        """
+        check_node_id(peer.node_id, self._hashtype)
+        raw = _raw_id(peer.node_id)
+        if raw in self._by_id:
+            raise UpaxError("another peer has nodeID %s" % raw.hex())
+        if peer.node_ndx is not None and peer.node_ndx in self._by_ndx:
+            raise UpaxError("another peer has node index %u" %
+                            peer.node_ndx)
+        (ips, names) = self._addresses(peer)
+        self._check_addresses(peer, ips, names)
+        if peer.node_ndx is None:
+            while self._next_ndx in self._by_ndx:
+                self._next_ndx += 1
+            peer.node_ndx = self._next_ndx
+        self._by_id[raw] = peer
+        self._by_ndx[peer.node_ndx] = peer
+        self._index(raw, peer, ips, names)
+        self._ring.add(raw.hex())
+        return peer
+
+    def remove(self, node_id):
+        """ Unregister the Peer with the nodeID, returning it. """
+        raw = _raw_id(node_id)
+        peer = self._by_id.pop(raw, None)
+        if peer is None:
+            raise UpaxError("no peer has nodeID %s" % raw.hex())
+        del self._by_ndx[peer.node_ndx]
+        self._unindex(raw)
+        self._ring.remove(raw.hex())
+        return peer
+
+    def update(self, peer):
+        """
+        Index a registered Peer's addresses and names again.  Raises
+        UpaxError, leaving the old ones indexed, if another Peer has
+        one of them.
+        """
+        raw = _raw_id(peer.node_id)
+        if self._by_id.get(raw) is not peer:
+            raise UpaxError("peer %s is not registered" % raw.hex())
+        (ips, names) = self._addresses(peer)
+        self._check_addresses(peer, ips, names)
+        self._unindex(raw)
+        self._index(raw, peer, ips, names)
+
+    def by_id(self, node_id):
+        """ Return the Peer with the nodeID, as bytes or hex, or None. """
+        return self._by_id.get(_raw_id(node_id))
+
+    def by_ndx(self, node_ndx):
+        """ Return the Peer with the node index, or None. """
+        return self._by_ndx.get(node_ndx)
+
+    def by_ip(self, addr):
+        """ Return the Peer with the IPv4 address, or None. """
+        return self._by_ip.get(_ip(addr))
+
+    def by_fqdn(self, name):
+        """ Return the Peer with the domain name, or None. """
+        return self._by_fqdn.get(name.lower())
+
+    def replicas(self, key, count):
+        """
+        Return a list of up to count Peers for the content key, its
+        owner on the ring first and then its successors.
+        """
+        return [self._by_id[bytes.fromhex(member)]
+                for member in self._ring.lookup_n(key, count)]
@@ -0,0 +1,292 @@
+# ~/dev/py/upax/upax/replicator.py
+
+"""
+Pull replication: a replica following another store's log.
+
+A Replicator reads a source's log a batch of entries at a time from a
+cursor saved in the replica's uDir.  It fetches the objects the entries
+refer to which the local Server lacks, checks them against their keys
+in a pool of worker threads, and stores them as they were stored at the
+source, appending their log entries unchanged (timestamp, nodeID,
+source and path) with a single append per batch.  The cursor is saved
+once a batch has been stored, so a replica which stops resumes with the
+batch it was working on.
+
+Two sources are provided.  A LocalSource follows a store on the same
+machine, tailing its log file with a LogFollower; its cursor is a byte
+offset into the file.  A ZSource follows a node over ZeroMQ (see
+upax.zserver); its cursor is a position in the node's log, and objects
+are fetched with up to `window` requests in flight.
+
+ReplicaStats.lag_entries is the number of entries in the source's log
+not yet applied, and lag_secs how far the timestamp of the last entry
+applied trails the clock while any remain; both are zero once the
+replica has caught up.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from upax.chunker import decode_manifest
+from upax.codec import decode, is_manifest
+from upax.ftlog import LogFollower
+from upax.hashing import hash_hex
+from upax.zserver import WINDOW
+
+__all__ = ['Replicator', 'ReplicaStats', 'LocalSource', 'ZSource',
+           'CURSOR_NAME', ]
+
+CURSOR_NAME = 'replica.cursor'
+
+# entries the scout of a LocalSource reads at a time when counting
+SCOUT_BATCH = 4096
+
+
+class ReplicaStats(object):
+    """ Counts and lag for a Replicator. """
+
+    def __init__(self):
+        self.batches = 0
+        self.applied = 0            # objects stored and logged
+        self.present = 0            # entries for objects already here
+        self.missing = 0            # objects the source no longer has
+        self.rejected = 0           # objects not matching their keys
+        self.last_timestamp = None  # of the last entry applied
+        self.lag_entries = 0
+        self.lag_secs = 0.0
+
+    def __str__(self):
+        return ('batches %u, applied %u, present %u, missing %u, '
+                'rejected %u, lag %u entries %.1fs' % (
+                    self.batches, self.applied, self.present, self.missing,
+                    self.rejected, self.lag_entries, self.lag_secs))
+
+
+class LocalSource(object):
+    """
+    Follows the log of server, a Server on the same machine, reading
+    objects from it.  If lock is given it is held while the Server is
+    used.
+    """
+
+    def __init__(self, server, lock=None):
+        self._server = server
+        self._lock = lock if lock is not None else threading.Lock()
+        self._follower = None
+        self._scout = None          # runs ahead, counting entries
+        self.seek(0)
+
+    @property
+    def position(self):
+        """ Return the byte offset in the log of the next entry. """
+        return self._follower.offset
+
+    def seek(self, position):
+        """ Continue from the byte offset in the log. """
+        path = self._server.log.path_to_log
+        hashtype = self._server.hashtype
+        self._follower = LogFollower(path, hashtype, position)
+        self._scout = LogFollower(path, hashtype, position)
+
+    def poll(self, max_entries):
+        """ Return up to max_entries entries from the log. """
+        return self._follower.poll(max_entries)
+
+    def behind(self):
+        """ Return the number of entries in the log not yet polled. """
+        while self._scout.poll(SCOUT_BATCH):
+            pass
+        return self._scout.seq - self._follower.seq
+
+    def fetch(self, keys):
+        """ Return a list of each key's object as stored, or None. """
+        with self._lock:
+            return [self._server.get_stored(key) for key in keys]
+
+
+class ZSource(object):
+    """
+    Follows the log of the node which client, a ZClient, reaches,
+    fetching objects from it with up to window requests in flight.
+    """
+
+    def __init__(self, client, window=WINDOW):
+        self._client = client
+        self._window = window
+        self._position = 0
+
+    @property
+    def position(self):
+        """ Return the position in the node's log of the next entry. """
+        return self._position
+
+    def seek(self, position):
+        """ Continue from the position in the node's log. """
+        self._position = position
+
+    def poll(self, max_entries):
+        """ Return up to max_entries entries from the log. """
+        (self._position, _, entries) = self._client.log_from(
+            self._position, max_entries)
+        return entries
+
+    def behind(self):
+        """ Return the number of entries in the log not yet polled. """
+        (_, total, _) = self._client.log_from(self._position, 0)
+        return max(0, total - self._position)
+
+    def fetch(self, keys):
+        """ Return a list of each key's object as stored, or None. """
+        return self._client.get_stored_many(keys, self._window)
+
+
+class Replicator(object):
+    """
+    Replicates into server, a Server, the objects in source's log.  If
+    lock is given it is held while the Server is used, so that other
+    threads can share it.
+    """
+
+    def __init__(self, server, source, cursor_path=None, batch_size=256,
+                 workers=4, interval=1.0, lock=None):
+        self._server = server
+        self._source = source
+        if cursor_path is None:
+            cursor_path = os.path.join(server.u_path, CURSOR_NAME)
+        self._cursor_path = cursor_path
+        self._batch_size = batch_size
+        self._workers = workers
+        self._interval = interval
+        self._lock = lock if lock is not None else threading.Lock()
+        self._stats = ReplicaStats()
+        self._pool = None
+        self._thread = None
+        self._stopping = threading.Event()
+        if os.path.exists(cursor_path):
+            with open(cursor_path, 'r') as file:
+                source.seek(int(file.read()))
+
+    @property
+    def stats(self):
+        """ Return the ReplicaStats. """
+        return self._stats
+
+    @property
+    def cursor_path(self):
+        """ Return the path to the file holding the saved cursor. """
+        return self._cursor_path
+
+    def _save_cursor(self):
+        tmp_path = self._cursor_path + '.new'
+        with open(tmp_path, 'w') as file:
+            file.write('%d\n' % self._source.position)
+        os.replace(tmp_path, self._cursor_path)
+
+    def lag(self):
+        """ Bring the lag figures up to date, returning (entries, secs). """
+        stats = self._stats
+        stats.lag_entries = self._source.behind()
+        if stats.lag_entries and stats.last_timestamp is not None:
+            stats.lag_secs = max(0.0, time.time() - stats.last_timestamp)
+        else:
+            stats.lag_secs = 0.0
+        return (stats.lag_entries, stats.lag_secs)
+
+    def _verified(self, item):
+        """ Return whether an object not a manifest matches its key. """
+        (entry, blob) = item
+        return is_manifest(blob) or \
+            hash_hex(decode(blob), self._server.hashtype) == entry.key
+
+    def replicate_once(self):
+        """
+        Replicate up to batch_size entries of the source's log.  Returns
+        the number of entries dealt with.
+        """
+        entries = self._source.poll(self._batch_size)
+        if not entries:
+            self.lag()
+            return 0
+        stats = self._stats
+        wanted = []
+        with self._lock:
+            seen = set()
+            for entry in entries:
+                if entry.key in seen or self._server.exists(entry.key):
+                    stats.present += 1
+                else:
+                    seen.add(entry.key)
+                    wanted.append(entry)
+        fetched = []
+        if wanted:
+            blobs = self._source.fetch([e.key for e in wanted])
+            for (entry, blob) in zip(wanted, blobs):
+                if blob is None:
+                    stats.missing += 1
+                else:
+                    fetched.append((entry, blob))
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers)
+        checks = list(self._pool.map(self._verified, fetched))
+
+        items = []
+        with self._lock:
+            stored = set()
+            for ((entry, blob), good) in zip(fetched, checks):
+                if good and is_manifest(blob):
+                    # the chunks precede their manifest in the log
+                    good = all(c_key in stored or self._server.exists(c_key)
+                               for (c_key, _) in decode_manifest(blob))
+                    if not good:
+                        stats.missing += 1
+                        continue
+                if not good:
+                    stats.rejected += 1
+                    continue
+                items.append((blob, entry))
+                stored.add(entry.key)
+            self._server.put_stored_many(items)
+        self._save_cursor()
+        stats.applied += len(items)
+        stats.batches += 1
+        stats.last_timestamp = entries[-1].timestamp
+        self.lag()
+        return len(entries)
+
+    def replicate(self):
+        """
+        Replicate until the replica has caught up with the source.
+        Returns the number of entries dealt with.
+        """
+        count = 0
+        while True:
+            done = self.replicate_once()
+            if not done:
+                return count
+            count += done
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self.replicate_once():
+                self._stopping.wait(self._interval)
+
+    def start(self):
+        """ Start replicating in a background thread. """
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='upax-replicator',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread, if any, and the worker pool. """
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
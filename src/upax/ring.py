@@ -0,0 +1,120 @@
+# ~/dev/py/upax/upax/ring.py
+
+"""
+Consistent hashing of content keys onto a set of members.
+
+Each member is given VNODES points on a 64-bit ring, placed by hashing
+the member's name.  A content key is already a uniformly distributed
+hash, so its position is simply its first 16 hex digits; it belongs to
+the member owning the first point at or after that position.  Adding or
+removing a member therefore moves only about 1/N of the keys.
+"""
+
+import hashlib
+from bisect import bisect_left, insort
+
+from upax import UpaxError
+
+__all__ = ['HashRing', 'VNODES', ]
+
+# points on the ring per member
+VNODES = 64
+
+
+def _point(member, ndx):
+    digest = hashlib.sha1(('%s#%u' % (member, ndx)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def key_position(key):
+    """ Return the position of a hex content key on the ring. """
+    return int(key[:16], 16)
+
+
+class HashRing(object):
+    """ Maps content keys to members by consistent hashing. """
+
+    def __init__(self, members=(), vnodes=VNODES):
+        if vnodes < 1:
+            raise UpaxError("need at least one point per member")
+        self._vnodes = vnodes
+        self._members = set()
+        self._points = []           # sorted
+        self._owners = {}           # point => member
+        for member in members:
+            self.add(member)
+
+    @property
+    def members(self):
+        """ Return a sorted list of the members. """
+        return sorted(self._members)
+
+    @property
+    def vnodes(self):
+        """ Return the number of points per member. """
+        return self._vnodes
+
+    def __contains__(self, member):
+        return member in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, member):
+        """ Add a member to the ring. """
+        if member in self._members:
+            raise UpaxError("%s is already on the ring" % member)
+        self._members.add(member)
+        for ndx in range(self._vnodes):
+            point = _point(member, ndx)
+            # a collision is vanishingly unlikely; the smaller name wins
+            if point in self._owners:
+                if member < self._owners[point]:
+                    self._owners[point] = member
+                continue
+            self._owners[point] = member
+            insort(self._points, point)
+
+    def remove(self, member):
+        """ Remove a member from the ring. """
+        if member not in self._members:
+            raise UpaxError("%s is not on the ring" % member)
+        self._members.remove(member)
+        self._points = [p for p in self._points
+                        if self._owners[p] != member]
+        self._owners = {p: self._owners[p] for p in self._points}
+        # restore any points lost to a collision with this member
+        for other in self._members:
+            for ndx in range(self._vnodes):
+                point = _point(other, ndx)
+                if point not in self._owners:
+                    self._owners[point] = other
+                    insort(self._points, point)
+
+    def lookup(self, key):
+        """ Return the member owning the content key. """
+        if not self._points:
+            raise UpaxError("the ring is empty")
+        ndx = bisect_left(self._points, key_position(key))
+        if ndx == len(self._points):
+            ndx = 0
+        return self._owners[self._points[ndx]]
+
+    def lookup_n(self, key, count):
+        """
+        Return a list of up to count distinct members for the content
+        key, the owner first and then its successors around the ring.
+        """
+        if not self._points:
+            raise UpaxError("the ring is empty")
+        count = min(count, len(self._members))
+        points = self._points
+        ndx = bisect_left(points, key_position(key))
+        ret = []
+        for step in range(len(points)):
+            member = self._owners[points[(ndx + step) % len(points)]]
+            if member not in ret:
+                ret.append(member)
+                if len(ret) == count:
+                    break
+        return ret
@@ -1,8 +1,11 @@
 # upax/__init__.py
 
 import binascii
+import io
 import time
 import os
+import shutil
+import tempfile
 # try:
 #    from os.scandir import scandir
 # except:
@@ -12,7 +15,20 @@ import rnglib
 from xlattice import HashTypes, check_hashtype
 from xlu import (file_sha1hex, file_sha2hex, file_sha3hex, file_blake2b_hex,
                  DirStruc, UDir)
-from upax.ftlog import BoundLog, FileReader, Reader
+from upax.ftlog import (BoundLog, FileReader, Reader, LOG_FORMAT_TEXT,
+                        recover_tail)
+from upax import codec
+from upax.codec import CODEC_NONE, CODEC_GZIP
+from upax.chunker import (chunk_stream, encode_manifest, decode_manifest,
+                          ChunkedReader, CHUNK_PATH)
+from upax.hashing import (BLOCK_SIZE, hash_hex, read_fully, HashingReader,
+                          IterReader)
+from upax.pack import PackStore, PACK_DIR
+from upax.tiers import TieredStore, Migrator
+from upax.evict import Evictor, POLICY_LRU
+from upax.locking import append_lock
+from upax.logmerge import WriterLog
+from upax.keyindex import KeyIndex
 
 from upax import UpaxError
 
@@ -41,26 +57,143 @@ class Server(object):
 
     All files in uDir should be owned by upax.upax and are (at least
     at this time) world-readable but only owner-writeable.
+
+    If L does not exist it is created in log_format, text by default.
+    An existing L keeps the format it was written in.  Before it is
+    loaded its tail is checked for a record left partly written by a
+    crash; any such record is truncated and quarantined, and the
+    RecoveryReport is available as the `recovery` property.
+
+    If compress is True, or one of the codec.CODEC_* values, data which
+    seems compressible is stored compressed (see upax.codec).  Keys are
+    always those of the uncompressed data and get() always returns the
+    uncompressed data, so compressed and uncompressed files can be
+    mixed freely in the same uDir.
+
+    If pack_threshold is non-zero, data shorter than that many bytes is
+    appended to pack files in uDir/packs/ (see upax.pack) rather than
+    stored in a file of its own.  Packed data is found by exists() and
+    get() whatever pack_threshold is.
+
+    If chunk_threshold is non-zero, data of at least that many bytes is
+    split into content-defined chunks, each stored and logged as an
+    object in its own right, and what is stored under the data's key is
+    a manifest listing the chunks (see upax.chunker).  Files differing
+    by a few bytes then share most of their chunks.  get() and
+    get_stream() reassemble chunked data transparently.
+
+    If cold_path is set, uDir is the fast tier of a tiered store and
+    cold_path, another DIR256x256 uDir, is the capacity tier (see
+    upax.tiers).  New data is stored in uDir; objects are demoted to the
+    capacity tier when uDir holds more than hot_quota bytes of them and
+    promoted back when read repeatedly.  Unless migrate_interval is zero
+    this is done by a background thread every migrate_interval seconds;
+    migrate() does it at once.  exists(), get() and get_stream() look
+    in both tiers.
+
+    If quota is non-zero the store is a cache: whenever it holds more
+    than quota bytes, objects are evicted according to eviction_policy
+    (see upax.evict) until it is back under quota.  Keys pinned with
+    evictor.pin() are never evicted.
+
+    Several Servers, in the same or different processes, may write to
+    one uDir.  Data files are renamed into place from uDir/tmp, which
+    needs no locking; appends to L are serialized by a short-held lock
+    on uDir/L.lock (see upax.locking), and appends to the pack files by
+    one in uDir/packs.  Each Server's in-memory Log holds only what it
+    read when opened and what it has added since.
+
+    If per_writer_log is True the Server appends not to L but to a log
+    file of its own, L.NODE_ID.PID, and needs no lock to do so; its Log
+    is the merge of L and every such file when it was opened (see
+    upax.logmerge).  L is still created if it does not exist.
+
+    If read_only is True the Server only reads: L is not opened for
+    appending, and its log is a KeyIndex (see upax.keyindex) mapping the
+    sorted index of L which the processes reading the store share,
+    rather than a Log of its own.  The index is published first if
+    need be, so a reader starts without parsing L, and log.refresh()
+    picks up entries appended since.  The log offers lookups by key
+    only.  Anything which would change the store raises UpaxError, and
+    the uDir must already exist; compress, chunk_threshold and
+    pack_threshold, which only affect writing, are ignored.
     """
 
-    def __init__(self, u_path, hashtype=HashTypes.SHA2):
+    def __init__(self, u_path, hashtype=HashTypes.SHA2,
+                 log_format=LOG_FORMAT_TEXT, compress=False,
+                 pack_threshold=0, chunk_threshold=0,
+                 cold_path=None, hot_quota=0, migrate_interval=60,
+                 quota=0, eviction_policy=POLICY_LRU,
+                 per_writer_log=False, read_only=False):
 
         check_hashtype(hashtype)
+        if read_only and (quota or per_writer_log):
+            raise UpaxError("a read-only Server can neither evict nor "
+                            "write a log")
         _in_dir_path = os.path.join(u_path, 'in')
         _log_file_path = os.path.join(u_path, 'L')
         _id_file_path = os.path.join(u_path, 'node_id')
         _tmp_dir_path = os.path.join(u_path, 'tmp')
 
         self._hashtype = hashtype
+        self._read_only = read_only
+        if read_only and not os.path.exists(_id_file_path):
+            raise UpaxError("no store to read at %s" % u_path)
         u_dir = UDir.discover(u_path, DirStruc.DIR256x256, hashtype)
 
         self._u_dir = u_dir
         self._u_path = u_path
+        self._tmp_path = _tmp_dir_path
+        if compress is True:
+            self._codec = CODEC_GZIP
+        elif compress:
+            self._codec = compress
+        else:
+            self._codec = CODEC_NONE
+        self._pack_threshold = pack_threshold
+        self._chunk_threshold = chunk_threshold
+        if (pack_threshold and not read_only) or \
+                os.path.exists(os.path.join(u_path, PACK_DIR)):
+            self._packs = PackStore(u_path)
+        else:
+            self._packs = None
+
+        if not read_only:
+            if not os.path.exists(_in_dir_path):
+                os.mkdir(_in_dir_path)
+            if not os.path.exists(_tmp_dir_path):
+                os.mkdir(_tmp_dir_path)
+
+        self._tiers = None
+        self._migrator = None
+        if cold_path is not None:
+            self._tiers = TieredStore(u_dir, cold_path, hashtype, hot_quota)
+            if migrate_interval and not read_only:
+                self._migrator = Migrator(self._tiers, migrate_interval)
+                self._migrator.start()
+        self._per_writer_log = per_writer_log
+        self._append_lock = append_lock(u_path)
+        if read_only:
+            with open(_id_file_path, 'r') as file:
+                self._node_id = file.read()[:-1]
+            self._recovery = None
+            self._log = KeyIndex.open(u_path, hashtype)
+        else:
+            with self._append_lock:
+                self._init_node_id_and_log(_id_file_path, _log_file_path,
+                                           log_format)
 
-        if not os.path.exists(_in_dir_path):
-            os.mkdir(_in_dir_path)
-        if not os.path.exists(_tmp_dir_path):
-            os.mkdir(_tmp_dir_path)
+        self._evictor = None
+        if quota:
+            self._evictor = Evictor(self, quota, eviction_policy)
+
+    def _init_node_id_and_log(self, _id_file_path, _log_file_path,
+                              log_format):
+        """
+        Read or create node_id, then open or create L.  Called holding
+        the append lock, so that concurrent Servers agree.
+        """
+        u_path = self._u_path
         if not os.path.exists(_id_file_path):
             if self._hashtype == HashTypes.SHA1:
                 byte_id = bytearray(20)
@@ -70,19 +203,31 @@ class Server(object):
             rng.next_bytes(byte_id)       # a low-quality quasi-random number
             id_ = str(binascii.b2a_hex(byte_id), 'utf-8')
             self._node_id = id_
-            with open(_id_file_path, 'w') as file:
+            with open(_id_file_path + '.new', 'w') as file:
                 file.write(id_ + '\n')
+            os.rename(_id_file_path + '.new', _id_file_path)
         else:
             # XXX many possible problems here!
             with open(_id_file_path, 'r') as file:
                 self._node_id = file.read()[:-1]
 
+        self._recovery = None
         if os.path.exists(_log_file_path):
-            self._log = BoundLog(FileReader(u_path, self._hashtype),
-                                 self._hashtype, u_path)
+            self._recovery = recover_tail(u_path, self._hashtype)
+            if not self._per_writer_log:
+                # append to the existing file rather than rewriting it
+                self._log = BoundLog(FileReader(u_path, self._hashtype),
+                                     self._hashtype, lock=self._append_lock)
         else:
             self._log = BoundLog(Reader([], self._hashtype),
-                                 self._hashtype, u_path)
+                                 self._hashtype, u_path,
+                                 log_format=log_format,
+                                 lock=self._append_lock)
+            if self._per_writer_log:
+                self._log.close()
+        if self._per_writer_log:
+            self._log = WriterLog(u_path, self._hashtype, self._node_id,
+                                  lock=self._append_lock)
 
     @property
     def u_dir(self):
@@ -101,7 +246,10 @@ class Server(object):
 
     @property
     def log(self):
-        """ Return a reference to the Server's BoundLog."""
+        """
+        Return a reference to the Server's BoundLog, or its KeyIndex if
+        it is read-only.
+        """
 
         return self._log
 
@@ -110,21 +258,356 @@ class Server(object):
         """ Return the Server's NodeID. """
         return self._node_id
 
+    @property
+    def append_lock(self):
+        """
+        Return the FileLock serializing appends to L (see upax.locking).
+        Anything rewriting L or node_id while the Server runs holds it.
+        """
+        return self._append_lock
+
+    @property
+    def read_only(self):
+        """ Return whether the Server was opened only to read. """
+        return self._read_only
+
+    def _check_writable(self):
+        if self._read_only:
+            raise UpaxError("%s is open read-only" % self._u_path)
+
+    @property
+    def recovery(self):
+        """
+        Return the RecoveryReport for the log, or None if the log was
+        created by this Server.
+        """
+        return self._recovery
+
+    @property
+    def compressing(self):
+        """ Return whether new data may be stored compressed. """
+        return self._codec != CODEC_NONE
+
+    @property
+    def packs(self):
+        """ Return the PackStore holding small objects, or None. """
+        return self._packs
+
+    @property
+    def evictor(self):
+        """ Return the Evictor keeping the store under quota, or None. """
+        return self._evictor
+
+    @property
+    def tiers(self):
+        """ Return the TieredStore, or None if there is a single tier. """
+        return self._tiers
+
+    def _packed(self, key):
+        return self._packs is not None and key in self._packs
+
     def exists(self, key):
         """ Return whehter uDir exists. """
-        return self._u_dir.exists(key)
+        return self._u_dir.exists(key) or self._packed(key) or \
+            (self._tiers is not None and self._tiers.in_cold(key))
+
+    def _stored(self, key):
+        """ Return what is stored under the key, as it is stored, or None. """
+        if self._packed(key):
+            return self._packs.get(key)
+        data = self._u_dir.get_data(key)
+        if data is None and self._tiers is not None:
+            # the fast tier, then the capacity tier, and the fast tier
+            # again in case the object was promoted in between
+            data = self._tiers.cold_dir.get_data(key)
+            if data is None:
+                data = self._u_dir.get_data(key)
+        return data
+
+    def _loose_path(self, key):
+        """ Return the path to the file holding the key, or None. """
+        if self._u_dir.exists(key):
+            return self._u_dir.get_path_for_key(key)
+        if self._tiers is not None and self._tiers.in_cold(key):
+            return self._tiers.cold_dir.get_path_for_key(key)
+        if self._u_dir.exists(key):
+            return self._u_dir.get_path_for_key(key)
+        return None
+
+    def _note_read(self, key):
+        if self._tiers is not None:
+            self._tiers.note_read(key)
+        if self._evictor is not None:
+            self._evictor.touch(key)
+
+    def _note_stored(self, key):
+        """ Account for a newly stored and logged object. """
+        if self._evictor is not None:
+            self._evictor.note_put(key)
+            self._evictor.enforce()
+
+    def stored_len(self, key):
+        """
+        Return the number of bytes the key occupies in the store, as
+        stored, or None if it is not there.
+        """
+        if self._packed(key):
+            return self._packs.length(key)
+        path = self._loose_path(key)
+        if path is None:
+            return None
+        return os.path.getsize(path)
+
+    def chunk_keys(self, key):
+        """
+        If the key's data is stored in chunks, return a list of the
+        chunks' keys, otherwise None.
+        """
+        if self._packed(key):
+            blob = self._packs.get(key)
+        else:
+            path = self._loose_path(key)
+            if path is None or not codec.is_manifest_file(path):
+                return None
+            with open(path, 'rb') as file:
+                blob = file.read()
+        if not codec.is_manifest(blob):
+            return None
+        return [c_key for (c_key, _) in decode_manifest(blob)]
+
+    def get_stored(self, key):
+        """
+        Return the key's data as it is stored, compressed or as a chunk
+        manifest, or None.  put_stored() accepts it.
+        """
+        return self._stored(key)
+
+    def put_stored(self, blob, entry):
+        """
+        Store blob, an object in the form get_stored() returns, under
+        entry.key, and log entry as it is, keeping its timestamp,
+        node_id, source and path.  This moves an object between stores
+        without changing its history.  A manifest's chunks must be put
+        before it.
+        """
+        self.put_stored_many([(blob, entry)])
+
+    def put_stored_many(self, items):
+        """
+        put_stored() each (blob, entry) in items, in order, logging the
+        entries with a single append.
+        """
+        self._check_writable()
+        for (blob, entry) in items:
+            self._store_blob(blob, entry.key,
+                             len(blob) < self._pack_threshold)
+        if not items:
+            return
+        self._log.add_entries([(e.timestamp, e.key, e.node_id, e.src,
+                                e.path) for (_, e) in items])
+        for (_, entry) in items:
+            if entry.path == CHUNK_PATH:
+                if self._evictor is not None:
+                    self._evictor.note_put(entry.key, chunk=True)
+            else:
+                self._note_stored(entry.key)
+
+    def _note_placed(self, key):
+        if self._tiers is not None:
+            self._tiers.note_placed(key)
+
+    def _chunked_reader(self, manifest):
+        """ Return a file-like object reading the data in a manifest. """
+        return ChunkedReader(decode_manifest(manifest), self.get)
 
     def get(self, key):
         """
         Given a content key (SHA hash), return the contents of the
-        corresponding file.
+        corresponding file, decompressed and reassembled if necessary.
+        """
+        blob = self._stored(key)
+        if blob is None:
+            return None
+        self._note_read(key)
+        if codec.is_manifest(blob):
+            with self._chunked_reader(blob) as reader:
+                return reader.read()
+        return codec.decode(blob)
+
+    def get_stream(self, key):
+        """
+        Given a content key, return a binary file-like object from which
+        the (uncompressed) contents can be read, or None if there is no
+        such key.  The caller must close it.
+        """
+        if self._packed(key):
+            blob = self._packs.get(key)
+            self._note_read(key)
+            if codec.is_manifest(blob):
+                return self._chunked_reader(blob)
+            return io.BytesIO(codec.decode(blob))
+        path = self._loose_path(key)
+        if path is None:
+            return None
+        self._note_read(key)
+        try:
+            if codec.is_manifest_file(path):
+                with open(path, 'rb') as file:
+                    return self._chunked_reader(file.read())
+            return codec.open_decoded(path)
+        except FileNotFoundError:
+            # moved to the other tier since we looked
+            path = self._loose_path(key)
+            if path is None:
+                return None
+            return codec.open_decoded(path)
+
+    def delete(self, key):
+        """
+        Remove whatever is stored under the key, returning whether there
+        was anything.  The log is left alone: it records what was put.
+        The chunks of chunked data are also left, as other data may
+        share them.
+        """
+        self._check_writable()
+        if self._evictor is not None:
+            self._evictor.forget(key)
+        if self._packed(key):
+            return self._packs.delete(key)
+        found = False
+        if self._tiers is not None:
+            found = self._tiers.delete(key)
+        if self._u_dir.exists(key):
+            os.remove(self._u_dir.get_path_for_key(key))
+            found = True
+        return found
+
+    def migrate(self):
+        """
+        Move objects between the tiers now, returning (demoted, promoted).
         """
-        return self._u_dir.get_data(key)
+        self._check_writable()
+        if self._tiers is None:
+            return (0, 0)
+        return self._tiers.migrate()
+
+    def repack(self):
+        """
+        Consolidate the pack files, returning the number of bytes
+        recovered.
+        """
+        self._check_writable()
+        if self._packs is None:
+            return 0
+        return self._packs.repack()
+
+    def _storage_codec(self, head, total_len):
+        """
+        Decide how to store data of total_len bytes beginning with head.
+        Return a codec, or None if the data should be stored as it is.
+        """
+        if self._codec != CODEC_NONE:
+            chosen = codec.choose_codec(head, total_len, self._codec)
+            if chosen != CODEC_NONE:
+                return chosen
+        if codec.needs_header(head):
+            return CODEC_NONE
+        return None
+
+    def _new_tmp_file(self):
+        """ Return (file, path) for a new temporary file in uDir/tmp. """
+        (fd_, tmp_path) = tempfile.mkstemp(dir=self._tmp_path)
+        return (os.fdopen(fd_, 'w+b'), tmp_path)
+
+    def _place_file(self, tmp_path, key):
+        """ Rename a complete file in uDir/tmp into its place in uDir. """
+        path = self._u_dir.get_path_for_key(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(tmp_path, path)
+        self._note_placed(key)
+
+    def _store_blob(self, blob, key, packed):
+        """ Store blob, which is in its final form, in a pack or a file. """
+        if packed:
+            self._packs.put(key, blob)
+        else:
+            (tmp_file, tmp_path) = self._new_tmp_file()
+            with tmp_file:
+                tmp_file.write(blob)
+            self._place_file(tmp_path, key)
+
+    def _store_data(self, data, key):
+        """
+        Store data under key, compressed and/or packed as configured.
+        Returns (len, hash).
+        """
+        codec_ = self._storage_codec(data[:codec.SAMPLE_LEN], len(data))
+        packed = len(data) < self._pack_threshold
+        if codec_ is None:
+            self._store_blob(data, key, packed)
+        else:
+            self._store_blob(codec.encode(data, codec_), key, packed)
+        return (len(data), key)
+
+    def _store_chunks(self, file, source, new=None):
+        """
+        Read a binary file-like object to its end, storing and logging
+        the chunks it divides into.  Returns a list of (key, len).
+
+        If new is a list, the keys of the chunks which were not already
+        present are appended to it instead of being logged, and the
+        caller either logs them with _log_chunks() or deletes them.
+        """
+        chunks = []
+        for chunk in chunk_stream(file):
+            c_key = hash_hex(chunk, self._hashtype)
+            if not self.exists(c_key):
+                self._store_data(chunk, c_key)
+                if new is None:
+                    self._log_chunks([c_key], source)
+                else:
+                    new.append(c_key)
+            chunks.append((c_key, len(chunk)))
+        return chunks
+
+    def _log_chunks(self, c_keys, source):
+        """ Log newly stored chunks. """
+        if not c_keys:
+            return
+        now = time.time()
+        self._log.add_entries([(now, c_key, self._node_id, source,
+                                CHUNK_PATH) for c_key in c_keys])
+        if self._evictor is not None:
+            for c_key in c_keys:
+                self._evictor.note_put(c_key, chunk=True)
+
+    def _store_manifest(self, chunks, total_len, key):
+        """ Store the manifest for the chunks under key. """
+        manifest = encode_manifest(chunks, total_len)
+        self._store_blob(manifest, key, len(manifest) < self._pack_threshold)
+
+    def _store_chunked(self, file, total_len, key, source):
+        """
+        Read a binary file-like object to its end, storing it in chunks
+        and storing a manifest for them under key.  Returns (len, hash).
+        Data which is a single chunk is already stored under its own key
+        and is left as it is, rather than replaced by a manifest listing
+        itself.
+        """
+        chunks = self._store_chunks(file, source)
+        if [c_key for (c_key, _) in chunks] != [key]:
+            self._store_manifest(chunks, total_len, key)
+        return (total_len, key)
+
+    def _chunking(self, length):
+        """ Return whether data of this length should be chunked. """
+        return self._chunk_threshold and length >= self._chunk_threshold
 
     def put(self, path_to_file, key, source, logged_path=None):
         """
         returns (len, hash)
         """
+        self._check_writable()
 
         # ----------------------------------------------------
         # XXX THIS IS A HACK but perhaps suggests a way to go
@@ -146,11 +629,10 @@ class Server(object):
             raise UpaxError('actual hash %s, claimed hash %s' % (
                 actual_key, key))
 
-        if self._u_dir.exists(key):
+        if self.exists(key):
             return (-1, key)
 
-        # XXX uses tempfile package, so not secure XXX
-        (len_, hash_) = self._u_dir.copy_and_put(path_to_file, key)
+        (len_, hash_) = self._store_file(path_to_file, key, source)
 
         # XXX should deal with exceptions
         self._log.add_entry(
@@ -159,11 +641,94 @@ class Server(object):
             self._node_id,
             source,
             logged_path)
+        self._note_stored(key)
+        return (len_, hash_)
+
+    def _store_file(self, path_to_file, key, source):
+        """
+        Store a copy of the file, whose key has been checked, compressed,
+        packed, or chunked as configured.  Returns (len, hash).
+        """
+        with open(path_to_file, 'rb') as file:
+            head = file.read(codec.SAMPLE_LEN)
+            len_ = os.fstat(file.fileno()).st_size
+            if self._chunking(len_):
+                file.seek(0)
+                (len_, hash_) = self._store_chunked(file, len_, key, source)
+                stored = True
+            elif len_ < self._pack_threshold:
+                (len_, hash_) = self._store_data(head + file.read(), key)
+                stored = True
+            else:
+                codec_ = self._storage_codec(head, len_)
+                stored = codec_ is not None
+                if stored:
+                    file.seek(0)
+                    (tmp_file, tmp_path) = self._new_tmp_file()
+                    with tmp_file:
+                        codec.encode_file(file, tmp_file, codec_)
+                    self._place_file(tmp_path, key)
+                    hash_ = key
+        if not stored:
+            (tmp_file, tmp_path) = self._new_tmp_file()
+            with tmp_file:
+                with open(path_to_file, 'rb') as file:
+                    shutil.copyfileobj(file, tmp_file, BLOCK_SIZE)
+            self._place_file(tmp_path, key)
+            hash_ = key
         return (len_, hash_)
 
+    def ingest_batch(self, items, source):
+        """
+        Given a list of (path, key, logged_path) for files inside uDir,
+        normally in uDir/in, whose keys have been checked, move them into
+        the store and log them all with a single append.  A file which
+        would be stored as it is, neither compressed, packed nor chunked,
+        is simply renamed into place; others are stored as by put() and
+        removed.  A file whose key is already present is removed.
+        Returns a list of (len, hash), len being -1 for those, with None
+        for any file which could not be read or moved; that file is left
+        where it was.
+        """
+        self._check_writable()
+        results = []
+        logged = []
+        now = time.time()
+        for (path, key, logged_path) in items:
+            try:
+                if self.exists(key):
+                    os.remove(path)
+                    results.append((-1, key))
+                    continue
+                len_ = os.path.getsize(path)
+                with open(path, 'rb') as file:
+                    head = file.read(codec.SAMPLE_LEN)
+                if not self._chunking(len_) and \
+                        len_ >= self._pack_threshold and \
+                        self._storage_codec(head, len_) is None:
+                    self._place_file(path, key)
+                else:
+                    (len_, _) = self._store_file(path, key, source)
+                    os.remove(path)
+            except OSError:
+                results.append(None)
+                continue
+            results.append((len_, key))
+            logged.append((now, key, self._node_id, source, logged_path))
+        if logged:
+            self._log.add_entries(logged)
+            for (_, key, _, _, _) in logged:
+                self._note_stored(key)
+        return results
+
     def put_data(self, data, key, source, logged_path='z@__posted_data__'):
         """ returns (len_, hash_) """
-        (len_, hash_) = self._u_dir.put_data(data, key)
+        self._check_writable()
+        if self._chunking(len(data)):
+            (len_, hash_) = self._store_chunked(io.BytesIO(data), len(data),
+                                                key, source)
+        else:
+            (len_, hash_) = self._store_data(data, key)
 
         # XXX should deal with exceptions
 
@@ -173,24 +738,111 @@ class Server(object):
             self._node_id,
             source,
             logged_path)
+        self._note_stored(key)
         return (len_, hash_)
 
+    def put_stream(self, stream, expected_key=None, source='',
+                   logged_path='z@__streamed_data__'):
+        """
+        Store data read from stream, a binary file-like object or an
+        iterable of bytes, in constant memory.  The data is hashed as it
+        is written to uDir/tmp and renamed into place once its key is
+        known, so it is written only once.  If expected_key is given
+        and the data does not hash to it, nothing is stored under any
+        key and UpaxError is raised.  Returns (len, hash), with len -1
+        if the key was already present.
+        """
+        self._check_writable()
+        if not hasattr(stream, 'read'):
+            stream = IterReader(stream)
+        reader = HashingReader(stream, self._hashtype)
+        # enough to decide how the data is to be stored
+        limit = max(codec.SAMPLE_LEN, self._pack_threshold,
+                    self._chunk_threshold)
+        head = read_fully(reader, limit)
+
+        if len(head) < limit:
+            # small enough to handle in memory
+            key = self._check_streamed(reader, expected_key)
+            if self.exists(key):
+                return (-1, key)
+            return self.put_data(head, key, source, logged_path)
+
+        rest = IterReader(iter(lambda: reader.read(BLOCK_SIZE), b''), head)
+        if self._chunk_threshold:
+            # the key is only known at the end: chunks are logged once
+            # it has been checked, and removed if it is wrong
+            new = []
+            try:
+                chunks = self._store_chunks(rest, source, new)
+                key = self._check_streamed(reader, expected_key)
+            except BaseException:
+                for c_key in new:
+                    self.delete(c_key)
+                raise
+            # data which is a single chunk was stored as itself
+            self._log_chunks([c_key for c_key in new if c_key != key],
+                             source)
+            if key not in new:
+                if self.exists(key):
+                    return (-1, key)
+                self._store_manifest(chunks, reader.length, key)
+        else:
+            codec_ = self._storage_codec(head[:codec.SAMPLE_LEN], len(head))
+            (tmp_file, tmp_path) = self._new_tmp_file()
+            try:
+                with tmp_file:
+                    if codec_ is None:
+                        shutil.copyfileobj(rest, tmp_file, BLOCK_SIZE)
+                    else:
+                        codec.encode_file(rest, tmp_file, codec_)
+                key = self._check_streamed(reader, expected_key)
+                if self.exists(key):
+                    os.remove(tmp_path)
+                    return (-1, key)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._place_file(tmp_path, key)
+
+        self._log.add_entry(time.time(), key, self._node_id, source,
+                            logged_path)
+        self._note_stored(key)
+        return (reader.length, key)
+
+    @staticmethod
+    def _check_streamed(reader, expected_key):
+        """ Return the key of what was read, checking it if expected. """
+        key = reader.hexdigest()
+        if expected_key is not None and key != expected_key:
+            raise UpaxError('actual hash %s, claimed hash %s' % (
+                key, expected_key))
+        return key
+
     def close(self):
         """ Shut down the server, closing any open files. """
+        if self._migrator is not None:
+            self._migrator.stop()
+            self._migrator = None
+        if self._tiers is not None:
+            self._tiers.close()
         self._log.close()
+        if self._packs is not None:
+            self._packs.close()
 
 
 class BlockingServer(Server):
     """ Single-threaded Upax server. """
 
-    def __init__(self, u_dir, hashtype=HashTypes.SHA2):
+    def __init__(self, u_dir, hashtype=HashTypes.SHA2, **kwargs):
         #pylint: disable=useless-super-delegation
-        super().__init__(u_dir, hashtype)
+        super().__init__(u_dir, hashtype, **kwargs)
 
 
 class NonBlockingServer(Server):
     """ Multi-threaded or otherwise non-blocking Upax server. """
 
-    def __init__(self, u_dir, hashtype=HashTypes.SHA2):
+    def __init__(self, u_dir, hashtype=HashTypes.SHA2, **kwargs):
         #pylint: disable=useless-super-delegation
-        super().__init__(u_dir, hashtype)
+        super().__init__(u_dir, hashtype, **kwargs)
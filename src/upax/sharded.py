@@ -0,0 +1,265 @@
+# ~/dev/py/upax/upax/sharded.py
+
+"""
+A content-keyed store spread across several uDirs, typically one per
+disk.
+
+Each shard is a complete uDir managed by an ordinary Server, with its
+own log and node_id, so a shard can still be opened on its own.  Keys
+are assigned to shards by consistent hashing (see upax.ring) on the
+shards' node_ids, which do not change when a disk is mounted somewhere
+else.  Operations on different shards run concurrently; operations on
+the same shard are serialized.
+
+After add_shard() some keys belong to the new shard but are still
+stored on the old ones.  They remain readable, because lookups fall
+back to the other shards, and rebalance() moves them.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from xlattice import HashTypes, check_hashtype
+from upax import UpaxError
+from upax.chunker import CHUNK_PATH
+from upax.ftlog import LogEntry
+from upax.ring import HashRing, VNODES
+from upax.server import Server
+
+__all__ = ['ShardedServer', ]
+
+
+class ShardedServer(object):
+    """
+    Offers the put/get/exists interface of a Server over several uDirs.
+    Keyword arguments are passed to the Server for each shard.
+    """
+
+    def __init__(self, u_paths, hashtype=HashTypes.SHA2, max_workers=None,
+                 vnodes=VNODES, **kwargs):
+        check_hashtype(hashtype)
+        if not u_paths:
+            raise UpaxError("a ShardedServer needs at least one uDir")
+        self._hashtype = hashtype
+        self._kwargs = kwargs
+        self._shards = {}           # node_id => Server
+        self._order = []            # node_ids, in the order added
+        self._locks = {}            # node_id => Lock
+        self._ring = HashRing((), vnodes)
+        self._max_workers = max_workers
+        self._pool = None
+        for u_path in u_paths:
+            self.add_shard(u_path)
+
+    @property
+    def hashtype(self):
+        """ Return the type of SHA hash used. """
+        return self._hashtype
+
+    @property
+    def ring(self):
+        """ Return the HashRing assigning keys to shards. """
+        return self._ring
+
+    @property
+    def shards(self):
+        """ Return the shards' Servers in the order they were added. """
+        return [self._shards[node_id] for node_id in self._order]
+
+    def add_shard(self, u_path):
+        """
+        Add a uDir as a shard, returning its Server.  Keys now owned by
+        the new shard are moved by rebalance().
+        """
+        server = Server(u_path, self._hashtype, **self._kwargs)
+        node_id = server.node_id
+        if node_id in self._shards:
+            server.close()
+            raise UpaxError("%s has the same node_id as another shard" %
+                            u_path)
+        self._shards[node_id] = server
+        self._order.append(node_id)
+        self._locks[node_id] = threading.Lock()
+        self._ring.add(node_id)
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return server
+
+    def _executor(self):
+        if self._pool is None:
+            workers = self._max_workers or len(self._shards)
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+        return self._pool
+
+    def shard_for(self, key):
+        """ Return the Server of the shard which owns the key. """
+        return self._shards[self._ring.lookup(key)]
+
+    def _locate(self, key):
+        """
+        Return the node_id of a shard holding the key, trying the owner
+        first, or None.
+        """
+        owner = self._ring.lookup(key)
+        with self._locks[owner]:
+            if self._shards[owner].exists(key):
+                return owner
+        for node_id in self._order:
+            if node_id != owner:
+                with self._locks[node_id]:
+                    if self._shards[node_id].exists(key):
+                        return node_id
+        return None
+
+    def exists(self, key):
+        """ Return whether any shard holds the key. """
+        return self._locate(key) is not None
+
+    def get(self, key):
+        """ Return the data stored under the key, or None. """
+        node_id = self._locate(key)
+        if node_id is None:
+            return None
+        with self._locks[node_id]:
+            return self._shards[node_id].get(key)
+
+    def get_stream(self, key):
+        """
+        Return a binary file-like object from which the data stored under
+        the key can be read, or None.  The caller must close it.
+        """
+        node_id = self._locate(key)
+        if node_id is None:
+            return None
+        with self._locks[node_id]:
+            return self._shards[node_id].get_stream(key)
+
+    def put(self, path_to_file, key, source, logged_path=None):
+        """ Store the file on the shard owning the key; return (len, hash). """
+        if self._locate(key) is not None:
+            return (-1, key)
+        node_id = self._ring.lookup(key)
+        with self._locks[node_id]:
+            return self._shards[node_id].put(path_to_file, key, source,
+                                             logged_path)
+
+    def put_data(self, data, key, source, logged_path='z@__posted_data__'):
+        """ Store data on the shard owning the key; return (len, hash). """
+        if self._locate(key) is not None:
+            return (-1, key)
+        node_id = self._ring.lookup(key)
+        with self._locks[node_id]:
+            return self._shards[node_id].put_data(data, key, source,
+                                                  logged_path)
+
+    def put_many(self, items):
+        """
+        Given an iterable of (path_to_file, key, source) triples, store
+        the files concurrently, returning a list of (len, hash) in the
+        same order.
+        """
+        return list(self._executor().map(lambda item: self.put(*item),
+                                         items))
+
+    def get_many(self, keys):
+        """
+        Return a list of the data stored under each of the keys (None
+        where absent), reading the shards concurrently.
+        """
+        return list(self._executor().map(self.get, keys))
+
+    def _misplaced(self, node_id):
+        """
+        Return the log entries for keys stored on the shard which the
+        ring assigns elsewhere.  Chunks stay with the data they belong to.
+        """
+        server = self._shards[node_id]
+        entries = {}
+        with self._locks[node_id]:
+            for entry in server.log.entries:
+                if entry.path == CHUNK_PATH:
+                    continue
+                if self._ring.lookup(entry.key) != node_id and \
+                        server.exists(entry.key):
+                    entries[entry.key] = entry
+        return list(entries.values())
+
+    def _move(self, node_id, entry):
+        """
+        Move an object from the shard to the shard owning it: the object
+        as it is stored, together with the chunks of chunked data, and
+        their log entries unchanged.  Returns the keys of the chunks,
+        which may now be orphans on the old shard.  Both shards, and the
+        append locks on their logs, are held throughout, always taken in
+        the same order.
+        """
+        key = entry.key
+        src = self._shards[node_id]
+        dest_id = self._ring.lookup(key)
+        dest = self._shards[dest_id]
+        both = sorted({node_id, dest_id})
+        with ExitStack() as stack:
+            for n_id in both:
+                stack.enter_context(self._locks[n_id])
+            for n_id in both:
+                stack.enter_context(self._shards[n_id].append_lock)
+            c_keys = src.chunk_keys(key) or []
+            if not dest.exists(key):
+                for c_key in c_keys:
+                    blob = src.get_stored(c_key)
+                    if blob is None or dest.exists(c_key):
+                        continue
+                    c_entry = src.log.get_entry(c_key)
+                    if c_entry is None:
+                        c_entry = LogEntry(entry.timestamp, c_key,
+                                           entry.node_id, entry.src,
+                                           CHUNK_PATH)
+                    dest.put_stored(blob, c_entry)
+                dest.put_stored(src.get_stored(key), entry)
+            src.delete(key)
+        return c_keys
+
+    def _drop_orphans(self, node_id, c_keys):
+        """
+        Delete from the shard those of the chunks which no data still
+        stored there refers to.  Returns the number deleted.
+        """
+        if not c_keys:
+            return 0
+        server = self._shards[node_id]
+        dropped = 0
+        with self._locks[node_id], server.append_lock:
+            live = set()
+            for entry in server.log.entries:
+                if entry.path != CHUNK_PATH and server.exists(entry.key):
+                    live.update(server.chunk_keys(entry.key) or ())
+            for c_key in set(c_keys) - live:
+                if server.delete(c_key):
+                    dropped += 1
+        return dropped
+
+    def rebalance(self):
+        """
+        Move every object not on the shard that owns it there, working on
+        the shards concurrently, then delete the chunks left behind
+        which nothing on the old shard refers to.  Returns the number of
+        objects moved.
+        """
+        def drain(node_id):
+            misplaced = self._misplaced(node_id)
+            c_keys = []
+            for entry in misplaced:
+                c_keys.extend(self._move(node_id, entry))
+            self._drop_orphans(node_id, c_keys)
+            return len(misplaced)
+        return sum(self._executor().map(drain, list(self._order)))
+
+    def close(self):
+        """ Shut down the thread pool and all the shards. """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for server in self.shards:
+            server.close()
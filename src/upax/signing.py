@@ -0,0 +1,249 @@
+# ~/dev/py/upax/upax/signing.py
+
+"""
+Signing a log a segment at a time.
+
+Signing every entry would cost an RSA operation per put.  Instead the
+log is divided into segments of up to SEGMENT_SIZE consecutive entries,
+and each segment is signed once.  A segment's entries are hashed into a
+chain, each link the SHA256 digest of the previous link and the
+entry's text line, starting from the last link of the previous segment
+(all zeroes for the first).  The node's RSA key signs the segment's
+position in the log, its length, and the first and last links.
+
+The chain ties every segment to those before it, so entries can be
+neither altered, dropped, reordered nor inserted without breaking a
+signature.  Checking a segment costs one RSA verification and a hash
+per entry; verify_segments() checks segments in parallel in a pool of
+processes, so a peer can authenticate a log it has been sent at close
+to the speed of hashing it.
+
+A LogSigner seals the entries appended to a node's log since it last
+did so, appending a line for each new segment to uDir/L.sig:
+
+    START COUNT PREV_LINK LAST_LINK SIGNATURE
+
+START and COUNT in decimal, the rest in hex.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from upax import UpaxError
+
+__all__ = ['Segment', 'LogSigner', 'chain_link', 'sign_segment',
+           'verify_segments', 'read_segments', 'SEGMENT_SIZE',
+           'SIG_NAME', ]
+
+SEGMENT_SIZE = 1024
+SIG_NAME = 'L.sig'
+
+LINK_LEN = hashlib.sha256().digest_size
+FIRST_LINK = bytes(LINK_LEN)
+
+
+def chain_link(prev, lines):
+    """
+    Return the last link of the hash chain over the text lines, each
+    a str, starting from prev.
+    """
+    link = prev
+    for line in lines:
+        link = hashlib.sha256(link + line.encode('utf-8')).digest()
+    return link
+
+
+def _signed_digest(start, count, prev, link):
+    """ Return the Crypto hash object a segment's signature covers. """
+    return SHA256.new(b'%u %u ' % (start, count) + prev + link)
+
+
+class Segment(object):
+    """ A signed run of count entries of a log, from position start. """
+
+    def __init__(self, start, count, prev, link, signature):
+        if start < 0 or count < 1:
+            raise UpaxError("a segment needs a position and some entries")
+        if len(prev) != LINK_LEN or len(link) != LINK_LEN:
+            raise UpaxError("segment links must be %u bytes" % LINK_LEN)
+        self._start = start
+        self._count = count
+        self._prev = prev
+        self._link = link
+        self._signature = signature
+
+    @property
+    def start(self):
+        """ Return the position in the log of the first entry. """
+        return self._start
+
+    @property
+    def count(self):
+        """ Return the number of entries in the segment. """
+        return self._count
+
+    @property
+    def end(self):
+        """ Return the position in the log after the last entry. """
+        return self._start + self._count
+
+    @property
+    def prev(self):
+        """ Return the last link of the previous segment's chain. """
+        return self._prev
+
+    @property
+    def link(self):
+        """ Return the last link of the segment's chain. """
+        return self._link
+
+    @property
+    def signature(self):
+        """ Return the RSA signature over the segment. """
+        return self._signature
+
+    def __str__(self):
+        return '%u %u %s %s %s\n' % (
+            self._start, self._count, self._prev.hex(), self._link.hex(),
+            self._signature.hex())
+
+    @classmethod
+    def parse(cls, line):
+        """ Return the Segment a line of uDir/L.sig describes. """
+        parts = line.split()
+        try:
+            (start, count, prev, link, signature) = parts
+            return cls(int(start), int(count), bytes.fromhex(prev),
+                       bytes.fromhex(link), bytes.fromhex(signature))
+        except ValueError:
+            raise UpaxError("not a valid segment line: '%s'" % line[:80])
+
+
+def sign_segment(rsa_priv_key, lines, start, prev=FIRST_LINK):
+    """
+    Return a Segment signing the entries' text lines, which begin at
+    position start in the log and follow the link prev.
+    """
+    link = chain_link(prev, lines)
+    signature = pkcs1_15.new(rsa_priv_key).sign(
+        _signed_digest(start, len(lines), prev, link))
+    return Segment(start, len(lines), prev, link, signature)
+
+
+def read_segments(path):
+    """ Return a list of the Segments in a signature file. """
+    segments = []
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    segments.append(Segment.parse(line))
+    return segments
+
+
+def _verify(args):
+    """
+    Return whether a segment's lines and signature check out.  Run in
+    worker processes, so it is given the public key exported.
+    """
+    (pub_key, lines, start, prev, link, signature) = args
+    if chain_link(prev, lines) != link:
+        return False
+    try:
+        pkcs1_15.new(RSA.import_key(pub_key)).verify(
+            _signed_digest(start, len(lines), prev, link), signature)
+    except ValueError:
+        return False
+    return True
+
+
+def verify_segments(entries, segments, rsa_pub_key, processes=None):
+    """
+    Check the segments against entries, a list of the log's entries in
+    order, with the signer's public key.  Returns a sorted list of the
+    indexes of the segments which do not check out, empty if all do;
+    a segment which does not follow on from the one before it is also
+    reported.  The segments are checked in a pool of processes,
+    os.cpu_count() of them if processes is None; if it is 0 they are
+    checked in this one.
+    """
+    pub_key = rsa_pub_key.export_key('DER')
+    bad = []
+    work = []
+    expected = (0, FIRST_LINK)
+    for (ndx, seg) in enumerate(segments):
+        if (seg.start, seg.prev) != expected or seg.end > len(entries):
+            bad.append(ndx)
+        else:
+            lines = [str(entry) for entry in entries[seg.start:seg.end]]
+            work.append((ndx, (pub_key, lines, seg.start, seg.prev,
+                               seg.link, seg.signature)))
+        expected = (seg.end, seg.link)
+    if processes == 0 or len(work) < 2:
+        results = [_verify(args) for (_, args) in work]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_verify, [args for (_, args) in work]))
+    bad.extend(ndx for ((ndx, _), good) in zip(work, results) if not good)
+    return sorted(bad)
+
+
+class LogSigner(object):
+    """
+    Signs a node's log, a Log, with rsa_priv_key, a segment at a time,
+    recording the segments in uDir/L.sig.  Segments already recorded
+    there are carried on from.
+    """
+
+    def __init__(self, log, u_path, rsa_priv_key,
+                 segment_size=SEGMENT_SIZE):
+        if segment_size < 1:
+            raise UpaxError("segments must hold at least one entry")
+        self._log = log
+        self._rsa_priv_key = rsa_priv_key
+        self._segment_size = segment_size
+        self._path = os.path.join(u_path, SIG_NAME)
+        self._segments = read_segments(self._path)
+
+    @property
+    def segments(self):
+        """ Return a copy of the list of Segments signed so far. """
+        return list(self._segments)
+
+    @property
+    def signed(self):
+        """ Return the number of entries of the log signed so far. """
+        return self._segments[-1].end if self._segments else 0
+
+    @property
+    def path(self):
+        """ Return the path to the file recording the segments. """
+        return self._path
+
+    def seal(self, partial=True):
+        """
+        Sign the entries added to the log since the last seal, in
+        segments of up to segment_size.  If partial is False a final
+        segment short of segment_size is left for a later seal.
+        Returns the list of new Segments.
+        """
+        start = self.signed
+        prev = self._segments[-1].link if self._segments else FIRST_LINK
+        lines = [str(entry) for entry in self._log.entries_from(start)]
+        new = []
+        for ndx in range(0, len(lines), self._segment_size):
+            chunk = lines[ndx:ndx + self._segment_size]
+            if len(chunk) < self._segment_size and not partial:
+                break
+            seg = sign_segment(self._rsa_priv_key, chunk, start + ndx, prev)
+            new.append(seg)
+            prev = seg.link
+        if new:
+            with open(self._path, 'a') as file:
+                file.write(''.join(str(seg) for seg in new))
+            self._segments.extend(new)
+        return new
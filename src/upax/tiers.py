@@ -0,0 +1,328 @@
+# ~/dev/py/upax/upax/tiers.py
+
+"""
+Tiered storage: a fast tier and a capacity tier.
+
+The Server's uDir is the fast tier: new data is always stored there, and
+so are the log, the pack files, and chunk manifests.  A TieredStore adds
+a capacity tier, another DIR256x256 uDir (usually on a larger, slower
+disk), and decides which objects live where using AccessStats.  When the
+fast tier holds more than hot_quota bytes of object files the coldest
+are demoted to the capacity tier; objects in the capacity tier which
+are read repeatedly are promoted back.  Placing an object in the fast
+tier counts as an access, so new data is not the first to be demoted,
+while only reads since demotion count towards promotion.  A Migrator
+does this in the background.
+
+An object is always copied into place in its new tier before it is
+removed from the old one, so it can be found in one tier or the other
+at every moment.  Stored files are moved as they are, compressed or not.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from xlu import DirStruc, UDir
+from upax import UpaxError
+from upax.codec import is_manifest_file
+
+__all__ = ['AccessStats', 'TieredStore', 'Migrator',
+           'HALF_LIFE', 'PROMOTE_HEAT', ]
+
+# seconds for the heat of an object which is not read to halve
+HALF_LIFE = 24 * 3600.0
+
+# an object in the capacity tier is promoted when its heat reaches this
+PROMOTE_HEAT = 2.0
+
+# demotion stops when the fast tier is down to this fraction of its quota
+LOW_WATER = 0.9
+
+STATS_NAME = 'access'
+
+
+class AccessStats(object):
+    """
+    The heat of each object read: a count of reads, each decaying with
+    the given half life, and the time of the last read.  Persisted in a
+    text file, one line per object:
+
+        KEY HEAT LAST_READ
+    """
+
+    def __init__(self, path, half_life=HALF_LIFE):
+        if half_life <= 0:
+            raise UpaxError("half life must be positive")
+        self._path = path
+        self._half_life = half_life
+        self._stats = {}            # key => [heat, last_read]
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        self._stats[parts[0]] = [float(parts[1]),
+                                                 float(parts[2])]
+
+    def __contains__(self, key):
+        return key in self._stats
+
+    def __len__(self):
+        return len(self._stats)
+
+    def _decayed(self, stat, now):
+        return stat[0] * 0.5 ** (max(0.0, now - stat[1]) / self._half_life)
+
+    def touch(self, key, now=None):
+        """ Record a read of the key, returning its new heat. """
+        if now is None:
+            now = time.time()
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = self._stats[key] = [0.0, now]
+        stat[0] = self._decayed(stat, now) + 1.0
+        stat[1] = now
+        return stat[0]
+
+    def heat(self, key, now=None):
+        """ Return the current heat of the key, 0.0 if never read. """
+        stat = self._stats.get(key)
+        if stat is None:
+            return 0.0
+        return self._decayed(stat, time.time() if now is None else now)
+
+    def last_read(self, key):
+        """ Return the time the key was last read, or 0.0. """
+        stat = self._stats.get(key)
+        return 0.0 if stat is None else stat[1]
+
+    def forget(self, key):
+        """ Drop what is known about the key. """
+        self._stats.pop(key, None)
+
+    def save(self):
+        """ Write the statistics to disk, replacing the old file. """
+        tmp_path = self._path + '.new'
+        with open(tmp_path, 'w') as file:
+            for key in sorted(self._stats):
+                (heat, last) = self._stats[key]
+                file.write('%s %.6g %.3f\n' % (key, heat, last))
+        os.replace(tmp_path, self._path)
+
+
+class TieredStore(object):
+    """
+    The capacity tier of a Server's store, together with what is needed
+    to decide which objects belong in which tier.  hot_dir is the
+    Server's UDir, the fast tier.
+    """
+
+    def __init__(self, hot_dir, cold_path, hashtype, hot_quota,
+                 promote_heat=PROMOTE_HEAT, half_life=HALF_LIFE):
+        if hot_quota <= 0:
+            raise UpaxError("the fast tier needs a positive byte quota")
+        self._hot = hot_dir
+        self._cold = UDir.discover(cold_path, DirStruc.DIR256x256, hashtype)
+        self._cold_path = cold_path
+        self._cold_tmp = os.path.join(cold_path, 'tmp')
+        os.makedirs(self._cold_tmp, exist_ok=True)
+        self._hot_quota = hot_quota
+        self._promote_heat = promote_heat
+        self._stats = AccessStats(
+            os.path.join(hot_dir.u_path, STATS_NAME), half_life)
+        self._lock = threading.RLock()
+        self._hot_sizes = self._scan(hot_dir.u_path)      # key => bytes
+        self._hot_bytes = sum(self._hot_sizes.values())
+        self._to_promote = set()
+
+    @staticmethod
+    def _scan(u_path):
+        """ Return a map key => size of the object files in a uDir. """
+        sizes = {}
+        for top in os.listdir(u_path):
+            top_path = os.path.join(u_path, top)
+            if len(top) != 2 or not os.path.isdir(top_path):
+                continue
+            for mid in os.listdir(top_path):
+                mid_path = os.path.join(top_path, mid)
+                if len(mid) != 2 or not os.path.isdir(mid_path):
+                    continue
+                for entry in os.scandir(mid_path):
+                    if entry.is_file():
+                        sizes[entry.name] = entry.stat().st_size
+        return sizes
+
+    @property
+    def cold_dir(self):
+        """ Return the UDir of the capacity tier. """
+        return self._cold
+
+    @property
+    def cold_path(self):
+        """ Return the path to the capacity tier. """
+        return self._cold_path
+
+    @property
+    def hot_quota(self):
+        """ Return the byte quota of the fast tier. """
+        return self._hot_quota
+
+    @property
+    def hot_bytes(self):
+        """ Return the number of bytes of object files in the fast tier. """
+        return self._hot_bytes
+
+    @property
+    def stats(self):
+        """ Return the AccessStats. """
+        return self._stats
+
+    def in_cold(self, key):
+        """ Return whether the key is stored in the capacity tier. """
+        return self._cold.exists(key)
+
+    def note_placed(self, key):
+        """
+        Record that an object file has been stored in the fast tier,
+        which counts as an access.
+        """
+        path = self._hot.get_path_for_key(key)
+        with self._lock:
+            old = self._hot_sizes.get(key, 0)
+            self._hot_sizes[key] = os.path.getsize(path)
+            self._hot_bytes += self._hot_sizes[key] - old
+            self._stats.touch(key)
+
+    def note_read(self, key):
+        """
+        Record a read of the key, marking it for promotion if it is in
+        the capacity tier and has become hot.
+        """
+        with self._lock:
+            heat = self._stats.touch(key)
+            if heat >= self._promote_heat and key not in self._hot_sizes \
+                    and self._cold.exists(key):
+                self._to_promote.add(key)
+
+    def delete(self, key):
+        """
+        Remove the key from the capacity tier, and forget it in both.
+        Return whether it was in the capacity tier.
+        """
+        with self._lock:
+            self._stats.forget(key)
+            self._to_promote.discard(key)
+            size = self._hot_sizes.pop(key, None)
+            if size is not None:
+                self._hot_bytes -= size
+            if not self._cold.exists(key):
+                return False
+            os.remove(self._cold.get_path_for_key(key))
+            return True
+
+    def _copy(self, src, dest, tmp_dir):
+        """ Copy the file at src to dest, via tmp_dir, atomically. """
+        (fd_, tmp_path) = tempfile.mkstemp(dir=tmp_dir)
+        with os.fdopen(fd_, 'wb') as tmp_file:
+            with open(src, 'rb') as file:
+                shutil.copyfileobj(file, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.rename(tmp_path, dest)
+
+    def demote(self, key):
+        """
+        Move an object from the fast tier to the capacity tier.  Chunk
+        manifests stay in the fast tier.  Return whether it was moved.
+        """
+        src = self._hot.get_path_for_key(key)
+        if not os.path.exists(src) or is_manifest_file(src):
+            return False
+        self._copy(src, self._cold.get_path_for_key(key), self._cold_tmp)
+        with self._lock:
+            os.remove(src)
+            self._hot_bytes -= self._hot_sizes.pop(key, 0)
+            # only reads from the capacity tier count towards promotion
+            self._stats.forget(key)
+        return True
+
+    def promote(self, key):
+        """
+        Move an object from the capacity tier to the fast tier.  Return
+        whether it was moved.
+        """
+        src = self._cold.get_path_for_key(key)
+        if not os.path.exists(src):
+            return False
+        dest = self._hot.get_path_for_key(key)
+        self._copy(src, dest, os.path.join(self._hot.u_path, 'tmp'))
+        self.note_placed(key)
+        with self._lock:
+            os.remove(src)
+        return True
+
+    def migrate(self):
+        """
+        Demote the coldest objects until the fast tier is below its
+        low-water mark, if it is over quota, then promote hot objects
+        from the capacity tier as far as the quota allows.  Returns
+        (demoted, promoted).
+        """
+        demoted = promoted = 0
+        now = time.time()
+        with self._lock:
+            over = self._hot_bytes > self._hot_quota
+            if over:
+                victims = sorted(
+                    self._hot_sizes,
+                    key=lambda k: (self._stats.heat(k, now),
+                                   self._stats.last_read(k), k))
+            candidates = sorted(
+                self._to_promote,
+                key=lambda k: -self._stats.heat(k, now))
+            self._to_promote = set()
+        if over:
+            target = self._hot_quota * LOW_WATER
+            for key in victims:
+                if self._hot_bytes <= target:
+                    break
+                if self.demote(key):
+                    demoted += 1
+        for key in candidates:
+            size = os.path.getsize(self._cold.get_path_for_key(key)) \
+                if self._cold.exists(key) else None
+            if size is None or self._hot_bytes + size > self._hot_quota:
+                continue
+            if self.promote(key):
+                promoted += 1
+        with self._lock:
+            self._stats.save()
+        return (demoted, promoted)
+
+    def close(self):
+        """ Save the access statistics. """
+        with self._lock:
+            self._stats.save()
+
+
+class Migrator(threading.Thread):
+    """ Runs TieredStore.migrate() every `interval` seconds until stopped. """
+
+    def __init__(self, tiers, interval):
+        super().__init__(name='upax-migrator', daemon=True)
+        self._tiers = tiers
+        self._interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self._interval):
+            self._tiers.migrate()
+
+    def stop(self):
+        """ Ask the thread to stop and wait for it. """
+        self._stopping.set()
+        self.join()
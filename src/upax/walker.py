@@ -13,20 +13,53 @@ import re
 import sys
 
 from upax import UpaxError
+from upax.chunker import ChunkedReader, decode_manifest, manifest_hex
+from upax.codec import decode, file_hex, is_manifest, is_manifest_file
+from upax.hashing import hash_hex
+from upax.pack import PackStore, PACK_DIR
 from xlattice import HashTypes, check_hashtype
-from xlu import DirStruc, file_sha1hex, file_sha2hex, file_sha3hex
+from xlu import DirStruc
 
 HEX_DIR_PAT = '^[0-9a-fA-F]{2}$'
 HEX_DIR_RE = re.compile(HEX_DIR_PAT)
-__all__ = ['UWalker', ]
+__all__ = ['UWalker', 'load_object', ]
 
 TWO_HEX_RE = re.compile('[0-9a-f]{2}')
 
 
+def load_object(u_path, key, packs=None):
+    """
+    Return the decoded data stored under key in the uDir, looking in
+    packs (a PackStore or None) if there is no file of that name, or
+    None if it isn't there.  Chunk manifests are reassembled.
+    """
+    path = os.path.join(u_path, key[0:2], key[2:4], key)
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            blob = file.read()
+    elif packs is not None and key in packs:
+        blob = packs.get(key)
+    else:
+        return None
+    if is_manifest(blob):
+        return _read_manifest(u_path, blob, packs)
+    return decode(blob)
+
+
+def _read_manifest(u_path, blob, packs):
+    """ Return the data described by a manifest stored in the uDir. """
+    with ChunkedReader(decode_manifest(blob),
+                       lambda key: load_object(u_path, key, packs)) as reader:
+        return reader.read()
+
+
 class UWalker(object):
     """
     Walks a content-keyed directory structure, visiting up to `limit` nodes.
 
+    Objects in pack files are visited after those stored in files of
+    their own.
+
     XXX Can't handle DIR_FLAT or DIR16x16.  Needs to be modified to
     handle the nine combinations of SHA{1,2,3} and DIR{_FLAT,16x16,256x256.
     """
@@ -60,6 +93,7 @@ class UWalker(object):
         self._verbose = verbose
 
         self._keys = []
+        self._packs = None
 
     @property
     def count(self):
@@ -81,10 +115,23 @@ class UWalker(object):
         """ Return path to content-keyed store. """
         return self._u_path
 
+    def _load(self, key):
+        return load_object(self._u_path, key, self._packs)
+
     def walk(self):
         """
         Returns a list of keys found.
         """
+        if os.path.exists(os.path.join(self._u_path, PACK_DIR)):
+            self._packs = PackStore(self._u_path)
+        try:
+            return self._walk()
+        finally:
+            if self._packs is not None:
+                self._packs.close()
+                self._packs = None
+
+    def _walk(self):
         limit = self._limit
 
         self._count = 0
@@ -113,12 +160,15 @@ class UWalker(object):
                                 continue
 
                             path_to_file = os.path.join(mid_dir_path, file)
-                            if self._hashtype == HashTypes.SHA1:
-                                content_key = file_sha1hex(path_to_file)
-                            elif self._hashtype == HashTypes.SHA2:
-                                content_key = file_sha2hex(path_to_file)
-                            elif self._hashtype == HashTypes.SHA3:
-                                content_key = file_sha3hex(path_to_file)
+                            # the key of the uncompressed data
+                            if is_manifest_file(path_to_file):
+                                with open(path_to_file, 'rb') as manifest:
+                                    content_key = manifest_hex(
+                                        manifest.read(), self._load,
+                                        self._hashtype)
+                            else:
+                                content_key = file_hex(path_to_file,
+                                                       self._hashtype)
 
                             if file != content_key:
                                 print('HASH MISMATCH: expected %s, actual %s'
@@ -129,4 +179,27 @@ class UWalker(object):
                         break
             if not walking:
                 break
+        if walking and self._packs is not None:
+            self._walk_packs()
         return self._keys
+
+    def _walk_packs(self):
+        """ Visit packed objects, in key order, until the limit is reached. """
+        packs = self._packs
+        for key in packs.keys():
+            if key[:2] < self._start_at:
+                continue
+            self._count += 1
+            self._keys.append(key)
+            if not self._just_keys:
+                blob = packs.get(key)
+                if is_manifest(blob):
+                    content_key = manifest_hex(blob, self._load,
+                                               self._hashtype)
+                else:
+                    content_key = hash_hex(decode(blob), self._hashtype)
+                if key != content_key:
+                    print('HASH MISMATCH: expected %s, actual %s'
+                          % (key, content_key))
+            if self._count >= self._limit:
+                break
@@ -0,0 +1,644 @@
+# ~/dev/py/upax/upax/zserver.py
+
+"""
+A ZeroMQ request/response protocol in front of a Server.
+
+A ZServer owns a ROUTER socket and answers requests from ZClients, each
+of which owns a DEALER socket.  Any transport ZeroMQ offers may be used:
+inproc:// within a process, ipc:// between processes on one machine,
+tcp:// between machines.
+
+Every message is multipart.  A request is
+
+    REQ_ID OP ARG...
+
+and its reply
+
+    REQ_ID STATUS PAYLOAD...
+
+where REQ_ID is a request number chosen by the client, 8 bytes
+big-endian, and STATUS is one of OK, NOT_FOUND and ERROR; an ERROR
+reply carries a message.  Requests are answered in the order received
+but carry their number, so a client may have many in flight and match
+the replies as they arrive.  Data travels as frames of its own and is
+sent without being copied.
+
+    OP            ARGS                         OK PAYLOAD
+    PUT           KEY SRC PATH DATA            LEN KEY
+    GET           KEY                          DATA, or NOT_FOUND
+    EXISTS        KEY                          '1' or '0'
+    PUT_MANY      SRC PATH (KEY DATA)...       (LEN KEY)...
+    GET_MANY      KEY...                       (FOUND DATA)...
+    EXISTS_MANY   KEY...                       one '1' or '0' per key
+    LOG           START END LIMIT              log entry lines
+    LOG_FROM      SEQ LIMIT                    NEXT TOTAL log entry lines
+    GET_STORED    KEY                          BLOB, or NOT_FOUND
+    TREE          PREFIX                       DEPTH HASH CHILD_HASHES
+    ENTRIES       PREFIX                       log entry lines
+    ADD_ENTRIES   LINES                        COUNT
+    PING                                       nothing
+
+A KEY is lower-case hex of the length of the store's digest; any other
+KEY is answered with ERROR.  KEY may be empty in a put, in which case
+the server computes it; if given, the data must hash to it.  LEN is -1
+if the key was already present.  In a LOG request START and END are
+timestamps and LIMIT a count, each in decimal and each possibly empty,
+meaning unbounded; the reply holds the log entries with START <=
+timestamp < END, in timestamp order, as ftlog text lines.
+
+LOG_FROM and GET_STORED let a replica follow the server's log (see
+upax.replicator).  LOG_FROM answers with up to LIMIT entries in the
+order they were added to the log, starting at position SEQ, with NEXT,
+the position after the last of them, and TOTAL, the number of entries
+in the log.  GET_STORED answers with an object as it is stored,
+compressed or as a chunk manifest.
+
+TREE, ENTRIES and ADD_ENTRIES let two nodes reconcile their logs (see
+upax.merkle).  TREE answers with the depth of the server's LogSummary,
+the hash of the node named by PREFIX, a key prefix in lower-case hex,
+and the 16 hashes of its children concatenated.  ENTRIES answers with
+the entries in the bucket named by PREFIX, and ADD_ENTRIES adds to the
+log those of the entries in LINES which it lacks, answering with their
+number.
+
+Numbers are sent in ASCII.  A request which fails for any reason is
+answered with ERROR.
+"""
+
+import re
+import struct
+import threading
+import time
+
+from xlattice import HashTypes, check_hashtype
+from upax import UpaxError
+from upax.ftlog import parse_entry_line
+from upax.hashing import hash_hex
+from upax.merkle import LogSummary
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+__all__ = ['ZServer', 'ZClient',
+           'OP_PUT', 'OP_GET', 'OP_EXISTS', 'OP_PUT_MANY', 'OP_GET_MANY',
+           'OP_EXISTS_MANY', 'OP_LOG', 'OP_LOG_FROM', 'OP_GET_STORED',
+           'OP_TREE', 'OP_ENTRIES',
+           'OP_ADD_ENTRIES', 'OP_PING',
+           'STATUS_OK', 'STATUS_NOT_FOUND', 'STATUS_ERROR',
+           'TIMEOUT', 'WINDOW', ]
+
+OP_PUT = b'PUT'
+OP_GET = b'GET'
+OP_EXISTS = b'EXISTS'
+OP_PUT_MANY = b'PUT_MANY'
+OP_GET_MANY = b'GET_MANY'
+OP_EXISTS_MANY = b'EXISTS_MANY'
+OP_LOG = b'LOG'
+OP_LOG_FROM = b'LOG_FROM'
+OP_GET_STORED = b'GET_STORED'
+OP_TREE = b'TREE'
+OP_ENTRIES = b'ENTRIES'
+OP_ADD_ENTRIES = b'ADD_ENTRIES'
+OP_PING = b'PING'
+
+STATUS_OK = b'OK'
+STATUS_NOT_FOUND = b'NOT_FOUND'
+STATUS_ERROR = b'ERROR'
+
+REQ_ID = struct.Struct('>Q')
+
+# default number of requests a client keeps in flight when pipelining
+WINDOW = 64
+
+# milliseconds a serving thread waits for a request before checking
+# whether it has been stopped
+POLL_MS = 100
+
+# seconds a client waits to send a request or for its reply
+TIMEOUT = 30.0
+
+POSTED_PATH = 'z@__posted_data__'
+
+KEY_1_RE = re.compile('^[0-9a-f]{40}$')
+KEY_256_RE = re.compile('^[0-9a-f]{64}$')
+
+
+def _need_zmq():
+    if zmq is None:
+        raise UpaxError("pyzmq is needed to serve or reach Upax over ZeroMQ")
+
+
+def _number(frame):
+    """ Return the decimal number in the frame, or None if it is empty. """
+    text = bytes(frame).decode('ascii')
+    return int(text) if text else None
+
+
+class ZServer(object):
+    """
+    Answers requests on endpoint using server, a Server.  The Server is
+    used only by the thread calling serve() or the thread start()
+    creates.
+    """
+
+    def __init__(self, server, endpoint, context=None):
+        _need_zmq()
+        self._server = server
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.ROUTER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind(endpoint)
+        if server.hashtype == HashTypes.SHA1:
+            self._key_re = KEY_1_RE
+        else:
+            self._key_re = KEY_256_RE
+        self._stopping = threading.Event()
+        self._thread = None
+        self._handled = 0
+        self._summary = None        # LogSummary, built on first use
+        self._handlers = {
+            OP_PUT: self._do_put,
+            OP_GET: self._do_get,
+            OP_EXISTS: self._do_exists,
+            OP_PUT_MANY: self._do_put_many,
+            OP_GET_MANY: self._do_get_many,
+            OP_EXISTS_MANY: self._do_exists_many,
+            OP_LOG: self._do_log,
+            OP_LOG_FROM: self._do_log_from,
+            OP_GET_STORED: self._do_get_stored,
+            OP_TREE: self._do_tree,
+            OP_ENTRIES: self._do_entries,
+            OP_ADD_ENTRIES: self._do_add_entries,
+            OP_PING: self._do_ping,
+        }
+
+    @property
+    def endpoint(self):
+        """ Return the endpoint bound, with any wildcard port filled in. """
+        return self._socket.getsockopt(zmq.LAST_ENDPOINT).decode('ascii')
+
+    @property
+    def handled(self):
+        """ Return the number of requests answered. """
+        return self._handled
+
+    # -- requests ----------------------------------------------------
+
+    def _key(self, frame):
+        """
+        Return the key in the frame, raising UpaxError unless it is a
+        well-formed key for the store.  Keys name files, so nothing else
+        may reach the Server.
+        """
+        key = bytes(frame).decode('ascii', 'replace')
+        if not self._key_re.match(key):
+            raise UpaxError("not a valid key: '%s'" % key[:80])
+        return key
+
+    def _put(self, key, source, logged_path, data):
+        """ Store data, returning the reply frames (LEN, KEY). """
+        actual = hash_hex(data, self._server.hashtype)
+        key = self._key(key) if len(key) else ''
+        if key and key != actual:
+            raise UpaxError('actual hash %s, claimed hash %s' % (
+                actual, key))
+        if self._server.exists(actual):
+            len_ = -1
+        else:
+            (len_, _) = self._server.put_data(data, actual, source,
+                                              logged_path)
+        return [b'%d' % len_, actual.encode('ascii')]
+
+    def _do_put(self, args):
+        (key, source, logged_path, data) = args
+        return self._put(key, bytes(source).decode('utf-8'),
+                         bytes(logged_path).decode('utf-8'),
+                         data.bytes)
+
+    def _do_get(self, args):
+        (key,) = args
+        data = self._server.get(self._key(key))
+        if data is None:
+            return None
+        return [data]
+
+    def _do_exists(self, args):
+        (key,) = args
+        return [b'1' if self._server.exists(self._key(key)) else b'0']
+
+    def _do_put_many(self, args):
+        if len(args) % 2:
+            raise UpaxError("PUT_MANY needs a key and data for each item")
+        source = bytes(args[0]).decode('utf-8')
+        logged_path = bytes(args[1]).decode('utf-8')
+        reply = []
+        for ndx in range(2, len(args), 2):
+            reply.extend(self._put(args[ndx], source, logged_path,
+                                   args[ndx + 1].bytes))
+        return reply
+
+    def _do_get_many(self, args):
+        reply = []
+        for key in [self._key(arg) for arg in args]:
+            data = self._server.get(key)
+            if data is None:
+                reply.extend([b'0', b''])
+            else:
+                reply.extend([b'1', data])
+        return reply
+
+    def _do_exists_many(self, args):
+        exists = self._server.exists
+        return [b''.join(b'1' if exists(key) else b'0'
+                         for key in [self._key(arg) for arg in args])]
+
+    def _do_log(self, args):
+        (start, end, limit) = [_number(arg) for arg in args]
+        lines = []
+        for entry in self._server.log.entries_between(start, end):
+            if limit is not None and len(lines) >= limit:
+                break
+            lines.append(str(entry))
+        return [''.join(lines).encode('utf-8')]
+
+    def _do_log_from(self, args):
+        (seq, limit) = [_number(arg) for arg in args]
+        if seq is None or seq < 0 or (limit is not None and limit < 0):
+            raise UpaxError("LOG_FROM needs a position and a limit >= 0")
+        log = self._server.log
+        total = len(log.entries)
+        end = total if limit is None else min(total, seq + limit)
+        lines = [str(entry) for entry in log.entries[seq:end]]
+        return [b'%d' % max(seq, end), b'%d' % total,
+                ''.join(lines).encode('utf-8')]
+
+    def _do_get_stored(self, args):
+        (key,) = args
+        blob = self._server.get_stored(self._key(key))
+        if blob is None:
+            return None
+        return [blob]
+
+    def _log_summary(self):
+        """ Return the LogSummary of the Server's log, brought up to date. """
+        if self._summary is None:
+            self._summary = LogSummary(self._server.log)
+        else:
+            self._summary.refresh()
+        return self._summary
+
+    def _do_tree(self, args):
+        (prefix,) = args
+        prefix = bytes(prefix).decode('ascii', 'replace')
+        summary = self._log_summary()
+        return [b'%d' % summary.depth, summary.node_hash(prefix),
+                b''.join(summary.children(prefix))]
+
+    def _do_entries(self, args):
+        (prefix,) = args
+        entries = self._log_summary().entries(
+            bytes(prefix).decode('ascii', 'replace'))
+        return [''.join(str(entry) for entry in entries).encode('utf-8')]
+
+    def _do_add_entries(self, args):
+        (lines,) = args
+        summary = self._log_summary()
+        entries = []
+        for line in bytes(lines).decode('utf-8').split('\n'):
+            entry = parse_entry_line(line, self._server.hashtype)
+            if entry is not None and entry not in summary:
+                entries.append(entry)
+        entries.sort(key=lambda entry: entry.timestamp)
+        if entries:
+            self._server.log.add_entries(
+                [(e.timestamp, e.key, e.node_id, e.src, e.path)
+                 for e in entries])
+        return [b'%d' % len(entries)]
+
+    @staticmethod
+    def _do_ping(args):
+        if args:
+            raise UpaxError("PING takes no arguments")
+        return []
+
+    def _answer(self, frames):
+        """ Return the reply to one request, as received by ROUTER. """
+        if len(frames) < 3 or len(frames[1]) != REQ_ID.size:
+            return None                     # not ours; drop it
+        (ident, req_id, op) = frames[:3]
+        handler = self._handlers.get(bytes(op))
+        try:
+            if handler is None:
+                raise UpaxError("unknown operation '%s'" %
+                                bytes(op).decode('ascii', 'replace'))
+            payload = handler(frames[3:])
+        except Exception as exc:        # pylint: disable=broad-except
+            # whatever goes wrong, the client gets a reply and the
+            # serving loop carries on
+            return [ident, req_id, STATUS_ERROR, str(exc).encode('utf-8')]
+        if payload is None:
+            return [ident, req_id, STATUS_NOT_FOUND]
+        return [ident, req_id, STATUS_OK] + payload
+
+    # -- serving -----------------------------------------------------
+
+    def serve_once(self, timeout=POLL_MS):
+        """
+        Answer every request waiting, waiting up to timeout ms for the
+        first.  Returns the number answered.
+        """
+        count = 0
+        while self._socket.poll(timeout if count == 0 else 0):
+            frames = self._socket.recv_multipart(copy=False)
+            reply = self._answer(frames)
+            if reply is not None:
+                # counted first, so a client seeing the reply sees it
+                self._handled += 1
+                self._socket.send_multipart(reply, copy=False)
+                count += 1
+        return count
+
+    def serve(self):
+        """ Answer requests until stop() is called. """
+        while not self._stopping.is_set():
+            self.serve_once()
+
+    def start(self):
+        """ Answer requests in a background thread. """
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self.serve,
+                                            name='upax-zserver', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop answering requests, waiting for the thread if any. """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """ Stop, and close the socket.  The Server is left open. """
+        self.stop()
+        self._socket.close()
+
+
+class ZClient(object):
+    """
+    Sends requests to a ZServer at endpoint, whose store uses hashtype.
+    A ZClient may be used by one thread at a time.  Sending a request or
+    waiting for a reply raises UpaxError after timeout seconds; if
+    timeout is None they wait indefinitely.
+
+    submit() sends a request and returns its number at once; result()
+    waits for the reply, and receive() and done() let the caller wait
+    in steps of its own choosing.  pipeline() keeps a window of requests
+    in flight.  The other methods send one request and wait for its reply.
+    """
+
+    def __init__(self, endpoint, hashtype=HashTypes.SHA2, context=None,
+                 timeout=TIMEOUT):
+        _need_zmq()
+        check_hashtype(hashtype)
+        self._hashtype = hashtype
+        self._timeout = timeout
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        # queue requests only on completed connections, so that sending
+        # to a server which is not there times out
+        self._socket.setsockopt(zmq.IMMEDIATE, 1)
+        if timeout is not None:
+            self._socket.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+        self._endpoint = endpoint
+        self._socket.connect(endpoint)
+        self._next_id = 0
+        self._replies = {}          # req_id => (status, payload frames)
+
+    def submit(self, op, *args):
+        """ Send a request, returning its number. """
+        req_id = self._next_id
+        self._next_id += 1
+        try:
+            self._socket.send_multipart(
+                [REQ_ID.pack(req_id), op] + list(args), copy=False)
+        except zmq.Again:
+            raise UpaxError("can't send to %s" % self._endpoint)
+        return req_id
+
+    def _recv_one(self):
+        """ Receive a reply, keeping it for result(). """
+        frames = self._socket.recv_multipart(copy=False)
+        if len(frames) >= 2 and len(frames[0]) == REQ_ID.size:
+            (got,) = REQ_ID.unpack(frames[0].bytes)
+            self._replies[got] = (frames[1].bytes, frames[2:])
+
+    def receive(self, timeout=0):
+        """
+        Receive the replies which arrive within timeout ms, keeping them
+        for result().  Returns the number of messages received.
+        """
+        count = 0
+        while self._socket.poll(timeout if count == 0 else 0):
+            self._recv_one()
+            count += 1
+        return count
+
+    def done(self, req_id):
+        """ Return whether the reply to the request has been received. """
+        return req_id in self._replies
+
+    def result(self, req_id):
+        """
+        Wait for the reply to the request, returning (status, payload),
+        where payload is a list of zmq Frames.
+        """
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        while req_id not in self._replies:
+            if self._timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or \
+                        not self._socket.poll(remaining * 1000):
+                    raise UpaxError("no reply from %s in %.1fs" % (
+                        self._endpoint, self._timeout))
+            self._recv_one()
+        return self._replies.pop(req_id)
+
+    def pipeline(self, requests, window=WINDOW):
+        """
+        Send each (op, arg...) in requests, keeping up to window of them
+        in flight, and yield their (status, payload) in the same order.
+        """
+        in_flight = []
+        for request in requests:
+            in_flight.append(self.submit(*request))
+            if len(in_flight) >= window:
+                yield self.result(in_flight.pop(0))
+        for req_id in in_flight:
+            yield self.result(req_id)
+
+    @staticmethod
+    def _check(reply, not_found=None):
+        """ Return the payload of an OK reply; raise on ERROR. """
+        (status, payload) = reply
+        if status == STATUS_OK:
+            return payload
+        if status == STATUS_NOT_FOUND:
+            return not_found
+        if status == STATUS_ERROR:
+            raise UpaxError(payload[0].bytes.decode('utf-8')
+                            if payload else 'error')
+        raise UpaxError("unexpected reply status '%s'" %
+                        status.decode('ascii', 'replace'))
+
+    @staticmethod
+    def _put_results(payload):
+        return [(int(payload[ndx].bytes), payload[ndx + 1].bytes.decode())
+                for ndx in range(0, len(payload), 2)]
+
+    # -- one request each --------------------------------------------
+
+    def put_data(self, data, key=None, source='', logged_path=POSTED_PATH):
+        """
+        Store data, under key if given, which it must hash to.  Returns
+        (len, hash), len being -1 if the key was already present.
+        """
+        payload = self._check(self.result(self.submit(
+            OP_PUT, (key or '').encode('ascii'), source.encode('utf-8'),
+            logged_path.encode('utf-8'), data)))
+        return self._put_results(payload)[0]
+
+    def get(self, key):
+        """ Return the data stored under the key, or None. """
+        payload = self._check(self.result(self.submit(
+            OP_GET, key.encode('ascii'))))
+        return None if payload is None else payload[0].bytes
+
+    def exists(self, key):
+        """ Return whether the key is stored. """
+        payload = self._check(self.result(self.submit(
+            OP_EXISTS, key.encode('ascii'))))
+        return payload[0].bytes == b'1'
+
+    def put_many(self, items, source='', logged_path=POSTED_PATH):
+        """
+        Store each (data, key) in items, key possibly None, in a single
+        request.  Returns a list of (len, hash) in the same order.
+        """
+        args = [source.encode('utf-8'), logged_path.encode('utf-8')]
+        for (data, key) in items:
+            args.extend([(key or '').encode('ascii'), data])
+        return self._put_results(self._check(self.result(
+            self.submit(OP_PUT_MANY, *args))))
+
+    def get_many(self, keys):
+        """
+        Return a list of the data stored under each of the keys, None
+        where absent, in a single request.
+        """
+        payload = self._check(self.result(self.submit(
+            OP_GET_MANY, *[key.encode('ascii') for key in keys])))
+        return [payload[ndx + 1].bytes if payload[ndx].bytes == b'1'
+                else None for ndx in range(0, len(payload), 2)]
+
+    def exists_many(self, keys):
+        """ Return a list of whether each of the keys is stored. """
+        payload = self._check(self.result(self.submit(
+            OP_EXISTS_MANY, *[key.encode('ascii') for key in keys])))
+        return [flag == ord('1') for flag in payload[0].bytes]
+
+    def ping(self):
+        """ Return whether the server answers. """
+        (status, _) = self.result(self.submit(OP_PING))
+        return status == STATUS_OK
+
+    def log_range(self, start=None, end=None, limit=None):
+        """
+        Return a list of the LogEntries with start <= timestamp < end,
+        at most limit of them, in timestamp order.
+        """
+        args = [b'' if arg is None else b'%d' % arg
+                for arg in (start, end, limit)]
+        payload = self._check(self.result(self.submit(OP_LOG, *args)))
+        return self._entry_lines(payload)
+
+    def log_from(self, seq, limit=None):
+        """
+        Return (next, total, entries): up to limit of the LogEntries
+        added to the server's log from position seq on, the position
+        after them, and the number of entries in the log.
+        """
+        payload = self._check(self.result(self.submit(
+            OP_LOG_FROM, b'%d' % seq,
+            b'' if limit is None else b'%d' % limit)))
+        return (int(payload[0].bytes), int(payload[1].bytes),
+                self._entry_lines(payload[2:]))
+
+    def get_stored_many(self, keys, window=WINDOW):
+        """
+        Return a list of each of the keys' objects as stored, None where
+        absent, keeping up to window requests in flight.
+        """
+        results = []
+        for reply in self.pipeline([(OP_GET_STORED, key.encode('ascii'))
+                                    for key in keys], window):
+            payload = self._check(reply)
+            results.append(None if payload is None else payload[0].bytes)
+        return results
+
+    def _entry_lines(self, payload):
+        entries = []
+        for line in payload[0].bytes.decode('utf-8').split('\n'):
+            entry = parse_entry_line(line, self._hashtype)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    @staticmethod
+    def _tree_result(payload):
+        children = payload[2].bytes
+        size = len(children) // 16
+        return (int(payload[0].bytes), payload[1].bytes,
+                [children[ndx:ndx + size]
+                 for ndx in range(0, len(children), size)])
+
+    def tree(self, prefix=''):
+        """
+        Return (depth, hash, child hashes) for the node named by the key
+        prefix in the summary of the server's log; see upax.merkle.
+        """
+        return self._tree_result(self._check(self.result(self.submit(
+            OP_TREE, prefix.encode('ascii')))))
+
+    def trees(self, prefixes):
+        """ Return what tree() would for each prefix, pipelined. """
+        return [self._tree_result(self._check(reply)) for reply in
+                self.pipeline([(OP_TREE, prefix.encode('ascii'))
+                               for prefix in prefixes])]
+
+    def bucket_entries(self, prefixes):
+        """
+        Return a list of the LogEntries in the server's summary bucket
+        named by each prefix, pipelined.
+        """
+        return [self._entry_lines(self._check(reply)) for reply in
+                self.pipeline([(OP_ENTRIES, prefix.encode('ascii'))
+                               for prefix in prefixes])]
+
+    def add_entries(self, entries):
+        """
+        Add to the server's log those of the LogEntries it lacks,
+        returning their number.
+        """
+        lines = ''.join(str(entry) for entry in entries)
+        payload = self._check(self.result(self.submit(
+            OP_ADD_ENTRIES, lines.encode('utf-8'))))
+        return int(payload[0].bytes)
+
+    def close(self):
+        """ Close the socket, abandoning any replies not yet received. """
+        self._socket.close()
@@ -0,0 +1,57 @@
+# store_util.py
+
+""" Scratch stores for the tests. """
+
+import os
+import time
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+__all__ = ['DATA_PATH', 'new_u_path', 'new_server', 'put_some', ]
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+
+
+def new_u_path():
+    """ Return the path to a uDir under DATA_PATH which does not exist. """
+    u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+    while os.path.exists(u_path):
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+    return u_path
+
+
+def new_server(test, hashtype=HashTypes.SHA2, **kwargs):
+    """
+    Return a BlockingServer, configured by kwargs, on a new uDir.  It is
+    closed when test, a unittest.TestCase, has finished.
+    """
+    server = BlockingServer(new_u_path(), hashtype, **kwargs)
+    test.addCleanup(server.close)
+    return server
+
+
+def put_some(servers, count, size=2048, source='test', lock=None):
+    """
+    Store count random objects of up to size bytes in each of servers, a
+    Server or a list of them, holding lock if it is given.  Returns the
+    objects' keys.
+    """
+    if not isinstance(servers, (list, tuple)):
+        servers = [servers]
+    keys = []
+    for _ in range(count):
+        data = bytes(RNG.some_bytes(16 + RNG.next_int16(size)))
+        key = hash_hex(data, servers[0].hashtype)
+        for server in servers:
+            if lock is None:
+                server.put_data(data, key, source, 'z@' + key[:8])
+            else:
+                with lock:
+                    server.put_data(data, key, source, 'z@' + key[:8])
+        keys.append(key)
+    return keys
@@ -7,7 +7,10 @@ import time
 import unittest
 from xlattice import HashTypes, check_hashtype
 
-from upax.ftlog import BoundLog, FileReader, LogEntry, StringReader
+from upax import UpaxError
+from upax.ftlog import (BoundLog, FileReader, LogEntry, LogFollower,
+                        StringReader, convert_log, recover_tail,
+                        LOG_FORMAT_TEXT, LOG_FORMAT_BINARY)
 
 
 class TestBoundLog(unittest.TestCase):
@@ -244,6 +247,217 @@ class TestBoundLog(unittest.TestCase):
         for hashtype in HashTypes:
             self.do_test_with_opens_and_closes(hashtype)
 
+    def do_test_follower(self, hashtype):
+
+        check_hashtype(hashtype)
+        (_, _, goodkey_3, goodkey_4,
+         goodkey_5, goodkey_6, goodkey_7, goodkey_8,) = self.get_good(hashtype)
+
+        (_, time1, time2, time3, entry1, entry2, entry3, empty_log,
+         _) = self.setup_the_server(hashtype)
+        reader = StringReader(empty_log, hashtype)
+        log = BoundLog(reader, hashtype, self.u_dir, 'L')
+        log.add_entry(time1, goodkey_3, goodkey_4, 'jdd', 'e@document1')
+
+        from_start = log.follower(from_start=True)
+        at_end = log.follower()
+        self.assertEqual([entry1], from_start.poll())
+        self.assertEqual([], at_end.poll())
+
+        log.add_entry(time2, goodkey_5, goodkey_6, 'jdd', 'e@document2')
+        log.add_entry(time3, goodkey_7, goodkey_8, 'jdd', 'e@document3')
+        log.flush()
+        self.assertEqual([entry2], at_end.poll(max_entries=1))
+        self.assertEqual([entry3], at_end.poll())
+        self.assertEqual(2, at_end.seq)
+        self.assertEqual([entry2, entry3], from_start.poll())
+
+        # a saved offset resumes where the old follower stopped
+        offset = at_end.offset
+        self.assertEqual(log.end_offset, offset)
+        log.close()
+        resumed = LogFollower(self.path_to_log, hashtype, offset)
+        self.assertEqual([], resumed.poll())
+
+        # a partially written line is not returned until it is complete
+        line = str(LogEntry(time3 + 1, goodkey_3, goodkey_8, 'jdd', 'e@x'))
+        with open(self.path_to_log, 'a') as file:
+            file.write(line[:20])
+        self.assertEqual([], resumed.poll())
+        self.assertEqual(offset, resumed.offset)
+        with open(self.path_to_log, 'a') as file:
+            file.write(line[20:])
+        self.assertEqual(1, len(resumed.poll()))
+
+    def test_follower(self):
+        for hashtype in HashTypes:
+            self.do_test_follower(hashtype)
+
+    def do_test_binary_log(self, hashtype):
+
+        check_hashtype(hashtype)
+        (goodkey_1, goodkey_2, goodkey_3, _,
+         _, goodkey_6, _, _,) = self.get_good(hashtype)
+
+        (time0, _, _, time3, entry1, entry2, entry3, empty_log,
+         log_w_three) = self.setup_the_server(hashtype)
+        reader = StringReader(log_w_three, hashtype)
+        log = BoundLog(reader, hashtype, self.u_dir, 'L',
+                       log_format=LOG_FORMAT_BINARY)
+        self.assertEqual(LOG_FORMAT_BINARY, log.log_format)
+        follower = log.follower(from_start=True)
+        entry4 = log.add_entry(time3 + 1, goodkey_3, goodkey_6, 'jdd',
+                               'e@document4')
+        log.close()
+        with open(self.path_to_log, 'rb') as file:
+            data = file.read()
+        self.assertNotEqual(log_w_three.encode('utf-8'), data)
+        self.assertEqual([entry1, entry2, entry3, entry4], follower.poll())
+
+        # the format is recognized from the header on reopening
+        reader = FileReader(self.u_dir, hashtype)
+        self.assertEqual(LOG_FORMAT_BINARY, reader.log_format)
+        log = BoundLog(reader, hashtype)
+        self.assertEqual(LOG_FORMAT_BINARY, log.log_format)
+        self.assertEqual(time0, log.timestamp)
+        self.assertEqual(goodkey_1, log.prev_hash)
+        self.assertEqual(goodkey_2, log.prev_master)
+        self.assertEqual([entry1, entry2, entry3, entry4], log.entries)
+        self.assertEqual(entry4, log.get_entry(goodkey_3))
+        log.close()
+
+        # lossless conversion in both directions
+        self.assertFalse(convert_log(self.u_dir, hashtype, LOG_FORMAT_BINARY))
+        self.assertTrue(convert_log(self.u_dir, hashtype, LOG_FORMAT_TEXT))
+        with open(self.path_to_log, 'r') as file:
+            self.assertEqual(log_w_three + str(entry4), file.read())
+        self.assertTrue(convert_log(self.u_dir, hashtype, LOG_FORMAT_BINARY))
+        with open(self.path_to_log, 'rb') as file:
+            self.assertEqual(data, file.read())
+
+        # a damaged record is detected
+        with open(self.path_to_log, 'r+b') as file:
+            file.seek(-8, os.SEEK_END)
+            file.write(b'X')
+        self.assertRaises(UpaxError, BoundLog,
+                          FileReader(self.u_dir, hashtype), hashtype)
+
+        # text which can't be converted losslessly is left alone
+        with open(self.path_to_log, 'w') as file:
+            file.write(empty_log + '# a comment\n')
+        self.assertRaises(UpaxError, convert_log, self.u_dir, hashtype,
+                          LOG_FORMAT_BINARY)
+        with open(self.path_to_log, 'r') as file:
+            self.assertEqual(empty_log + '# a comment\n', file.read())
+
+    def test_binary_log(self):
+        for hashtype in HashTypes:
+            self.do_test_binary_log(hashtype)
+
+    def do_test_add_entries(self, hashtype, log_format):
+
+        check_hashtype(hashtype)
+        (_, _, goodkey_3, goodkey_4,
+         goodkey_5, goodkey_6, _, _,) = self.get_good(hashtype)
+        (_, _, _, time3, entry1, entry2, entry3, _,
+         log_w_three) = self.setup_the_server(hashtype)
+        log = BoundLog(StringReader(log_w_three, hashtype), hashtype,
+                       self.u_dir, 'L', log_format=log_format)
+        added = log.add_entries([
+            (time3 + 1, goodkey_3, goodkey_4, 'jdd', 'e@document4'),
+            (time3 + 2, goodkey_5, goodkey_6, 'jdd', 'e@document5'), ])
+        self.assertEqual(5, len(log))
+        self.assertEqual(added, log.entries[3:])
+        log.close()
+        log = BoundLog(FileReader(self.u_dir, hashtype), hashtype)
+        self.assertEqual([entry1, entry2, entry3] + added, log.entries)
+        log.close()
+
+    def test_add_entries(self):
+        for hashtype in HashTypes:
+            for log_format in (LOG_FORMAT_TEXT, LOG_FORMAT_BINARY):
+                self.do_test_add_entries(hashtype, log_format)
+
+    def do_test_recover_tail(self, hashtype, log_format):
+
+        check_hashtype(hashtype)
+        (_, _, goodkey_3, _, _, goodkey_6, _, _,) = self.get_good(hashtype)
+        (_, _, _, time3, entry1, entry2, entry3, _,
+         log_w_three) = self.setup_the_server(hashtype)
+
+        for name in os.listdir(self.u_dir):
+            if name.startswith('L.torn.'):
+                os.remove(os.path.join(self.u_dir, name))
+        log = BoundLog(StringReader(log_w_three, hashtype), hashtype,
+                       self.u_dir, 'L', log_format=log_format)
+        log.close()
+        with open(self.path_to_log, 'rb') as file:
+            intact = file.read()
+
+        # an intact log is left alone
+        report = recover_tail(self.u_dir, hashtype)
+        self.assertTrue(report.clean)
+        self.assertEqual(len(intact), report.truncated_at)
+
+        # simulate a crash part way through appending a fourth entry
+        log = BoundLog(FileReader(self.u_dir, hashtype), hashtype)
+        log.add_entry(time3 + 1, goodkey_3, goodkey_6, 'jdd', 'e@document4')
+        log.close()
+        with open(self.path_to_log, 'rb') as file:
+            whole = file.read()
+        torn = whole[:len(intact) + (len(whole) - len(intact)) // 2]
+        with open(self.path_to_log, 'wb') as file:
+            file.write(torn)
+        self.assertRaises(UpaxError, FileReader(self.u_dir, hashtype).read)
+
+        # the tail window is much smaller than the log: only the end is read
+        report = recover_tail(self.u_dir, hashtype, window=400)
+        self.assertFalse(report.clean)
+        self.assertEqual(len(torn), report.log_size)
+        self.assertEqual(len(intact), report.truncated_at)
+        self.assertEqual(torn[len(intact):], report.dropped)
+        with open(report.quarantine_path, 'rb') as file:
+            self.assertEqual(report.dropped, file.read())
+        with open(self.path_to_log, 'rb') as file:
+            self.assertEqual(intact, file.read())
+
+        log = BoundLog(FileReader(self.u_dir, hashtype), hashtype)
+        self.assertEqual([entry1, entry2, entry3], log.entries)
+        log.close()
+
+        # a log of another hash type is refused, not emptied
+        other = HashTypes.SHA2 if hashtype == HashTypes.SHA1 \
+            else HashTypes.SHA1
+        self.assertRaises(UpaxError, recover_tail, self.u_dir, other)
+        self.assertRaises(UpaxError, recover_tail, self.u_dir, other,
+                          'L', True, 16)
+        with open(self.path_to_log, 'rb') as file:
+            self.assertEqual(intact, file.read())
+
+        # so is a log damaged before its last record
+        if log_format == LOG_FORMAT_TEXT:
+            where = intact.index(entry2.key.encode('ascii'))
+        else:
+            where = intact.index(bytes.fromhex(entry2.key))
+        damaged = intact[:where] + b'z' + intact[where + 1:]
+        for tail in (b'', whole[len(intact):len(torn)]):
+            with open(self.path_to_log, 'wb') as file:
+                file.write(damaged + tail)
+            self.assertRaises(UpaxError, recover_tail, self.u_dir, hashtype)
+            with open(self.path_to_log, 'rb') as file:
+                self.assertEqual(damaged + tail, file.read())
+
+        # damage reaching back past the window is reported, not repaired
+        with open(self.path_to_log, 'wb') as file:
+            file.write(intact[:-1] + b'?' * 32)
+        self.assertRaises(UpaxError, recover_tail, self.u_dir, hashtype,
+                          'L', True, 16)
+
+    def test_recover_tail(self):
+        for hashtype in HashTypes:
+            for log_format in [LOG_FORMAT_TEXT, LOG_FORMAT_BINARY]:
+                self.do_test_recover_tail(hashtype, log_format)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# testChunker.py
+
+""" Test content-defined chunking and chunk manifests. """
+
+import io
+import time
+import unittest
+
+import rnglib
+from upax import UpaxError, chunker
+from upax.chunker import (chunk_stream, encode_manifest, decode_manifest,
+                          manifest_hex, ChunkedReader)
+from upax.codec import is_manifest, decode
+from upax.hashing import hash_hex
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+# small chunks keep the tests fast
+MIN, AVG, MAX = 1024, 4096, 16 * 1024
+
+
+def chunks_of(data):
+    """ Return the list of chunks data divides into. """
+    return list(chunk_stream(io.BytesIO(data), MIN, AVG, MAX))
+
+
+class TestChunker(unittest.TestCase):
+    """ Test content-defined chunking and chunk manifests. """
+
+    def test_chunk_sizes(self):
+        """ Chunks cover the data and respect the size limits. """
+        data = bytes(RNG.some_bytes(256 * 1024))
+        chunks = chunks_of(data)
+        self.assertEqual(data, b''.join(chunks))
+        self.assertTrue(len(chunks) > 16)
+        for chunk in chunks[:-1]:
+            self.assertTrue(MIN < len(chunk) <= MAX)
+        self.assertEqual([], chunks_of(b''))
+        self.assertEqual([b'abc'], chunks_of(b'abc'))
+        # runs of one byte value are cut at max_size
+        self.assertEqual([MAX, MAX], [len(c) for c in chunks_of(
+            bytes(2 * MAX))])
+        with self.assertRaises(UpaxError):
+            list(chunk_stream(io.BytesIO(data), MIN, 3000, MAX))
+
+    def test_boundaries_are_stable(self):
+        """ An insertion changes only the chunks near it. """
+        data = bytes(RNG.some_bytes(256 * 1024))
+        where = len(data) // 2
+        edited = data[:where] + b'a few inserted bytes' + data[where:]
+        before = set(chunks_of(data))
+        after = chunks_of(edited)
+        self.assertEqual(chunks_of(data), chunks_of(data))
+        changed = [chunk for chunk in after if chunk not in before]
+        self.assertTrue(0 < len(changed) <= 2)
+
+    def test_manifest(self):
+        """ Manifests round-trip and describe the data. """
+        for hashtype in HashTypes:
+            data = bytes(RNG.some_bytes(64 * 1024))
+            store = {}
+            chunks = []
+            for chunk in chunks_of(data):
+                key = hash_hex(chunk, hashtype)
+                store[key] = chunk
+                chunks.append((key, len(chunk)))
+            blob = encode_manifest(chunks, len(data))
+            self.assertTrue(is_manifest(blob))
+            self.assertEqual(chunks, decode_manifest(blob))
+            with self.assertRaises(UpaxError):
+                decode(blob)
+            self.assertEqual(hash_hex(data, hashtype),
+                             manifest_hex(blob, store.get, hashtype))
+            with ChunkedReader(chunks, store.get) as reader:
+                self.assertEqual(data[:100], reader.read(100))
+                self.assertEqual(data[100:], reader.read())
+                self.assertEqual(b'', reader.read())
+            del store[chunks[0][0]]
+            with self.assertRaises(UpaxError):
+                ChunkedReader(chunks, store.get).read()
+
+    @unittest.skipIf(chunker.numpy is None, "numpy is not installed")
+    def test_scans_agree(self):
+        """ Scanning with numpy finds the boundaries Python does. """
+        for (low, avg, high) in ((MIN, AVG, MAX), (chunker.MIN_CHUNK,
+                                                  chunker.AVG_CHUNK,
+                                                  chunker.MAX_CHUNK)):
+            mask = chunker._boundary_mask(avg)
+            for size in (low - 1, low, low + 1, high // 2, high, 2 * high):
+                for data in (bytearray(RNG.some_bytes(size)),
+                             bytearray(size)):
+                    self.assertEqual(
+                        chunker._py_find_cut(data, low, high, mask),
+                        chunker._np_find_cut(data, low, high, mask))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# testCodec.py
+
+""" Test compression of data stored in uDir. """
+
+import io
+import os
+import time
+import unittest
+
+import rnglib
+from upax import codec
+from upax.hashing import hash_hex
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+
+
+class TestCodec(unittest.TestCase):
+    """ Test compression of data stored in uDir. """
+
+    def setUp(self):
+        if not os.path.exists(DATA_PATH):
+            os.makedirs(DATA_PATH)
+
+    def tearDown(self):
+        pass
+
+    def test_choose_codec(self):
+        """ Only compressible data of some size should be compressed. """
+        text = b'abcdefgh' * 1024
+        self.assertEqual(codec.CODEC_GZIP, codec.choose_codec(text))
+        self.assertEqual(codec.CODEC_LZMA,
+                         codec.choose_codec(text, codec=codec.CODEC_LZMA))
+        self.assertEqual(codec.CODEC_NONE, codec.choose_codec(text[:64]))
+        noise = bytes(RNG.some_bytes(8192))
+        self.assertEqual(codec.CODEC_NONE, codec.choose_codec(noise))
+
+    def test_round_trip(self):
+        """ Data must survive encoding with each codec, whole or streamed. """
+        data = b'0123456789abcdef' * 4096 + bytes(RNG.some_bytes(1000))
+        for codec_ in codec.CODECS:
+            blob = codec.encode(data, codec_)
+            self.assertTrue(codec.is_encoded(blob))
+            self.assertEqual(data, codec.decode(blob))
+
+            path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+            with open(path, 'wb') as file:
+                self.assertEqual(len(data), codec.encode_file(
+                    io.BytesIO(data), file, codec_))
+            self.assertTrue(codec.is_encoded_file(path))
+            self.assertEqual(len(data), codec.raw_len(path))
+            with codec.open_decoded(path) as file:
+                self.assertEqual(data, file.read())
+            for hashtype in HashTypes:
+                self.assertEqual(hash_hex(data, hashtype),
+                                 codec.file_hex(path, hashtype))
+            os.remove(path)
+
+        # data without a header is returned unchanged
+        self.assertFalse(codec.is_encoded(data))
+        self.assertEqual(data, codec.decode(data))
+        self.assertTrue(codec.needs_header(codec.MAGIC + data))
+        self.assertFalse(codec.needs_header(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
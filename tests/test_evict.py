@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# testEvict.py
+
+""" Test quota-driven eviction. """
+
+import os
+import time
+import unittest
+
+import rnglib
+from upax.evict import POLICY_GDSF, read_evictions
+from upax.hashing import hash_hex
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+from store_util import new_u_path
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestEvict(unittest.TestCase):
+    """ Test quota-driven eviction. """
+
+    def make_data(self, count, size, hashtype):
+        """ Return a list of (key, data) for random data of the size. """
+        ret = []
+        for _ in range(count):
+            data = bytes(RNG.some_bytes(size))
+            ret.append((hash_hex(data, hashtype), data))
+        return ret
+
+    def test_lru(self):
+        """ The least recently used unpinned objects are evicted first. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        objects = self.make_data(16, 4096, hashtype)
+        server = BlockingServer(u_path, hashtype, quota=8 * 4096)
+        try:
+            server.evictor.pin(objects[0][0])
+            for (ndx, (key, data)) in enumerate(objects):
+                server.put_data(data, key, 'test')
+                if ndx < 4:
+                    # reading keeps these fresh
+                    for (old_key, _) in objects[1:ndx + 1]:
+                        self.assertIsNotNone(server.get(old_key))
+                self.assertTrue(server.evictor.used <= 8 * 4096)
+            present = [key for (key, _) in objects if server.exists(key)]
+            self.assertEqual(8, len(present))
+            self.assertTrue(objects[0][0] in present)           # pinned
+            self.assertTrue(objects[-1][0] in present)          # newest
+            evicted = read_evictions(u_path)
+            self.assertEqual(8, len(evicted))
+            for key in evicted:
+                self.assertFalse(server.exists(key))
+                self.assertTrue(key in server.log)
+        finally:
+            server.close()
+
+        # a new server takes over the accounts and the pins
+        server = BlockingServer(u_path, hashtype, quota=4 * 4096)
+        try:
+            self.assertEqual([objects[0][0]], server.evictor.pins)
+            self.assertEqual(8 * 4096, server.evictor.used)
+            server.put_data(b'one more', hash_hex(b'one more', hashtype),
+                            'test')
+            self.assertTrue(server.evictor.used <= 4 * 4096)
+            self.assertTrue(server.exists(objects[0][0]))
+        finally:
+            server.close()
+
+    def test_stream_packed(self):
+        """ Streaming a packed object keeps it fresh, as reading it does. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        objects = self.make_data(5, 1024, hashtype)
+        server = BlockingServer(u_path, hashtype, pack_threshold=4096,
+                                quota=4 * 1024)
+        try:
+            for (key, data) in objects[:4]:
+                server.put_data(data, key, 'test')
+            (oldest, data) = objects[0]
+            self.assertTrue(server.packs.exists(oldest))
+            stream = server.get_stream(oldest)
+            try:
+                self.assertEqual(data, stream.read())
+            finally:
+                stream.close()
+            # the next put evicts the least recently used, not the oldest
+            server.put_data(objects[4][1], objects[4][0], 'test')
+            self.assertTrue(server.exists(oldest))
+            self.assertFalse(server.exists(objects[1][0]))
+        finally:
+            server.close()
+
+    def test_gdsf(self):
+        """ GDSF evicts large, unpopular objects before small, popular. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        small = self.make_data(8, 1024, hashtype)
+        large = self.make_data(4, 16 * 1024, hashtype)
+        server = BlockingServer(u_path, hashtype, quota=64 * 1024,
+                                eviction_policy=POLICY_GDSF)
+        try:
+            for (key, data) in small + large[:3]:
+                server.put_data(data, key, 'test')
+            for (key, _) in small:
+                server.get(key)
+            server.put_data(large[3][1], large[3][0], 'test')
+            for (key, _) in small:
+                self.assertTrue(server.exists(key))
+            self.assertEqual(3, sum(1 for (key, _) in large
+                                    if server.exists(key)))
+        finally:
+            server.close()
+
+    def test_chunks(self):
+        """ Chunks shared by stored data survive its neighbours' eviction. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        data = bytes(RNG.some_bytes(1024 * 1024))
+        edited = data[:1000] + b'changed' + data[1000:]
+        first = hash_hex(data, hashtype)
+        second = hash_hex(edited, hashtype)
+        server = BlockingServer(u_path, hashtype, chunk_threshold=64 * 1024,
+                                quota=4 * 1024 * 1024)
+        try:
+            server.put_data(data, first, 'test')
+            server.put_data(edited, second, 'test')
+            used = server.evictor.used
+            self.assertTrue(used < 2 * len(data) - 512 * 1024)
+            gone = server.evictor.evict(first)
+            self.assertTrue(first in gone)
+            self.assertTrue(len(gone) <= 3)
+            self.assertEqual(edited, server.get(second))
+            server.evictor.evict(second)
+            self.assertEqual(0, server.evictor.used)
+        finally:
+            server.close()
+
+    def test_reput_after_delete(self):
+        """ Chunks orphaned by a delete are adopted again by a re-put. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        data = bytes(RNG.some_bytes(512 * 1024))
+        key = hash_hex(data, hashtype)
+        server = BlockingServer(u_path, hashtype, chunk_threshold=64 * 1024,
+                                quota=600 * 1024)
+        try:
+            server.put_data(data, key, 'test')
+            self.assertTrue(server.delete(key))
+            server.put_data(data, key, 'test')
+            server.evictor.pin(key)
+            # over quota: only the filler may go
+            for (f_key, filler) in self.make_data(2, 64 * 1024, hashtype):
+                server.put_data(filler, f_key, 'test')
+            self.assertEqual(data, server.get(key))
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,15 @@
 import os
 import time
 import unittest
+from unittest import mock
 import rnglib
 from xlattice import HashTypes, check_hashtype
 from xlu import(file_sha1hex, file_sha2hex, file_sha3hex, file_blake2b_hex)
 from upax import __version__
+from upax.hashing import hash_hex
 from upax.importer import Importer
 from upax.server import BlockingServer
+from upax.walker import load_object
 
 
 RNG = rnglib.SimpleRNG(time.time())
@@ -157,6 +160,40 @@ class TestImporter(unittest.TestCase):
         server2.close()
         self.assertTrue(os.path.exists(os.path.join(dest_path, 'L')))
 
+    def test_import_chunked(self):
+        """ Data stored in chunks is reassembled as it is imported. """
+        hashtype = HashTypes.SHA2
+        os.makedirs(DATA_PATH, exist_ok=True, mode=0o755)
+        src_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(src_path):
+            src_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        dest_path = src_path + '.dest'
+        data = bytes(RNG.some_bytes(512 * 1024))
+        key = hash_hex(data, hashtype)
+        server = BlockingServer(src_path, hashtype,
+                                chunk_threshold=64 * 1024)
+        try:
+            server.put_data(data, key, 'test')
+            self.assertTrue(len(server.chunk_keys(key)) > 1)
+        finally:
+            server.close()
+
+        # chunks are loaded one at a time, never the whole object
+        with mock.patch('upax.importer.load_object',
+                        wraps=load_object) as loader:
+            Importer(src_path, dest_path, 'testImport ' + __version__,
+                     hashtype).do_import_u_dir()
+        loaded = [args[1] for (args, _) in loader.call_args_list]
+        self.assertTrue(loaded)
+        self.assertFalse(key in loaded)
+        server = BlockingServer(dest_path, hashtype)
+        try:
+            self.assertEqual(data, server.get(key))
+            self.assertIsNone(server.chunk_keys(key))
+            self.assertIsNotNone(server.log.get_entry(key))
+        finally:
+            server.close()
+
     def test_import(self):
         os.makedirs(DATA_PATH, exist_ok=True, mode=0o755)
         for hashtype in HashTypes:
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# testIngest.py
+
+""" Test ingestion of files dropped into in/. """
+
+import os
+import time
+import unittest
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.ingest import Ingester
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+from store_util import new_u_path
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestIngest(unittest.TestCase):
+    """ Test ingestion of files dropped into in/. """
+
+    @staticmethod
+    def drop(server, name, data):
+        """ Drop a file into in/ as a producer should; return its inode. """
+        in_path = os.path.join(server.u_path, 'in')
+        tmp_path = os.path.join(in_path, '.' + name)
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.rename(tmp_path, os.path.join(in_path, name))
+        return os.stat(os.path.join(in_path, name)).st_ino
+
+    def do_test_ingest(self, hashtype, **kwargs):
+        """ Drain in/ into a server configured by kwargs. """
+        u_path = new_u_path()
+        server = BlockingServer(u_path, hashtype, **kwargs)
+        try:
+            objects = {}
+            inodes = {}
+            for ndx in range(40):
+                data = bytes(RNG.some_bytes(8192 + ndx))
+                key = hash_hex(data, hashtype)
+                objects[key] = data
+                inodes[key] = self.drop(server, 'file%02u' % ndx, data)
+            # a duplicate, a key already stored, and one not yet complete
+            dup_key = sorted(objects)[0]
+            self.drop(server, 'copy of first', objects[dup_key])
+            old = bytes(RNG.some_bytes(100))
+            server.put_data(old, hash_hex(old, hashtype), 'test')
+            self.drop(server, 'old', old)
+            with open(os.path.join(u_path, 'in', '.partial'), 'wb') as file:
+                file.write(b'not yet')
+            count = len(server.log)
+
+            ingester = Ingester(server, workers=3, batch_size=16)
+            try:
+                self.assertEqual(42, ingester.drain())
+            finally:
+                ingester.stop()
+            stats = ingester.stats
+            self.assertEqual(40, stats.ingested)
+            self.assertEqual(2, stats.duplicates)
+            self.assertEqual(0, stats.quarantined)
+            self.assertEqual(0, stats.queue_depth)
+            self.assertEqual(3, stats.batches)
+            self.assertTrue(stats.max_latency >= stats.mean_latency)
+            self.assertEqual(['.partial'],
+                             os.listdir(os.path.join(u_path, 'in')))
+            self.assertEqual(count + 40, len(server.log))
+            for (key, data) in objects.items():
+                self.assertEqual(data, server.get(key))
+                self.assertTrue(server.log.get_entry(key).path.startswith(
+                    'z@'))
+                if not kwargs:
+                    # renamed, not copied
+                    self.assertEqual(inodes[key], os.stat(
+                        server.u_dir.get_path_for_key(key)).st_ino)
+        finally:
+            server.close()
+
+    def test_ingest(self):
+        """ Test ingestion using the supported hash types. """
+        for hashtype in HashTypes:
+            self.do_test_ingest(hashtype)
+        self.do_test_ingest(HashTypes.SHA2, compress=True,
+                            pack_threshold=8200)
+
+    def test_background(self):
+        """ Files are picked up by the background thread. """
+        hashtype = HashTypes.SHA2
+        server = BlockingServer(new_u_path(), hashtype)
+        ingester = Ingester(server, interval=0.01)
+        try:
+            ingester.start()
+            data = bytes(RNG.some_bytes(1000))
+            self.drop(server, 'late', data)
+            key = hash_hex(data, hashtype)
+            for _ in range(500):
+                if ingester.stats.ingested:
+                    break
+                time.sleep(0.01)
+            ingester.stop()
+            self.assertEqual(data, server.get(key))
+        finally:
+            ingester.stop()
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# testKeyIndex.py
+
+""" Test the shared key index used by read-only Servers. """
+
+import os
+import unittest
+
+from upax import UpaxError
+from upax.ftlog import LOG_FORMAT_BINARY, convert_log
+from upax.hashing import hash_hex
+from upax.keyindex import KeyIndex, publish_index, INDEX_NAME
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+from store_util import new_u_path, put_some
+
+
+class TestKeyIndex(unittest.TestCase):
+    """ Test the shared key index used by read-only Servers. """
+
+    def setUp(self):
+        self.u_path = new_u_path()
+        self.closing = []
+
+    def tearDown(self):
+        for thing in reversed(self.closing):
+            thing.close()
+
+    def open_server(self, **kwargs):
+        """ Return a BlockingServer on the test's uDir. """
+        server = BlockingServer(self.u_path, HashTypes.SHA2, **kwargs)
+        self.closing.append(server)
+        return server
+
+    def check_entries(self, writer, reader, keys):
+        """ The reader finds what the writer logged and stored. """
+        for key in keys:
+            self.assertTrue(key in reader.log)
+            self.assertEqual(str(writer.log.get_entry(key)),
+                             str(reader.log.get_entry(key)))
+            self.assertEqual(key, hash_hex(reader.get(key),
+                                           HashTypes.SHA2))
+
+    def test_read_only(self):
+        """ A read-only Server shares the index and cannot write. """
+        writer = self.open_server()
+        keys = put_some(writer, 50)
+        key = sorted(keys)[10]
+        writer.put_data(writer.get(key), key, 'again', 'z@again')
+        log_path = os.path.join(self.u_path, 'L')
+        log_size = os.path.getsize(log_path)
+
+        reader = self.open_server(read_only=True)
+        self.assertTrue(reader.read_only)
+        self.assertTrue(isinstance(reader.log, KeyIndex))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.u_path, INDEX_NAME)))
+        self.assertEqual(50, len(reader.log))
+        self.assertEqual(log_size, reader.log.covered)
+        self.assertEqual('again', reader.log.get_entry(key).src)
+        self.check_entries(writer, reader, keys)
+        absent = hash_hex(b'absent', HashTypes.SHA2)
+        self.assertFalse(absent in reader.log)
+        self.assertIsNone(reader.log.get_entry(absent))
+        self.assertIsNone(reader.get(absent))
+
+        data = b'not to be stored'
+        self.assertRaises(UpaxError, reader.put_data, data,
+                          hash_hex(data, HashTypes.SHA2), 'test')
+        self.assertRaises(UpaxError, reader.delete, key)
+        self.assertTrue(writer.exists(key))
+        self.assertEqual(log_size, os.path.getsize(log_path))
+
+        # entries appended since the index was published
+        more = put_some(writer, 5)
+        self.assertFalse(sorted(more)[0] in reader.log)
+        self.assertEqual(5, reader.log.refresh())
+        self.assertEqual(55, len(reader.log))
+        self.check_entries(writer, reader, more)
+
+        # another reader maps the same index, reading only the tail
+        stat = os.stat(reader.log.path)
+        second = self.open_server(read_only=True)
+        self.assertEqual(stat.st_ino, os.stat(second.log.path).st_ino)
+        self.assertEqual(log_size, second.log.covered)
+        self.check_entries(writer, second, keys + more)
+
+        self.assertRaises(UpaxError, BlockingServer, new_u_path(),
+                          read_only=True)
+
+    def test_republish(self):
+        """ The index is published again as the tail grows. """
+        writer = self.open_server()
+        keys = put_some(writer, 10)
+        self.assertEqual(10, publish_index(self.u_path))
+        index = KeyIndex.open(self.u_path, max_tail=4)
+        self.closing.append(index)
+        covered = index.covered
+        keys += put_some(writer, 3)
+        self.assertEqual(3, index.refresh())
+        self.assertEqual(covered, index.covered)
+        keys += put_some(writer, 3)
+        self.assertEqual(3, index.refresh())
+        self.assertTrue(index.covered > covered)
+        self.assertEqual(16, len(index))
+        for key in keys:
+            self.assertEqual(str(writer.log.get_entry(key)),
+                             str(index.get_entry(key)))
+
+    def test_replaced(self):
+        """ An index of a log since replaced is published again. """
+        writer = self.open_server()
+        keys = put_some(writer, 20)
+        reader = self.open_server(read_only=True)
+        reader.close()
+        self.closing.remove(reader)
+        writer.close()
+        self.closing.remove(writer)
+        convert_log(self.u_path, HashTypes.SHA2, LOG_FORMAT_BINARY)
+
+        writer = self.open_server()
+        keys += put_some(writer, 5)
+        reader = self.open_server(read_only=True)
+        self.assertEqual(os.path.getsize(os.path.join(self.u_path, 'L')),
+                         reader.log.covered)
+        self.assertEqual(25, len(reader.log))
+        self.check_entries(writer, reader, keys)
+        more = put_some(writer, 3)
+        self.assertEqual(3, reader.log.refresh())
+        self.check_entries(writer, reader, more)
+
+
+if __name__ == '__main__':
+    unittest.main()
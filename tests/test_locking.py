@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# testLocking.py
+
+""" Test several processes writing to one uDir. """
+
+import multiprocessing
+import os
+import time
+import unittest
+
+import rnglib
+from upax.ftlog import (BoundLog, FileReader, Log, convert_log,
+                        LOG_FORMAT_BINARY, LOG_FORMAT_TEXT)
+from upax.hashing import hash_hex
+from upax.locking import FileLock
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+WRITERS = 4
+PUTS = 50
+
+
+def write_some(u_path, hashtype, writer):
+    """ Put PUTS objects, small and large, into the uDir. """
+    server = BlockingServer(u_path, hashtype, pack_threshold=1024)
+    try:
+        for ndx in range(PUTS):
+            data = b'writer %u object %u ' % (writer, ndx)
+            data *= 1 + (ndx % 3) * 50
+            server.put_data(data, hash_hex(data, hashtype), 'w%u' % writer)
+    finally:
+        server.close()
+
+
+class TestLocking(unittest.TestCase):
+    """ Test several processes writing to one uDir. """
+
+    def test_file_lock(self):
+        """ A FileLock may be taken again by the thread holding it. """
+        os.makedirs(DATA_PATH, exist_ok=True)
+        lock = FileLock(os.path.join(DATA_PATH, RNG.next_file_name(8)))
+        with lock:
+            with lock:
+                self.assertTrue(os.path.exists(lock.path))
+        with lock:
+            pass
+
+    def test_concurrent_writers(self):
+        """ Writers in several processes share the log and the packs. """
+        hashtype = HashTypes.SHA2
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        BlockingServer(u_path, hashtype).close()
+
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=write_some, args=(u_path, hashtype, n))
+                 for n in range(WRITERS)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            self.assertEqual(0, proc.exitcode)
+
+        log = BoundLog(FileReader(u_path, hashtype), hashtype)
+        try:
+            self.assertEqual(WRITERS * PUTS, len(log))
+        finally:
+            log.close()
+        server = BlockingServer(u_path, hashtype)
+        try:
+            for writer in range(WRITERS):
+                for ndx in range(PUTS):
+                    data = b'writer %u object %u ' % (writer, ndx)
+                    data *= 1 + (ndx % 3) * 50
+                    self.assertEqual(data,
+                                     server.get(hash_hex(data, hashtype)))
+            self.assertEqual([], server.packs.verify(hashtype))
+        finally:
+            server.close()
+
+    def test_rewrite_while_running(self):
+        """ A Server appends to L after it is converted underneath it. """
+        hashtype = HashTypes.SHA2
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        server = BlockingServer(u_path, hashtype)
+        keys = []
+        try:
+            for log_format in (LOG_FORMAT_BINARY, LOG_FORMAT_TEXT):
+                for ndx in range(3):
+                    data = b'format %u object %u' % (log_format, ndx)
+                    keys.append(hash_hex(data, hashtype))
+                    server.put_data(data, keys[-1], 'test')
+                self.assertTrue(convert_log(u_path, hashtype, log_format))
+                reader = FileReader(u_path, hashtype)
+                self.assertEqual(log_format, reader.log_format)
+                entries = Log(reader, hashtype).entries
+                self.assertEqual(keys, [e.key for e in entries])
+            data = b'after both'
+            keys.append(hash_hex(data, hashtype))
+            server.put_data(data, keys[-1], 'test')
+        finally:
+            server.close()
+        log = BoundLog(FileReader(u_path, hashtype), hashtype)
+        try:
+            self.assertEqual(keys, [e.key for e in log.entries])
+        finally:
+            log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 # testLog.py
 
+import io
 import time
 import unittest
 from xlattice import HashTypes, check_hashtype
@@ -213,6 +214,147 @@ class TestLog(unittest.TestCase):
         for hashtype in HashTypes:
             self.do_test_add_entry(hashtype)
 
+    # ---------------------------------------------------------------
+
+    def do_test_secondary_indexes(self, hashtype, secondary):
+        """
+        Check node_id, src, and path queries, whether the indexes are
+        built on load or on first use.
+        """
+        check_hashtype(hashtype)
+
+        (goodkey_1, goodkey_2, goodkey_3, goodkey_4,
+         goodkey_5, goodkey_6, goodkey_7, goodkey_8,) = self.get_good(hashtype)
+
+        time0 = int(time.time()) - 10000
+        time1 = time0 + 100
+        time2 = time1 + 100
+        time3 = time2 + 100
+
+        empty_log = "%013u %s %s\n" % (time0, goodkey_1, goodkey_2)
+        entry1 = LogEntry(time1, goodkey_3, goodkey_4, 'jdd', 'z@/a/b')
+        entry2 = LogEntry(time2, goodkey_5, goodkey_4, 'poster', 'z@/a/c')
+        test_log = empty_log + str(entry1) + str(entry2)
+
+        reader = StringReader(test_log, hashtype)
+        log = Log(reader, hashtype, secondary)
+        self.assertEqual(secondary, log.has_secondary_indexes)
+
+        # this one is added after load and must be indexed incrementally
+        entry3 = log.add_entry(time3, goodkey_7, goodkey_8, 'jdd', 'z@/b')
+        self.assertTrue(log.has_secondary_indexes or not secondary)
+
+        self.assertEqual([entry1, entry2], log.entries_by_node_id(goodkey_4))
+        self.assertEqual([entry3], log.entries_by_node_id(goodkey_8))
+        self.assertEqual([], log.entries_by_node_id(goodkey_6))
+        self.assertTrue(log.has_secondary_indexes)
+
+        self.assertEqual([entry1, entry3], log.entries_by_src('jdd'))
+        self.assertEqual([entry2], log.entries_by_src('poster'))
+
+        self.assertEqual([entry2], log.entries_by_path('z@/a/c'))
+        self.assertEqual([], log.entries_by_path('z@/a'))
+        self.assertEqual([entry1, entry2],
+                         log.entries_by_path_prefix('z@/a/'))
+        self.assertEqual([entry1, entry2, entry3],
+                         log.entries_by_path_prefix('z@/'))
+        self.assertEqual([], log.entries_by_path_prefix('y@'))
+
+        # a second entry for an existing path follows the first
+        entry4 = log.add_entry(time3 + 100, goodkey_5, goodkey_8,
+                               'jdd', 'z@/a/c')
+        self.assertEqual([entry2, entry4], log.entries_by_path('z@/a/c'))
+        self.assertEqual([entry1, entry3, entry4], log.entries_by_src('jdd'))
+
+    def test_secondary_indexes(self):
+        """ Test secondary indexes using supported SHA hash types. """
+        for hashtype in HashTypes:
+            self.do_test_secondary_indexes(hashtype, True)
+            self.do_test_secondary_indexes(hashtype, False)
+
+    # ---------------------------------------------------------------
+
+    def do_test_time_range(self, hashtype):
+        """ Check timestamp-range and sequence-cursor queries. """
+        check_hashtype(hashtype)
+
+        (goodkey_1, goodkey_2, goodkey_3, goodkey_4,
+         goodkey_5, goodkey_6, goodkey_7, goodkey_8,) = self.get_good(hashtype)
+
+        time0 = int(time.time()) - 10000
+        time1 = time0 + 100
+        time2 = time1 + 100
+        time3 = time2 + 100
+
+        empty_log = "%013u %s %s\n" % (time0, goodkey_1, goodkey_2)
+        entry1 = LogEntry(time1, goodkey_3, goodkey_4, 'jdd', 'document1')
+        entry3 = LogEntry(time3, goodkey_7, goodkey_8, 'jdd', 'document3')
+        reader = StringReader(empty_log + str(entry1) + str(entry3), hashtype)
+        log = Log(reader, hashtype)
+        cursor = len(log)
+
+        # out of order: must be placed between the other two
+        entry2 = log.add_entry(time2, goodkey_5, goodkey_6, 'jdd', 'document2')
+
+        self.assertEqual([entry1, entry2, entry3],
+                         list(log.entries_between()))
+        self.assertEqual([entry2, entry3], list(log.entries_since(time2)))
+        self.assertEqual([entry1, entry2],
+                         list(log.entries_between(time1, time3)))
+        self.assertEqual([], list(log.entries_between(time1 + 1, time2)))
+        self.assertEqual([], list(log.entries_since(time3 + 1)))
+
+        # the sequence cursor sees entries in the order they were added
+        self.assertEqual([entry2], list(log.entries_from(cursor)))
+        self.assertEqual([entry1, entry3, entry2], list(log.entries_from(0)))
+        self.assertEqual([], list(log.entries_from(len(log))))
+
+    def test_time_range(self):
+        """ Test timestamp-range queries using supported hash types. """
+        for hashtype in HashTypes:
+            self.do_test_time_range(hashtype)
+
+    # ---------------------------------------------------------------
+
+    def do_test_write_to(self, hashtype):
+        """ Check that streamed serialization matches the string form. """
+        check_hashtype(hashtype)
+
+        (goodkey_1, goodkey_2, goodkey_3, goodkey_4,
+         goodkey_5, goodkey_6, goodkey_7, goodkey_8,) = self.get_good(hashtype)
+
+        time0 = int(time.time()) - 10000
+        empty_log = "%013u %s %s\n" % (time0, goodkey_1, goodkey_2)
+        log = Log(StringReader(empty_log, hashtype), hashtype)
+        expected = empty_log
+        for ndx, (key, node_id) in enumerate(
+                [(goodkey_3, goodkey_4), (goodkey_5, goodkey_6),
+                 (goodkey_7, goodkey_8)]):
+            entry = log.add_entry(time0 + ndx, key, node_id, 'jdd',
+                                  'document%u' % ndx)
+            expected += str(entry)
+        self.assertEqual(expected, str(log))
+
+        # text and binary file-like objects, in chunks of two entries
+        text = io.StringIO()
+        log.write_to(text, chunk_size=2)
+        self.assertEqual(expected, text.getvalue())
+        binary = io.BytesIO()
+        log.write_to(binary, chunk_size=2)
+        self.assertEqual(expected.encode('utf-8'), binary.getvalue())
+        self.assertEqual(expected.encode('utf-8'), log.to_bytes())
+
+        # a bare callable receives the header and then each chunk
+        chunks = []
+        log.write_to(chunks.append, chunk_size=2)
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(expected, ''.join(chunks))
+
+    def test_write_to(self):
+        """ Test streamed serialization using supported hash types. """
+        for hashtype in HashTypes:
+            self.do_test_write_to(hashtype)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# testLogMerge.py
+
+""" Test per-writer logs and merging them. """
+
+import multiprocessing
+import os
+import time
+import unittest
+
+from upax.ftlog import FileReader, Log, LogEntry
+from upax.hashing import hash_hex
+from upax.logmerge import (compact_logs, merge_entries, merged_log,
+                           writer_log_name, writer_logs)
+from upax.server import BlockingServer
+from xlattice import HashTypes
+
+from store_util import new_u_path
+
+WRITERS = 4
+PUTS = 25
+
+
+def write_some(u_path, hashtype, writer):
+    """ Put PUTS objects into the uDir, logging them to a writer log. """
+    server = BlockingServer(u_path, hashtype, per_writer_log=True)
+    try:
+        for ndx in range(PUTS):
+            data = b'writer %u object %u' % (writer, ndx)
+            server.put_data(data, hash_hex(data, hashtype), 'w%u' % writer)
+        # every writer stores this; the races leave duplicates
+        data = b'common to all writers'
+        server.put_data(data, hash_hex(data, hashtype), 'common',
+                        'z@common')
+    finally:
+        server.close()
+
+
+class TestLogMerge(unittest.TestCase):
+    """ Test per-writer logs and merging them. """
+
+    def test_merge_entries(self):
+        """ Merging orders by timestamp, breaks ties, drops duplicates. """
+        hashtype = HashTypes.SHA2
+        node_a = '1' * 64
+        node_b = '2' * 64
+        key_x = 'a' * 64
+        key_y = 'b' * 64
+        first = [LogEntry(200, key_y, node_a, 'src', 'z@y'),
+                 LogEntry(100, key_x, node_a, 'src', 'z@x')]
+        second = [LogEntry(100, key_x, node_a, 'src', 'z@x'),
+                  LogEntry(200, key_x, node_b, 'src', 'z@x'),
+                  LogEntry(300, key_x, node_a, 'src', 'z@x')]
+        merged = merge_entries(first, second)
+        self.assertEqual(merged, merge_entries(second, first))
+        self.assertEqual(
+            [(e.timestamp, e.key, e.node_id) for e in merged],
+            [(100, key_x, node_a), (200, key_x, node_b),
+             (200, key_y, node_a)])
+
+    def test_merge_keeps_main(self):
+        """ Every entry of L is kept; writer entries already in L are not. """
+        node_a = '1' * 64
+        key_x = 'a' * 64
+        main = [LogEntry(100, key_x, node_a, 'src', 'z@x'),
+                LogEntry(300, key_x, node_a, 'src', 'z@x')]
+        writer = [LogEntry(100, key_x, node_a, 'src', 'z@x'),
+                  LogEntry(200, key_x, node_a, 'src', 'z@x')]
+        merged = merge_entries(writer, main=main)
+        self.assertEqual([100, 300], [e.timestamp for e in merged])
+        merged = merge_entries([LogEntry(400, key_x, node_a, 'src', 'z@x')],
+                               main=main)
+        self.assertEqual([100, 300, 400], [e.timestamp for e in merged])
+
+    def test_compact_keeps_relogged(self):
+        """ Compacting keeps a key logged again later from the same source. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        data = b'logged twice'
+        key = hash_hex(data, hashtype)
+        server = BlockingServer(u_path, hashtype)
+        try:
+            server.put_data(data, key, 'again', 'z@again')
+            time.sleep(0.01)
+            server.put_data(data, key, 'again', 'z@again')
+            stamps = [e.timestamp for e in server.log.entries]
+        finally:
+            server.close()
+        self.assertEqual(2, len(stamps))
+        self.assertTrue(stamps[0] < stamps[1])
+
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=write_some, args=(u_path, hashtype, 0))
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+        self.assertEqual(1, compact_logs(u_path, hashtype))
+
+        compacted = Log(FileReader(u_path, hashtype), hashtype)
+        self.assertEqual(PUTS + 3, len(compacted))
+        self.assertEqual([int(t) for t in stamps],
+                         [e.timestamp for e in compacted.entries
+                          if e.key == key])
+        self.assertEqual(int(stamps[1]), compacted.get_entry(key).timestamp)
+
+    def do_test_writers(self, hashtype):
+        u_path = new_u_path()
+        BlockingServer(u_path, hashtype).close()
+
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=write_some, args=(u_path, hashtype, n))
+                 for n in range(WRITERS)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+
+        names = writer_logs(u_path)
+        self.assertEqual(len(names), WRITERS)
+        for (name, pid) in names:
+            self.assertTrue(name.startswith('L.'))
+            self.assertTrue(name.endswith('.%u' % pid))
+        # nothing was appended to L itself
+        self.assertEqual(len(Log(FileReader(u_path, hashtype), hashtype)), 0)
+
+        log = merged_log(u_path, hashtype)
+        self.assertEqual(len(log), WRITERS * PUTS + 1)
+        stamps = [e.timestamp for e in log.entries]
+        self.assertEqual(stamps, sorted(stamps))
+        self.assertEqual(str(log), str(merged_log(u_path, hashtype)))
+
+        # a new writer sees the merged log
+        server = BlockingServer(u_path, hashtype, per_writer_log=True)
+        try:
+            self.assertEqual(len(server.log), WRITERS * PUTS + 1)
+            self.assertEqual(os.path.basename(server.log.path_to_log),
+                             writer_log_name(server.node_id))
+            data = b'written while compacting'
+            server.put_data(data, hash_hex(data, hashtype), 'late')
+
+            # the logs of exited writers are folded into L; the live
+            # writer's log is left alone
+            self.assertEqual(compact_logs(u_path, hashtype), WRITERS)
+            self.assertEqual(writer_logs(u_path),
+                             [(writer_log_name(server.node_id),
+                               os.getpid())])
+            compacted = Log(FileReader(u_path, hashtype), hashtype)
+            self.assertEqual(str(compacted), str(log))
+            self.assertEqual(len(merged_log(u_path, hashtype)),
+                             WRITERS * PUTS + 2)
+        finally:
+            server.close()
+
+        # an ordinary Server sees what was compacted into L
+        server = BlockingServer(u_path, hashtype)
+        try:
+            self.assertEqual(len(server.log), WRITERS * PUTS + 1)
+        finally:
+            server.close()
+
+    def test_writers(self):
+        """ Writers append to logs of their own, which are merged. """
+        for hashtype in HashTypes:
+            self.do_test_writers(hashtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
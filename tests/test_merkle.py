@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# testMerkle.py
+
+""" Test Merkle summaries of logs and anti-entropy sync between nodes. """
+
+import time
+import unittest
+
+import rnglib
+import zmq
+from upax import UpaxError
+from upax.hashing import hash_hex
+from upax.merkle import (KeySummary, LogSummary, differing_buckets,
+                         sync_log, EMPTY)
+from upax.zserver import ZClient, ZServer
+from xlattice import HashTypes
+
+from store_util import new_server, put_some
+
+CONTEXT = zmq.Context.instance()
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestMerkle(unittest.TestCase):
+    """ Test Merkle summaries of logs and anti-entropy sync. """
+
+    def setUp(self):
+        self.zservers = []
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for zserver in self.zservers:
+            zserver.close()
+
+    def serve(self, server):
+        """ Serve the store over inproc, returning a client for it. """
+        zserver = ZServer(server, 'inproc://%s' % RNG.next_file_name(16),
+                          CONTEXT)
+        zserver.start()
+        self.zservers.append(zserver)
+        client = ZClient(zserver.endpoint, HashTypes.SHA2, CONTEXT,
+                         timeout=5.0)
+        self.clients.append(client)
+        return (zserver, client)
+
+    @staticmethod
+    def lines(log):
+        """ Return the set of the log's entry lines. """
+        return set(str(entry) for entry in log.entries)
+
+    def test_summary(self):
+        """ The root depends on the entries, not the order of adding. """
+        first = new_server(self)
+        second = new_server(self)
+        self.assertEqual(EMPTY, LogSummary(first.log).root)
+        put_some(first, 50)
+        for entry in reversed(first.log.entries):
+            second.log.add_entry(entry.timestamp, entry.key, entry.node_id,
+                                 entry.src, entry.path)
+        summary = LogSummary(first.log, 2)
+        self.assertEqual(50, len(summary))
+        self.assertEqual(summary.root, LogSummary(second.log, 2).root)
+        self.assertNotEqual(summary.root, LogSummary(second.log).root)
+
+        # refresh() follows the log, and only changed nodes change
+        old = summary.children('')
+        (key,) = put_some(first, 1)
+        self.assertEqual(1, summary.refresh())
+        new = summary.children('')
+        changed = [ndx for ndx in range(16) if old[ndx] != new[ndx]]
+        self.assertEqual([int(key[0], 16)], changed)
+        self.assertEqual(key, summary.entries(key[:2])[-1].key)
+        for bad in ('abc', 'x', '0/'):
+            with self.assertRaises(UpaxError):
+                summary.node_hash(bad)
+
+    def test_key_summary(self):
+        """ Differing buckets hold exactly the keys not shared. """
+        keys = [hash_hex(b'%u' % ndx, HashTypes.SHA2) for ndx in range(1000)]
+        first = KeySummary(keys[:990])
+        second = KeySummary(keys[3:])
+        self.assertEqual(990, len(first))
+        only = set(keys[:3] + keys[990:])
+        buckets = differing_buckets(first, second)
+        self.assertEqual(sorted(set(key[:3] for key in only)), buckets)
+        found = set()
+        for prefix in buckets:
+            found.update(set(first.keys(prefix)) ^ set(second.keys(prefix)))
+        self.assertEqual(only, found)
+        for key in keys[990:]:
+            self.assertTrue(first.add(key))
+        for key in keys[:3]:
+            self.assertTrue(second.add(key))
+        self.assertEqual([], differing_buckets(first, second))
+        self.assertTrue(first.discard(keys[0]))
+        self.assertFalse(first.discard(keys[0]))
+        self.assertNotEqual(first.root, second.root)
+
+    def test_sync(self):
+        """ Divergent logs converge, exchanging only what differs. """
+        local = new_server(self)
+        remote = new_server(self)
+        (zserver, client) = self.serve(remote)
+        shared = put_some(local, 200)
+        for entry in local.log.entries:
+            remote.log.add_entry(entry.timestamp, entry.key, entry.node_id,
+                                 entry.src, entry.path)
+        put_some(local, 3, source='local')
+        put_some(remote, 2, source='remote')
+        self.assertEqual(len(shared), 200)
+
+        summary = LogSummary(local.log)
+        before = zserver.handled
+        self.assertEqual((2, 3), sync_log(local.log, client, summary))
+        # the root, at most one node per difference at each lower
+        # level, the differing buckets' entries, and one push
+        self.assertTrue(zserver.handled - before <=
+                        1 + 5 * summary.depth + 1)
+        self.assertEqual(self.lines(local.log), self.lines(remote.log))
+        self.assertEqual(205, len(local.log))
+
+        # the entries keep their timestamps, nodeIDs and sources
+        for entry in remote.log.entries:
+            if entry.src == 'remote':
+                self.assertEqual(str(entry),
+                                 str(local.log.get_entry(entry.key)))
+                self.assertEqual(remote.node_id, entry.node_id)
+
+        # logs which agree cost a single request
+        before = zserver.handled
+        self.assertEqual((0, 0), sync_log(local.log, client, summary))
+        self.assertEqual(1, zserver.handled - before)
+
+    def test_pull_only(self):
+        """ With push False, the peer is left as it was. """
+        local = new_server(self)
+        remote = new_server(self)
+        (_, client) = self.serve(remote)
+        put_some(local, 4)
+        put_some(remote, 5)
+        self.assertEqual((5, 0), sync_log(local.log, client, push=False))
+        self.assertEqual(9, len(local.log))
+        self.assertEqual(5, len(remote.log))
+        with self.assertRaises(UpaxError):
+            sync_log(local.log, client, LogSummary(local.log, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
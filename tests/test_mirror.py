@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# testMirror.py
+
+""" Test mirroring one content-keyed store into another. """
+
+import os
+import time
+import unittest
+from unittest import mock
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.mirror import Mirror, store_keys, PENDING_NAME, DONE_NAME
+from xlattice import HashTypes
+
+from store_util import new_server, put_some
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestMirror(unittest.TestCase):
+    """ Test mirroring one content-keyed store into another. """
+
+    def test_mirror(self):
+        """ Only what the destination lacks is found and copied. """
+        src = new_server(self, pack_threshold=512,
+                         chunk_threshold=64 * 1024)
+        dest = new_server(self)
+        shared = put_some([src, dest], 300)
+        only_src = put_some([src], 5)
+        put_some([dest], 2)
+        big = bytes(RNG.some_bytes(512 * 1024))
+        big_key = hash_hex(big, HashTypes.SHA2)
+        src.put_data(big, big_key, 'test', 'z@big')
+        c_keys = src.chunk_keys(big_key)
+        self.assertTrue(len(c_keys) > 1)
+        self.assertEqual(len(set(store_keys(src))), 306 + len(c_keys))
+
+        mirror = Mirror(src, dest)
+        missing = mirror.missing()
+        self.assertEqual(sorted(only_src + [big_key] + c_keys), missing)
+        self.assertEqual(len(missing), mirror.run())
+        self.assertEqual({}, mirror.failed)
+        for key in shared + only_src + [big_key]:
+            self.assertEqual(src.get(key), dest.get(key))
+        for key in missing:
+            self.assertEqual(str(src.log.get_entry(key)),
+                             str(dest.log.get_entry(key)))
+        self.assertFalse(os.path.exists(
+            os.path.join(dest.u_path, PENDING_NAME)))
+
+        # nothing is left to do
+        self.assertEqual([], mirror.missing())
+        self.assertEqual(0, mirror.run())
+
+    def test_resume(self):
+        """ An interrupted mirror resumes without summarizing again. """
+        src = new_server(self)
+        dest = new_server(self)
+        put_some([src, dest], 20)
+        keys = put_some([src], 8, 8192)
+        bad = sorted(keys)[3]
+        path = src.u_dir.get_path_for_key(bad)
+        stored = src.get_stored(bad)
+        with open(path, 'wb') as file:
+            file.write(b'not what the key says')
+
+        mirror = Mirror(src, dest, workers=3)
+        self.assertEqual(7, mirror.run())
+        self.assertEqual([bad], list(mirror.failed))
+        self.assertFalse(dest.exists(bad))
+        with open(os.path.join(dest.u_path, DONE_NAME)) as file:
+            self.assertEqual(7, len(file.read().split()))
+
+        # repaired, the object is copied by the next run
+        with open(path, 'wb') as file:
+            file.write(stored)
+        with mock.patch.object(Mirror, 'missing',
+                               side_effect=AssertionError('replanned')):
+            self.assertEqual(1, Mirror(src, dest).run())
+        self.assertEqual(src.get(bad), dest.get(bad))
+        self.assertFalse(os.path.exists(
+            os.path.join(dest.u_path, PENDING_NAME)))
+
+
+if __name__ == '__main__':
+    unittest.main()
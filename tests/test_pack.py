@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# testPack.py
+
+""" Test pack files for small objects. """
+
+import os
+import time
+import unittest
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.pack import PackStore
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+
+
+class TestPack(unittest.TestCase):
+    """ Test pack files for small objects. """
+
+    def setUp(self):
+        self.u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(self.u_path):
+            self.u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        os.makedirs(self.u_path)
+
+    def tearDown(self):
+        pass
+
+    def make_objects(self, count, hashtype):
+        """ Return a map key => data for some small random objects. """
+        objects = {}
+        while len(objects) < count:
+            data = bytes(RNG.some_bytes(1 + RNG.next_int16(1024)))
+            objects[hash_hex(data, hashtype)] = data
+        return objects
+
+    def test_put_get_delete(self):
+        """ Put, get, and delete objects, reopening the store between. """
+        hashtype = HashTypes.SHA2
+        objects = self.make_objects(64, hashtype)
+        # small packs, so that several are used
+        packs = PackStore(self.u_path, max_pack_size=8 * 1024)
+        for key, data in objects.items():
+            self.assertTrue(packs.put(key, data))
+            self.assertFalse(packs.put(key, data))
+        self.assertEqual(len(objects), len(packs))
+        self.assertTrue(len(os.listdir(packs.pack_path)) > 3)
+        for key, data in objects.items():
+            self.assertTrue(key in packs)
+            self.assertEqual(data, packs.get(key))
+        doomed = sorted(objects)[:16]
+        for key in doomed:
+            self.assertTrue(packs.delete(key))
+            self.assertFalse(packs.delete(key))
+        packs.close()
+
+        # simulate a crash while writing the index
+        index_path = os.path.join(self.u_path, 'packs', 'index')
+        with open(index_path, 'a') as file:
+            file.write('0123')
+
+        packs = PackStore(self.u_path, max_pack_size=8 * 1024)
+        self.assertEqual(len(objects) - len(doomed), len(packs))
+        for key, data in objects.items():
+            if key in doomed:
+                self.assertFalse(packs.exists(key))
+                self.assertIsNone(packs.get(key))
+            else:
+                self.assertEqual(data, packs.get(key))
+        self.assertEqual([], packs.verify(hashtype))
+
+        # repacking recovers the space used by deleted objects
+        self.assertTrue(packs.repack() > 0)
+        for key, data in objects.items():
+            if key not in doomed:
+                self.assertEqual(data, packs.get(key))
+        more = self.make_objects(4, hashtype)
+        for key, data in more.items():
+            packs.put(key, data)
+        packs.close()
+
+        packs = PackStore(self.u_path)
+        self.assertEqual(len(objects) - len(doomed) + len(more), len(packs))
+        for key, data in more.items():
+            self.assertEqual(data, packs.get(key))
+        self.assertEqual([], packs.verify(hashtype))
+        packs.close()
+
+    def test_shared(self):
+        """ A store sees what another sharing the packs puts and deletes. """
+        hashtype = HashTypes.SHA2
+        objects = self.make_objects(8, hashtype)
+        mine = PackStore(self.u_path)
+        theirs = PackStore(self.u_path)
+        try:
+            for key, data in objects.items():
+                self.assertTrue(theirs.put(key, data))
+                self.assertEqual(data, mine.get(key))
+            doomed = sorted(objects)[:4]
+            for key in doomed:
+                self.assertTrue(theirs.delete(key))
+                self.assertFalse(key in mine)
+                self.assertIsNone(mine.get(key))
+                self.assertIsNone(mine.length(key))
+                self.assertFalse(mine.delete(key))
+            self.assertEqual(len(objects) - len(doomed), len(mine))
+        finally:
+            mine.close()
+            theirs.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
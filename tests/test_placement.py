@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# testPlacement.py
+
+""" Test placing replicas of objects on a ring of local stores. """
+
+import os
+import time
+import unittest
+from unittest import mock
+
+import rnglib
+import zmq
+from upax import UpaxError
+from upax.hashing import hash_hex
+from upax.node import Peer, UpaxNode
+from upax.placement import Placement
+from upax.server import BlockingServer
+from upax.zserver import ZServer
+from xlattice import HashTypes
+
+CONTEXT = zmq.Context.instance()
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+RING_SIZE = 5
+
+
+class TestPlacement(unittest.TestCase):
+    """ Test placing replicas of objects on a ring of local stores. """
+
+    def setUp(self):
+        self.closing = []
+        self.servers = {}           # raw nodeID => Server
+        self.zservers = {}          # raw nodeID => ZServer
+        for ndx in range(RING_SIZE):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+            while os.path.exists(u_path):
+                u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+            server = BlockingServer(u_path, HashTypes.SHA2)
+            self.closing.append(server)
+            node_id = bytes.fromhex(server.node_id)
+            self.servers[node_id] = server
+            if ndx == 0:
+                # this node: its own store is used directly
+                self.node = UpaxNode(node_id)
+                self.node.peers.add(self.node)
+                continue
+            zserver = ZServer(server, 'inproc://%s' % RNG.next_file_name(16),
+                              CONTEXT)
+            zserver.start()
+            self.closing.append(zserver)
+            self.zservers[node_id] = zserver
+            peer = Peer(node_id, None)
+            peer.endpoints.append(zserver.endpoint)
+            peer.open_pool(context=CONTEXT, timeout=0.5)
+            self.closing.append(peer)
+            self.node.peers.add(peer)
+        self.local = self.node.node_id
+
+    def tearDown(self):
+        for thing in reversed(self.closing):
+            thing.close()
+
+    def new_placement(self, **kwargs):
+        """ Return a Placement for the node, closed after the test. """
+        placement = Placement(self.node,
+                              server=self.servers[self.local], **kwargs)
+        self.closing.append(placement)
+        return placement
+
+    @staticmethod
+    def some_data():
+        """ Return random data and its key. """
+        data = bytes(RNG.some_bytes(64 + RNG.next_int16(2048)))
+        return (data, hash_hex(data, HashTypes.SHA2))
+
+    def holders(self, key):
+        """ Return a sorted list of the nodeIDs of stores holding key. """
+        return sorted(n for (n, s) in self.servers.items() if s.exists(key))
+
+    def test_put_get(self):
+        """ Each object is stored on, and read from, its replicas. """
+        placement = self.new_placement()
+        self.assertEqual(3, placement.replicas)
+        self.assertEqual(2, placement.write_quorum)
+        keys = {}
+        for _ in range(40):
+            (data, key) = self.some_data()
+            self.assertEqual((len(data), key), placement.put_data(data))
+            keys[key] = data
+        placement.close()               # let the last puts finish
+
+        counts = dict.fromkeys(self.servers, 0)
+        for (key, data) in keys.items():
+            peers = placement.place(key)
+            self.assertEqual(self.node.peers.ring.lookup_n(key, 3),
+                             [p.node_id.hex() for p in peers])
+            self.assertEqual(sorted(p.node_id for p in peers),
+                             self.holders(key))
+            for peer in peers:
+                counts[peer.node_id] += 1
+            self.assertEqual(data, placement.get(key))
+            self.assertTrue(placement.exists(key))
+            self.assertTrue(all(placement.in_flight(p) == 0 for p in peers))
+        self.assertTrue(all(counts.values()))
+        absent = hash_hex(b'absent', HashTypes.SHA2)
+        self.assertIsNone(placement.get(absent))
+        self.assertFalse(placement.exists(absent))
+
+    def test_local_first(self):
+        """ Gets of keys held here do not go over the network. """
+        placement = self.new_placement()
+        (data, key) = self.some_data()
+        while self.local not in [p.node_id for p in placement.place(key)]:
+            (data, key) = self.some_data()
+        placement.put_data(data)
+        placement.close()
+        pools = [self.node.peers.by_id(n).pool for n in self.zservers]
+        with mock.patch.object(type(pools[0]), 'get',
+                               side_effect=AssertionError('remote get')):
+            self.assertEqual(data, placement.get(key))
+
+    def test_quorum(self):
+        """ Puts succeed while a quorum of replicas can be reached. """
+        down = sorted(self.zservers)[0]
+        self.zservers[down].stop()
+        (data, key) = self.some_data()
+        while down not in [p.node_id for p in
+                           self.node.peers.replicas(key, 3)]:
+            (data, key) = self.some_data()
+
+        strict = self.new_placement(write_quorum=3)
+        self.assertRaises(UpaxError, strict.put_data, data)
+        strict.close()
+
+        # the live replicas already hold it, so no new bytes are stored
+        placement = self.new_placement()
+        self.assertEqual(key, placement.put_data(data)[1])
+        placement.close()
+        self.assertEqual(2, len(self.holders(key)))
+        self.assertFalse(self.servers[down].exists(key))
+        self.assertEqual(data, placement.get(key))
+
+        self.assertRaises(UpaxError, Placement, self.node, 3, 4)
+        self.assertRaises(UpaxError, Placement, self.node, 0)
+        lonely = UpaxNode(bytes(RNG.some_bytes(32)))
+        self.assertRaises(UpaxError, Placement(lonely).put_data, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
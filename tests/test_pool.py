@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# testPool.py
+
+""" Test pooled, multiplexed connections to a peer. """
+
+import os
+import threading
+import time
+import unittest
+
+import rnglib
+import zmq
+from upax import UpaxError
+from upax.hashing import hash_hex
+from upax.node import Peer
+from upax.pool import ConnectionPool
+from upax.server import BlockingServer
+from upax.zserver import ZServer
+from xlattice import HashTypes
+
+CONTEXT = zmq.Context.instance()
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+COUNT = 200
+
+
+class TestPool(unittest.TestCase):
+    """ Test pooled, multiplexed connections to a peer. """
+
+    def setUp(self):
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        self.server = BlockingServer(u_path, HashTypes.SHA2)
+        self.endpoint = 'inproc://%s' % RNG.next_file_name(16)
+        self.zserver = ZServer(self.server, self.endpoint, CONTEXT)
+        self.zserver.start()
+        self.blobs = {}
+        for ndx in range(COUNT):
+            data = RNG.some_bytes(32 + ndx)
+            key = hash_hex(data, HashTypes.SHA2)
+            self.server.put_data(data, key, 'test')
+            self.blobs[key] = data
+
+    def tearDown(self):
+        self.zserver.close()
+        self.server.close()
+
+    def test_get_many(self):
+        """ Many gets share a few connections. """
+        pool = ConnectionPool([self.endpoint], max_connections=3,
+                              max_in_flight=16, context=CONTEXT)
+        try:
+            keys = list(self.blobs) + [hash_hex(b'absent', HashTypes.SHA2)]
+            self.assertEqual(pool.get_many(keys),
+                             [self.blobs.get(key) for key in keys])
+            self.assertLessEqual(pool.connects, 3)
+            self.assertEqual(len(pool.connections), pool.connects)
+            self.assertTrue(all(c.in_flight == 0 for c in pool.connections))
+            self.assertEqual(pool.check(), pool.connects)
+        finally:
+            pool.close()
+
+    def test_threads(self):
+        """ Requests from several threads are multiplexed. """
+        pool = ConnectionPool([self.endpoint], max_connections=2,
+                              max_in_flight=8, context=CONTEXT)
+        keys = list(self.blobs)
+        errors = []
+
+        def fetch(start):
+            for key in keys[start::8]:
+                if pool.get(key) != self.blobs[key]:
+                    errors.append(key)
+
+        try:
+            threads = [threading.Thread(target=fetch, args=(n,))
+                       for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertLessEqual(pool.connects, 2)
+            self.assertEqual(self.zserver.handled, len(keys))
+        finally:
+            pool.close()
+
+    def test_failure(self):
+        """ A connection which stops answering is replaced. """
+        pool = ConnectionPool([self.endpoint], timeout=0.3, context=CONTEXT)
+        try:
+            key = next(iter(self.blobs))
+            self.assertTrue(pool.exists(key))
+            self.zserver.close()
+            with self.assertRaises(UpaxError):
+                pool.get(key)
+            self.assertGreater(pool.failures, 0)
+
+            self.zserver = ZServer(self.server, self.endpoint, CONTEXT)
+            self.zserver.start()
+            self.assertEqual(pool.get(key), self.blobs[key])
+        finally:
+            pool.close()
+
+    def test_peer(self):
+        """ A Peer opens its pool on first use. """
+        peer = Peer(bytes(32), None, HashTypes.SHA2)
+        self.assertEqual(peer.cnx, [])
+        peer.endpoints.append(self.endpoint)
+        peer.open_pool(context=CONTEXT)
+        try:
+            data = b'posted through a peer'
+            key = hash_hex(data, HashTypes.SHA2)
+            self.assertEqual(peer.pool.put_data(data), (len(data), key))
+            self.assertEqual(peer.pool.get(key), data)
+            self.assertEqual(len(peer.cnx), 1)
+        finally:
+            peer.close()
+        self.assertEqual(peer.cnx, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# testRegistry.py
+
+""" Test the registry of the Peers a node knows. """
+
+import hashlib
+import time
+import unittest
+
+import rnglib
+from upax import UpaxError
+from upax.node import Peer, UpaxNode
+from upax.registry import PeerRegistry
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+def new_peer(hashtype=HashTypes.SHA2):
+    """ Return a Peer with a random nodeID. """
+    length = 20 if hashtype == HashTypes.SHA1 else 32
+    return Peer(bytes(RNG.some_bytes(length)), None, hashtype)
+
+
+class TestRegistry(unittest.TestCase):
+    """ Test the registry of the Peers a node knows. """
+
+    def test_lookup(self):
+        """ Peers are found every way they are indexed. """
+        registry = PeerRegistry()
+        peers = [new_peer() for _ in range(8)]
+        for (ndx, peer) in enumerate(peers):
+            peer.ip_addr.append('10.0.0.%u' % ndx)
+            peer.fqdn.append('Node%u.example.com' % ndx)
+            self.assertIs(peer, registry.add(peer))
+        self.assertEqual(8, len(registry))
+        self.assertEqual(sorted(p.node_id for p in peers), registry.ids)
+        self.assertEqual(registry.ids, [p.node_id for p in registry])
+        for (ndx, peer) in enumerate(peers):
+            self.assertEqual(ndx, peer.node_ndx)
+            self.assertTrue(peer.node_id in registry)
+            self.assertTrue(peer.node_id.hex() in registry)
+            self.assertIs(peer, registry.by_id(peer.node_id))
+            self.assertIs(peer, registry.by_id(peer.node_id.hex().upper()))
+            self.assertIs(peer, registry.by_ndx(ndx))
+            self.assertIs(peer, registry.by_ip('10.0.0.%u' % ndx))
+            self.assertIs(peer, registry.by_ip(0x0a000000 + ndx))
+            self.assertIs(peer, registry.by_fqdn('node%u.EXAMPLE.com' % ndx))
+        self.assertIsNone(registry.by_id(new_peer().node_id))
+        self.assertIsNone(registry.by_ndx(8))
+        self.assertIsNone(registry.by_ip('10.0.1.0'))
+        self.assertIsNone(registry.by_fqdn('nowhere.example.com'))
+        self.assertRaises(UpaxError, registry.by_ip, '10.0.0.256')
+        self.assertRaises(UpaxError, registry.by_id, 'not hex')
+
+    def test_uniqueness(self):
+        """ No two Peers may share a nodeID, index, address or name. """
+        registry = PeerRegistry()
+        first = new_peer()
+        first.node_ndx = 5
+        first.ip_addr.append('192.168.1.1')
+        first.fqdn.append('first.example.com')
+        registry.add(first)
+
+        same_id = Peer(first.node_id, None)
+        self.assertRaises(UpaxError, registry.add, same_id)
+        same_ndx = new_peer()
+        same_ndx.node_ndx = 5
+        self.assertRaises(UpaxError, registry.add, same_ndx)
+        same_ip = new_peer()
+        same_ip.ip_addr.append(0xc0a80101)
+        self.assertRaises(UpaxError, registry.add, same_ip)
+        same_name = new_peer()
+        same_name.fqdn.append('FIRST.example.com')
+        self.assertRaises(UpaxError, registry.add, same_name)
+        self.assertRaises(UpaxError, registry.add,
+                          new_peer(HashTypes.SHA1))
+        self.assertEqual(1, len(registry))
+        self.assertIsNone(same_ip.node_ndx)
+
+        # free indexes are given out around those already taken
+        others = [registry.add(new_peer()) for _ in range(7)]
+        self.assertEqual([0, 1, 2, 3, 4, 6, 7],
+                         [p.node_ndx for p in others])
+
+    def test_remove_update(self):
+        """ Removed Peers leave no trace; updates reindex addresses. """
+        registry = PeerRegistry()
+        peer = new_peer()
+        peer.ip_addr.append('10.1.1.1')
+        peer.fqdn.append('a.example.com')
+        registry.add(peer)
+        other = new_peer()
+        other.ip_addr.append('10.2.2.2')
+        registry.add(other)
+
+        peer.ip_addr[0] = '10.1.1.2'
+        peer.fqdn.append('b.example.com')
+        registry.update(peer)
+        self.assertIsNone(registry.by_ip('10.1.1.1'))
+        self.assertIs(peer, registry.by_ip('10.1.1.2'))
+        self.assertIs(peer, registry.by_fqdn('a.example.com'))
+        self.assertIs(peer, registry.by_fqdn('b.example.com'))
+
+        # a clash leaves the old addresses indexed
+        peer.ip_addr.append('10.2.2.2')
+        self.assertRaises(UpaxError, registry.update, peer)
+        self.assertIs(peer, registry.by_ip('10.1.1.2'))
+        self.assertIs(other, registry.by_ip('10.2.2.2'))
+        peer.ip_addr.pop()
+
+        self.assertIs(peer, registry.remove(peer.node_id.hex()))
+        self.assertRaises(UpaxError, registry.remove, peer.node_id)
+        self.assertRaises(UpaxError, registry.update, peer)
+        self.assertFalse(peer.node_id in registry)
+        self.assertIsNone(registry.by_ndx(peer.node_ndx))
+        self.assertIsNone(registry.by_ip('10.1.1.2'))
+        self.assertIsNone(registry.by_fqdn('a.example.com'))
+        self.assertEqual([other.node_id.hex()], registry.ring.members)
+
+    def test_replicas(self):
+        """ Replicas are the Peers the ring places a key on. """
+        registry = PeerRegistry()
+        for _ in range(6):
+            registry.add(new_peer())
+        for count in range(1, 200):
+            key = hashlib.sha256(b'%u' % count).hexdigest()
+            replicas = registry.replicas(key, 3)
+            self.assertEqual(3, len(replicas))
+            self.assertEqual(3, len(set(p.node_id for p in replicas)))
+            self.assertEqual(registry.ring.lookup(key),
+                             replicas[0].node_id.hex())
+        self.assertEqual(6, len(registry.replicas(key, 10)))
+
+    def test_node(self):
+        """ A node keeps its Peers in a registry. """
+        node = UpaxNode(bytes(RNG.some_bytes(32)))
+        self.assertTrue(isinstance(node.peers, PeerRegistry))
+        self.assertEqual(0, len(node.peers))
+
+
+if __name__ == '__main__':
+    unittest.main()
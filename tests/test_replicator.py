@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# testReplicator.py
+
+""" Test pull replication of one store's log and objects into another. """
+
+import os
+import threading
+import time
+import unittest
+
+import rnglib
+import zmq
+from upax.hashing import hash_hex
+from upax.replicator import LocalSource, Replicator, ZSource
+from upax.zserver import ZClient, ZServer
+from xlattice import HashTypes
+
+from store_util import new_server, put_some
+
+CONTEXT = zmq.Context.instance()
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestReplicator(unittest.TestCase):
+    """ Test pull replication of one store into another. """
+
+    def setUp(self):
+        self.closing = []
+
+    def tearDown(self):
+        for thing in reversed(self.closing):
+            thing.close()
+
+    def check_replica(self, src, dest, keys):
+        """ dest holds keys as src does, with the same log entries. """
+        for key in keys:
+            self.assertEqual(src.get(key), dest.get(key))
+            self.assertEqual(str(src.log.get_entry(key)),
+                             str(dest.log.get_entry(key)))
+            self.assertEqual(src.node_id, dest.log.get_entry(key).node_id)
+
+    def do_test_replication(self, src, make_source):
+        """ Replicate, resume from the cursor, and report lag. """
+        dest = new_server(self)
+        keys = put_some(src, 40)
+        big = bytes(RNG.some_bytes(512 * 1024))
+        big_key = hash_hex(big, HashTypes.SHA2)
+        src.put_data(big, big_key, 'test', 'z@big')
+        gone = keys[7]
+        src.delete(gone)
+        total = len(src.log)
+
+        replicator = Replicator(dest, make_source(), batch_size=16)
+        self.assertEqual((total, 0.0), replicator.lag())
+        self.assertEqual(16, replicator.replicate_once())
+        (entries, secs) = replicator.lag()
+        self.assertEqual(total - 16, entries)
+        self.assertTrue(secs >= 0.0)
+        self.assertEqual(total - 16, replicator.replicate())
+        self.assertEqual((0, 0.0), replicator.lag())
+        stats = replicator.stats
+        self.assertEqual(total - 1, stats.applied)
+        self.assertEqual(1, stats.missing)
+        self.assertEqual(0, stats.rejected)
+        self.assertFalse(dest.exists(gone))
+        self.check_replica(src, dest, [k for k in keys if k != gone] +
+                           [big_key] + src.chunk_keys(big_key))
+        self.assertTrue(os.path.exists(replicator.cursor_path))
+        replicator.stop()
+
+        # a new replicator resumes from the saved cursor
+        more = put_some(src, 5)
+        replicator = Replicator(dest, make_source())
+        self.assertEqual(5, replicator.lag()[0])
+        self.assertEqual(5, replicator.replicate())
+        self.assertEqual(0, replicator.stats.present)
+        self.check_replica(src, dest, more)
+        replicator.stop()
+
+    def test_local(self):
+        """ Replicate from a store on the same machine. """
+        src = new_server(self, pack_threshold=1024,
+                         chunk_threshold=64 * 1024)
+        self.do_test_replication(src, lambda: LocalSource(src))
+
+    def test_zmq(self):
+        """ Replicate from a node over inproc. """
+        src = new_server(self, chunk_threshold=64 * 1024)
+        zserver = ZServer(src, 'inproc://%s' % RNG.next_file_name(16),
+                          CONTEXT)
+        zserver.start()
+        self.closing.append(zserver)
+        client = ZClient(zserver.endpoint, HashTypes.SHA2, CONTEXT,
+                         timeout=5.0)
+        self.closing.append(client)
+        self.do_test_replication(src, lambda: ZSource(client, window=8))
+
+    def test_background(self):
+        """ A replicator running in the background keeps up. """
+        src = new_server(self)
+        dest = new_server(self)
+        lock = threading.Lock()
+        replicator = Replicator(dest, LocalSource(src, lock),
+                                interval=0.01)
+        replicator.start()
+        try:
+            keys = put_some(src, 20, lock=lock)
+            deadline = time.time() + 10
+            while replicator.stats.applied < 20 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            replicator.stop()
+        self.assertEqual(20, replicator.stats.applied)
+        self.check_replica(src, dest, keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# testRing.py
+
+""" Test consistent hashing of content keys onto members. """
+
+import hashlib
+import unittest
+
+from upax import UpaxError
+from upax.ring import HashRing
+
+
+def some_keys(count):
+    """ Return count distinct hex content keys. """
+    return [hashlib.sha256(b'%u' % n).hexdigest() for n in range(count)]
+
+
+class TestRing(unittest.TestCase):
+    """ Test consistent hashing of content keys onto members. """
+
+    def test_lookup(self):
+        """ Keys are spread over the members, and lookup_n is consistent. """
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        self.assertEqual(['a', 'b', 'c', 'd'], ring.members)
+        keys = some_keys(4000)
+        counts = {}
+        for key in keys:
+            owner = ring.lookup(key)
+            counts[owner] = counts.get(owner, 0) + 1
+            replicas = ring.lookup_n(key, 3)
+            self.assertEqual(owner, replicas[0])
+            self.assertEqual(3, len(set(replicas)))
+        for member in ring.members:
+            self.assertTrue(500 < counts[member] < 1500)
+        self.assertEqual(4, len(ring.lookup_n(keys[0], 9)))
+        with self.assertRaises(UpaxError):
+            ring.add('a')
+        with self.assertRaises(UpaxError):
+            HashRing().lookup(keys[0])
+
+    def test_add_and_remove(self):
+        """ Adding a member moves keys only to it; removing undoes that. """
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        keys = some_keys(4000)
+        before = [ring.lookup(key) for key in keys]
+        ring.add('e')
+        after = [ring.lookup(key) for key in keys]
+        moved = [n for n in range(len(keys)) if before[n] != after[n]]
+        self.assertTrue(0 < len(moved) < len(keys) // 3)
+        for n in moved:
+            self.assertEqual('e', after[n])
+        ring.remove('e')
+        self.assertEqual(before, [ring.lookup(key) for key in keys])
+
+
+if __name__ == '__main__':
+    unittest.main()
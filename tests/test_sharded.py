@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# testSharded.py
+
+""" Test a content-keyed store sharded across several uDirs. """
+
+import os
+import time
+import unittest
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.sharded import ShardedServer
+from xlattice import HashTypes
+
+from store_util import new_u_path
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestSharded(unittest.TestCase):
+    """ Test a content-keyed store sharded across several uDirs. """
+
+    def do_test_sharding(self, hashtype):
+        """ Put, get, add a shard, and rebalance, for one hash type. """
+        u_paths = [new_u_path() for _ in range(3)]
+        objects = {}
+        while len(objects) < 64:
+            data = bytes(RNG.some_bytes(16 + RNG.next_int16(1024)))
+            objects[hash_hex(data, hashtype)] = data
+        keys = sorted(objects)
+
+        paths = []
+        os.makedirs(u_paths[0], exist_ok=True)
+        for key in keys[:16]:
+            path = os.path.join(u_paths[0], 'file-' + key)
+            with open(path, 'wb') as file:
+                file.write(objects[key])
+            paths.append((path, key, 'test'))
+
+        server = ShardedServer(u_paths[:2], hashtype)
+        try:
+            results = server.put_many(paths)
+            self.assertEqual([(len(objects[k]), k) for k in keys[:16]],
+                             results)
+            for key in keys[16:]:
+                server.put_data(objects[key], key, 'test')
+            self.assertEqual((-1, keys[0]),
+                             server.put_data(objects[keys[0]], keys[0], 't'))
+            for key in keys:
+                self.assertTrue(server.shard_for(key).exists(key))
+            self.assertTrue(all(len(s.log) > 0 for s in server.shards))
+            self.assertEqual([objects[k] for k in keys],
+                             server.get_many(keys))
+
+            # a new shard: everything is still found before rebalancing
+            server.add_shard(u_paths[2])
+            owned = [k for k in keys if server.shard_for(k).u_path ==
+                     u_paths[2]]
+            self.assertTrue(owned)
+            for key in keys:
+                self.assertEqual(objects[key], server.get(key))
+            self.assertEqual(len(owned), server.rebalance())
+            self.assertEqual(0, server.rebalance())
+            for key in keys:
+                self.assertTrue(server.shard_for(key).exists(key))
+                others = [s for s in server.shards
+                          if s is not server.shard_for(key)]
+                self.assertFalse(any(s.exists(key) for s in others))
+                stream = server.get_stream(key)
+                try:
+                    self.assertEqual(objects[key], stream.read())
+                finally:
+                    stream.close()
+        finally:
+            server.close()
+
+        # reopening in a different order finds the same placement
+        server = ShardedServer(list(reversed(u_paths)), hashtype)
+        try:
+            for key in keys:
+                self.assertTrue(server.shard_for(key).exists(key))
+        finally:
+            server.close()
+
+    def test_rebalance_chunked(self):
+        """ Chunked data moves with its chunks and its log entries. """
+        hashtype = HashTypes.SHA2
+        u_paths = [new_u_path() for _ in range(3)]
+        objects = {}
+        while len(objects) < 12:
+            # pairs of objects sharing most of their chunks
+            data = bytes(RNG.some_bytes(320 * 1024))  # > MAX_CHUNK
+            objects[hash_hex(data, hashtype)] = data
+            edited = data[:1000] + b'edited' + data[1000:]
+            objects[hash_hex(edited, hashtype)] = edited
+        keys = sorted(objects)
+
+        server = ShardedServer(u_paths[:2], hashtype,
+                               chunk_threshold=64 * 1024)
+        try:
+            for key in keys:
+                server.put_data(objects[key], key, 'src-' + key[:8])
+            before = {}
+            for key in keys:
+                shard = server.shard_for(key)
+                self.assertIsNotNone(shard.chunk_keys(key))
+                before[key] = shard.log.get_entry(key)
+            old_shards = server.shards
+            server.add_shard(u_paths[2])
+            new_shard = server.shards[2]
+            owned = [k for k in keys if server.shard_for(k) is new_shard]
+            self.assertTrue(owned)
+            self.assertEqual(len(owned), server.rebalance())
+
+            moved_chunks = set()
+            for key in owned:
+                entry = new_shard.log.get_entry(key)
+                for attr in ('timestamp', 'node_id', 'src', 'path'):
+                    self.assertEqual(getattr(before[key], attr),
+                                     getattr(entry, attr))
+                c_keys = new_shard.chunk_keys(key)
+                for c_key in c_keys:
+                    self.assertTrue(new_shard.exists(c_key))
+                moved_chunks.update(c_keys)
+            for shard in old_shards:
+                live = set()
+                for key in keys:
+                    if shard.exists(key):
+                        live.update(shard.chunk_keys(key))
+                for c_key in moved_chunks - live:
+                    self.assertFalse(shard.exists(c_key))
+            for key in keys:
+                self.assertEqual(objects[key], server.get(key))
+        finally:
+            server.close()
+
+    def test_sharding(self):
+        """ Test sharding using the supported hash types. """
+        for hashtype in HashTypes:
+            self.do_test_sharding(hashtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
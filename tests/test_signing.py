@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# testSigning.py
+
+""" Test signing a log a segment at a time. """
+
+import hashlib
+import os
+import time
+import unittest
+
+import rnglib
+from Crypto.PublicKey import RSA
+from upax.ftlog import LogEntry
+from upax.server import BlockingServer
+from upax.signing import LogSigner, read_segments, verify_segments
+from xlattice import HashTypes
+
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+
+
+class TestSigning(unittest.TestCase):
+    """ Test signing a log a segment at a time. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSA.generate(1024)
+        cls.other_key = RSA.generate(1024)
+
+    def setUp(self):
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        self.server = BlockingServer(u_path, HashTypes.SHA2)
+        self.count = 0
+
+    def tearDown(self):
+        self.server.close()
+
+    def log_some(self, count):
+        """ Add count entries to the server's log. """
+        now = time.time()
+        items = []
+        for _ in range(count):
+            key = hashlib.sha256(b'%u' % self.count).hexdigest()
+            items.append((now, key, self.server.node_id, 'test',
+                          'z@%u' % self.count))
+            self.count += 1
+        self.server.log.add_entries(items)
+
+    def test_sign_and_verify(self):
+        """ Segments check out, and tampering is caught. """
+        log = self.server.log
+        self.log_some(250)
+        signer = LogSigner(log, self.server.u_path, self.key, 100)
+        self.assertEqual(2, len(signer.seal(partial=False)))
+        self.assertEqual(200, signer.signed)
+        self.assertEqual(1, len(signer.seal()))
+        self.assertEqual([], signer.seal())
+        self.assertEqual([seg.start for seg in signer.segments],
+                         [0, 100, 200])
+
+        # carried on from uDir/L.sig
+        self.log_some(120)
+        signer = LogSigner(log, self.server.u_path, self.key, 100)
+        self.assertEqual(250, signer.signed)
+        self.assertEqual(2, len(signer.seal()))
+        segments = read_segments(signer.path)
+        self.assertEqual(5, len(segments))
+
+        pub_key = self.key.publickey()
+        entries = list(log.entries)
+        self.assertEqual([], verify_segments(entries, segments, pub_key,
+                                             processes=2))
+        self.assertEqual([], verify_segments(entries, segments, pub_key,
+                                             processes=0))
+        self.assertEqual([0, 1, 2, 3, 4], verify_segments(
+            entries, segments, self.other_key.publickey(), processes=0))
+
+        # an altered entry breaks its segment
+        altered = list(entries)
+        old = altered[150]
+        altered[150] = LogEntry(old.timestamp, old.key, old.node_id,
+                                'forged', old.path)
+        self.assertEqual([1], verify_segments(altered, segments, pub_key, 0))
+
+        # as does dropping one; later segments no longer line up
+        dropped = entries[:210] + entries[211:]
+        self.assertEqual([2, 3, 4], verify_segments(dropped, segments,
+                                                    pub_key, 0))
+
+        # a segment left out is noticed at the one after it
+        self.assertEqual([1], verify_segments(
+            entries, segments[:1] + segments[2:], pub_key, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
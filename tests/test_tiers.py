@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# testTiers.py
+
+""" Test tiered storage with hot/cold placement. """
+
+import os
+import time
+import unittest
+
+import rnglib
+from upax.hashing import hash_hex
+from upax.server import BlockingServer
+from upax.tiers import AccessStats
+from xlattice import HashTypes
+
+from store_util import DATA_PATH, new_u_path
+
+RNG = rnglib.SimpleRNG(time.time())
+
+
+class TestTiers(unittest.TestCase):
+    """ Test tiered storage with hot/cold placement. """
+
+    def test_access_stats(self):
+        """ Heat decays with the half life and survives a save. """
+        path = new_u_path()
+        os.makedirs(DATA_PATH, exist_ok=True)
+        stats = AccessStats(path, half_life=10.0)
+        self.assertEqual(1.0, stats.touch('ab', now=100.0))
+        self.assertEqual(2.0, stats.touch('ab', now=100.0))
+        self.assertAlmostEqual(1.0, stats.heat('ab', now=110.0))
+        self.assertAlmostEqual(1.5, stats.touch('ab', now=120.0))
+        self.assertEqual(0.0, stats.heat('cd'))
+        stats.save()
+        again = AccessStats(path, half_life=10.0)
+        self.assertAlmostEqual(1.5, again.heat('ab', now=120.0))
+        self.assertEqual(120.0, again.last_read('ab'))
+
+    def do_test_tiers(self, hashtype):
+        """ Demote, read through, promote, and delete, for one hash type. """
+        u_path = new_u_path()
+        cold_path = new_u_path()
+        objects = {}
+        while len(objects) < 16:
+            data = bytes(RNG.some_bytes(4096))
+            objects[hash_hex(data, hashtype)] = data
+        keys = sorted(objects)
+
+        server = BlockingServer(u_path, hashtype, cold_path=cold_path,
+                                hot_quota=8 * 4096, migrate_interval=0)
+        try:
+            tiers = server.tiers
+            for key in keys:
+                server.put_data(objects[key], key, 'test')
+            self.assertEqual(16 * 4096, tiers.hot_bytes)
+            # the first few keys are read, so the rest are demoted first
+            for key in keys[:4]:
+                server.get(key)
+            (demoted, promoted) = server.migrate()
+            self.assertEqual((9, 0), (demoted, promoted))
+            self.assertTrue(tiers.hot_bytes <= 8 * 4096)
+            for key in keys[:4]:
+                self.assertFalse(tiers.in_cold(key))
+            cold = [k for k in keys if tiers.in_cold(k)]
+            self.assertEqual(9, len(cold))
+            for key in keys:
+                self.assertTrue(server.exists(key))
+                self.assertEqual(objects[key], server.get(key))
+            # those were all first reads; a second read makes one hot
+            server.get(cold[0])
+            with server.get_stream(cold[0]) as stream:
+                self.assertEqual(objects[cold[0]], stream.read())
+            self.assertEqual((0, 1), server.migrate())
+            self.assertFalse(tiers.in_cold(cold[0]))
+            self.assertTrue(server.u_dir.exists(cold[0]))
+            self.assertTrue(server.delete(cold[1]))
+            self.assertFalse(server.exists(cold[1]))
+        finally:
+            server.close()
+
+        # everything is still found by a new server, with a migrator
+        server = BlockingServer(u_path, hashtype, cold_path=cold_path,
+                                hot_quota=8 * 4096)
+        try:
+            self.assertTrue(len(server.tiers.stats) > 4)
+            for key in keys:
+                if key != cold[1]:
+                    self.assertEqual(objects[key], server.get(key))
+        finally:
+            server.close()
+
+    def test_new_puts_stay_hot(self):
+        """ Data just put is not demoted before older data. """
+        hashtype = HashTypes.SHA2
+        u_path = new_u_path()
+        cold_path = new_u_path()
+        old = [bytes(RNG.some_bytes(4096)) for _ in range(8)]
+        new = [bytes(RNG.some_bytes(4096)) for _ in range(4)]
+        server = BlockingServer(u_path, hashtype, cold_path=cold_path,
+                                hot_quota=8 * 4096, migrate_interval=0)
+        try:
+            tiers = server.tiers
+            for data in old + new:
+                server.put_data(data, hash_hex(data, hashtype), 'test')
+                time.sleep(0.001)
+            (demoted, _) = server.migrate()
+            self.assertEqual(5, demoted)
+            for data in new:
+                self.assertFalse(tiers.in_cold(hash_hex(data, hashtype)))
+            for data in old[:5]:
+                self.assertTrue(tiers.in_cold(hash_hex(data, hashtype)))
+        finally:
+            server.close()
+
+    def test_tiers(self):
+        """ Test tiered storage using the supported hash types. """
+        for hashtype in HashTypes:
+            self.do_test_tiers(hashtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
 # testUpaxNode.py
+import os
+import subprocess
+import sys
 import time
 import unittest
+from unittest import mock
 from rnglib import SimpleRNG
 
+from Crypto.PublicKey import RSA
 # from upax.ftlog import LogEntry
 from upax import UpaxError
-from upax.node import check_node_id, Peer
+from upax.node import check_node_id, Peer, UpaxNode, KEY_NAME
 from xlattice import HashTypes, check_hashtype
 
 RNG = SimpleRNG(int(time.time()))
 
+DATA_PATH = 'myData'
+
 
 class TestUpaxNode(unittest.TestCase):
 
@@ -102,8 +109,35 @@ class TestUpaxNode(unittest.TestCase):
 
     def test_upax_node(self):
         """
+        The RSA key is made only when needed, and kept in the uDir.
         """
-        pass
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        os.makedirs(u_path)
+        node_id = bytearray(32)
+        RNG.next_bytes(node_id)
+        generate = RSA.generate
+        with mock.patch.object(
+                RSA, 'generate',
+                side_effect=lambda bits: generate(1024)) as gen:
+            node = UpaxNode(node_id, u_path=u_path)
+            self.assertEqual(0, gen.call_count)
+            pub_key = node.rsa_pub_key
+            self.assertEqual(1, gen.call_count)
+            self.assertTrue(os.path.exists(os.path.join(u_path, KEY_NAME)))
+            again = UpaxNode(node_id, u_path=u_path)
+            self.assertEqual(pub_key, again.rsa_pub_key)
+            self.assertEqual(node.rsa_priv_key, again.rsa_priv_key)
+            self.assertEqual(1, gen.call_count)
+
+    def test_light_imports(self):
+        """ Reading logs does not import the crypto library. """
+        code = ('import sys, upax.ftlog, upax.node; '
+                'print(any(m.startswith("Crypto") for m in sys.modules))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(b'False', out.strip())
 
     def test_string_serialization(self):
         pass
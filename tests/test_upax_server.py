@@ -3,12 +3,17 @@
 
 """ Test functions of a Upax server. """
 
+import io
 import os
 import time
 import unittest
 
 import rnglib
+from upax import codec, UpaxError
+from upax.chunker import chunk_stream, CHUNK_PATH
+from upax.hashing import hash_hex
 from upax.server import BlockingServer
+from upax.walker import UWalker
 from xlattice import HashTypes, check_hashtype
 from xlu import file_sha1hex, file_sha2hex, file_sha3hex, file_blake2b_hex
 
@@ -205,6 +210,240 @@ class TestUpaxServer(unittest.TestCase):
         for hashtype in HashTypes:
             self._put_close_reopen_and_put(hashtype)          # GEEP
 
+    # ---------------------------------------------------------------
+
+    def _put_compressed(self, hashtype):
+        """
+        Test storing compressible and incompressible data in a server
+        which compresses at rest, using a specific hash type.
+        """
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+
+        text = b'the quick brown fox jumps over the lazy dog\n' * 500
+        noise = bytes(RNG.some_bytes(4096))
+        tricky = codec.MAGIC + b'looks like a header, but is data'
+        file_map = self.make_some_files(hashtype)
+
+        server = BlockingServer(u_path, hashtype, compress=True)
+        try:
+            self.assertTrue(server.compressing)
+            for data in (text, noise, tricky):
+                key = hash_hex(data, hashtype)
+                server.put_data(data, key, 'test_put_compressed')
+                self.assertTrue(server.exists(key))
+                self.assertEqual(data, server.get(key))
+                with server.get_stream(key) as file:
+                    self.assertEqual(data, file.read())
+
+            stored = server.u_dir.get_path_for_key(hash_hex(text, hashtype))
+            self.assertTrue(os.path.getsize(stored) < len(text) // 3)
+            self.assertEqual(len(text), codec.raw_len(stored))
+            stored = server.u_dir.get_path_for_key(hash_hex(noise, hashtype))
+            self.assertFalse(codec.is_encoded_file(stored))
+
+            for key in file_map:
+                server.put(file_map[key], key, 'test_put_compressed')
+                with open(file_map[key], 'rb') as file:
+                    self.assertEqual(file.read(), server.get(key))
+        finally:
+            server.close()
+
+        # a server which doesn't compress still reads compressed data
+        server = BlockingServer(u_path, hashtype)
+        try:
+            self.assertFalse(server.compressing)
+            self.assertEqual(text, server.get(hash_hex(text, hashtype)))
+            self.assertEqual(tricky, server.get(hash_hex(tricky, hashtype)))
+        finally:
+            server.close()
+
+        # and the walker verifies keys against the uncompressed data
+        walker = UWalker(u_path=u_path, limit=1024, hashtype=hashtype)
+        keys = walker.walk()
+        self.assertEqual(3 + len(file_map), len(keys))
+
+    def test_put_compressed(self):
+        """ Test compression at rest using the supported hash types. """
+        for hashtype in HashTypes:
+            self._put_compressed(hashtype)
+
+    # ---------------------------------------------------------------
+
+    def _put_packed(self, hashtype):
+        """
+        Test a server which packs small objects, using a specific hash type.
+        """
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+
+        small = [bytes(RNG.some_bytes(16 + n)) for n in range(8)]
+        large = bytes(RNG.some_bytes(8192))
+        file_map = self.make_some_files(hashtype)
+
+        server = BlockingServer(u_path, hashtype, pack_threshold=4096)
+        try:
+            for data in small + [large]:
+                server.put_data(data, hash_hex(data, hashtype), 'test')
+            for key in file_map:
+                server.put(file_map[key], key, 'test_put_packed')
+            for data in small:
+                key = hash_hex(data, hashtype)
+                self.assertTrue(server.packs.exists(key))
+                self.assertFalse(server.u_dir.exists(key))
+                self.assertEqual(data, server.get(key))
+            key = hash_hex(large, hashtype)
+            self.assertFalse(server.packs.exists(key))
+            self.assertEqual(large, server.get(key))
+            for key in file_map:
+                self.assertTrue(server.exists(key))
+                with open(file_map[key], 'rb') as file:
+                    self.assertEqual(file.read(), server.get(key))
+        finally:
+            server.close()
+
+        # packed objects are found, walked, and verified without packing on
+        server = BlockingServer(u_path, hashtype)
+        try:
+            for data in small:
+                self.assertEqual(data, server.get(hash_hex(data, hashtype)))
+            server.repack()
+            for data in small:
+                self.assertEqual(data, server.get(hash_hex(data, hashtype)))
+        finally:
+            server.close()
+        walker = UWalker(u_path=u_path, limit=1024, hashtype=hashtype)
+        self.assertEqual(len(small) + 1 + len(file_map), len(walker.walk()))
+
+    def test_put_packed(self):
+        """ Test packing small objects using the supported hash types. """
+        for hashtype in HashTypes:
+            self._put_packed(hashtype)
+
+    # ---------------------------------------------------------------
+
+    def _put_chunked(self, hashtype):
+        """
+        Test a server which stores large data in chunks, using a specific
+        hash type.
+        """
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+
+        data = bytes(RNG.some_bytes(1024 * 1024))
+        where = len(data) // 3
+        edited = data[:where] + b'a few more bytes' + data[where:]
+        small = bytes(RNG.some_bytes(1024))
+        keys = [hash_hex(d, hashtype) for d in (data, edited, small)]
+
+        server = BlockingServer(u_path, hashtype, pack_threshold=4096,
+                                chunk_threshold=256 * 1024)
+        try:
+            server.put_data(data, keys[0], 'test')
+            count = len(server.log)
+            # the edited copy shares all but a few chunks with the first
+            server.put_data(edited, keys[1], 'test')
+            self.assertTrue(len(server.log) - count <= 4)
+            server.put_data(small, keys[2], 'test')
+            self.assertTrue(server.packs.exists(keys[0]))
+            for (key, expected) in zip(keys, (data, edited, small)):
+                self.assertTrue(server.exists(key))
+                self.assertEqual(expected, server.get(key))
+                stream = server.get_stream(key)
+                try:
+                    self.assertEqual(expected, stream.read())
+                finally:
+                    stream.close()
+        finally:
+            server.close()
+        walker = UWalker(u_path=u_path, limit=1024, hashtype=hashtype)
+        self.assertEqual(len(walker.walk()), len(set(walker.keys)))
+        self.assertTrue(keys[0] in walker.keys)
+
+    def test_put_chunked(self):
+        """ Test chunking large data using the supported hash types. """
+        for hashtype in HashTypes:
+            self._put_chunked(hashtype)
+
+    def test_single_chunk(self):
+        """ Data which is a single chunk is stored as itself. """
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        server = BlockingServer(u_path, HashTypes.SHA2,
+                                chunk_threshold=1024)
+        try:
+            for put in (lambda d, k: server.put_data(d, k, 'test'),
+                        lambda d, k: server.put_stream(io.BytesIO(d), k)):
+                data = bytes(RNG.some_bytes(8 * 1024))
+                key = hash_hex(data, HashTypes.SHA2)
+                self.assertEqual([data], list(chunk_stream(io.BytesIO(data))))
+                self.assertEqual((len(data), key), put(data, key))
+                self.assertIsNone(server.chunk_keys(key))
+                self.assertEqual(data, server.get(key))
+                self.assertNotEqual(CHUNK_PATH,
+                                    server.log.get_entry(key).path)
+        finally:
+            server.close()
+
+    # ---------------------------------------------------------------
+
+    def _put_stream(self, hashtype, **kwargs):
+        """
+        Test streaming puts into a server configured by kwargs, using a
+        specific hash type.
+        """
+        u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(u_path):
+            u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+
+        small = bytes(RNG.some_bytes(100))
+        large = bytes(RNG.some_bytes(300 * 1024))
+        text = b'compressible text ' * 20000
+        server = BlockingServer(u_path, hashtype, **kwargs)
+        try:
+            for data in (small, large, text):
+                key = hash_hex(data, hashtype)
+                self.assertEqual((len(data), key),
+                                 server.put_stream(io.BytesIO(data), key,
+                                                   'test'))
+                self.assertEqual(data, server.get(key))
+                self.assertTrue(key in server.log)
+                self.assertEqual((-1, key),
+                                 server.put_stream(io.BytesIO(data)))
+            # an iterable of bytes, with the key derived
+            pieces = [bytes(RNG.some_bytes(1000)) for _ in range(200)]
+            data = b''.join(pieces)
+            key = hash_hex(data, hashtype)
+            self.assertEqual((len(data), key), server.put_stream(pieces))
+            self.assertEqual(data, server.get(key))
+            # a wrong key stores nothing and leaves nothing in tmp/
+            data = bytes(RNG.some_bytes(200 * 1024))
+            with self.assertRaises(UpaxError):
+                server.put_stream(io.BytesIO(data), hash_hex(small, hashtype))
+            self.assertFalse(server.exists(hash_hex(data, hashtype)))
+            self.assertEqual([], os.listdir(os.path.join(u_path, 'tmp')))
+            # nor does it log or keep any chunks of large data
+            data = bytes(RNG.some_bytes(600 * 1024))
+            entries = len(server.log)
+            with self.assertRaises(UpaxError):
+                server.put_stream(io.BytesIO(data), hash_hex(small, hashtype))
+            self.assertEqual(entries, len(server.log))
+            for chunk in chunk_stream(io.BytesIO(data)):
+                self.assertFalse(server.exists(hash_hex(chunk, hashtype)))
+        finally:
+            server.close()
+
+    def test_put_stream(self):
+        """ Test streaming puts using the supported hash types. """
+        for hashtype in HashTypes:
+            self._put_stream(hashtype)
+            self._put_stream(hashtype, compress=True, pack_threshold=4096)
+            self._put_stream(hashtype, chunk_threshold=256 * 1024)
+
 
 if __name__ == '__main__':
     unittest.main()
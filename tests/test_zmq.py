@@ -1,24 +1,161 @@
 #!/usr/bin/env python3
 
 # testZMQ.py
+
+""" Test the ZeroMQ protocol in front of a Server. """
+
+import os
+import time
 import unittest
+
+import rnglib
 import zmq
-# from upax.ftlog import LogEntry
+from upax import UpaxError
+from upax.hashing import hash_hex
+from upax.server import BlockingServer
+from upax.zserver import (ZClient, ZServer, OP_GET, STATUS_OK,
+                          STATUS_ERROR)
+from xlattice import HashTypes
 
 CONTEXT = zmq.Context.instance()
 
+RNG = rnglib.SimpleRNG(time.time())
+
+DATA_PATH = 'myData'
+
 
 class TestZMQ(unittest.TestCase):
+    """ Test the ZeroMQ protocol in front of a Server. """
 
     def setUp(self):
-        pass
+        self.u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
+        while os.path.exists(self.u_path):
+            self.u_path = os.path.join(DATA_PATH, RNG.next_file_name(16))
 
     def tearDown(self):
         pass
 
-    def test_constructor(self):
-        # XXX STUB
-        pass
+    def do_test_protocol(self, endpoint, hashtype):
+        """ Exercise every request over the endpoint. """
+        server = BlockingServer(self.u_path, hashtype)
+        zserver = ZServer(server, endpoint, CONTEXT)
+        zserver.start()
+        client = ZClient(zserver.endpoint, hashtype, CONTEXT)
+        try:
+            data = RNG.some_bytes(1024 + RNG.next_int16(1024))
+            key = hash_hex(data, hashtype)
+            self.assertFalse(client.exists(key))
+            self.assertIsNone(client.get(key))
+            self.assertEqual(client.put_data(data, key, 'test'),
+                             (len(data), key))
+            self.assertTrue(client.exists(key))
+            self.assertEqual(client.get(key), data)
+            # a repeat, with the key left to the server
+            self.assertEqual(client.put_data(data), (-1, key))
+            with self.assertRaises(UpaxError):
+                client.put_data(data + b'x', key)
+
+            # batches
+            items = [(RNG.some_bytes(64 + ndx), None) for ndx in range(8)]
+            results = client.put_many(items, 'batch', 'z@batch')
+            keys = [k for (_, k) in results]
+            self.assertEqual(keys, [hash_hex(d, hashtype)
+                                    for (d, _) in items])
+            self.assertEqual([n for (n, _) in results],
+                             [len(d) for (d, _) in items])
+            absent = hash_hex(b'never stored', hashtype)
+            self.assertEqual(client.get_many(keys + [absent]),
+                             [d for (d, _) in items] + [None])
+            self.assertEqual(client.exists_many([absent, key]),
+                             [False, True])
+
+            # log ranges
+            entries = client.log_range()
+            self.assertEqual([e.key for e in entries], [key] + keys)
+            self.assertEqual(len(client.log_range(limit=3)), 3)
+            late = client.log_range(start=int(time.time()) + 10)
+            self.assertEqual(late, [])
+
+            # pipelined requests, collected out of order
+            ids = [client.submit(OP_GET, k.encode('ascii')) for k in keys]
+            for (req_id, expected) in reversed(list(zip(ids, items))):
+                (status, payload) = client.result(req_id)
+                self.assertEqual(status, STATUS_OK)
+                self.assertEqual(payload[0].bytes, expected[0])
+            replies = list(client.pipeline(
+                [(OP_GET, k.encode('ascii')) for k in keys * 4], window=5))
+            self.assertEqual([p[0].bytes for (_, p) in replies],
+                             [d for (d, _) in items] * 4)
+
+            (status, _) = client.result(client.submit(b'NO_SUCH_OP'))
+            self.assertEqual(status, STATUS_ERROR)
+        finally:
+            client.close()
+            zserver.close()
+            server.close()
+
+    def test_bad_requests(self):
+        """ Malformed keys and failing handlers are answered with ERROR. """
+        server = BlockingServer(self.u_path, HashTypes.SHA2)
+        zserver = ZServer(server, 'inproc://%s' % RNG.next_file_name(16),
+                          CONTEXT)
+        zserver.start()
+        client = ZClient(zserver.endpoint, HashTypes.SHA2, CONTEXT,
+                         timeout=5.0)
+        try:
+            key = hash_hex(b'abc', HashTypes.SHA2)
+            for bad in ('../../etc/hostname', '../../tmp', key.upper(),
+                        key[:40], key + '0', ''):
+                (status, _) = client.result(
+                    client.submit(OP_GET, bad.encode('utf-8')))
+                self.assertEqual(status, STATUS_ERROR)
+                with self.assertRaises(UpaxError):
+                    client.exists_many([key, bad])
+            with self.assertRaises(UpaxError):
+                client.put_data(b'abc', '../' + key[3:])
+
+            def fail(args):
+                raise IsADirectoryError(21, 'Is a directory')
+            zserver._handlers[OP_GET] = fail
+            (status, payload) = client.result(
+                client.submit(OP_GET, key.encode('ascii')))
+            self.assertEqual(status, STATUS_ERROR)
+            self.assertIn(b'directory', payload[0].bytes)
+            # the serving thread is still answering
+            self.assertEqual(client.put_data(b'abc'), (3, key))
+            self.assertTrue(client.exists(key))
+        finally:
+            client.close()
+            zserver.close()
+            server.close()
+
+    def test_timeout(self):
+        """ A client with nothing to talk to gives up. """
+        client = ZClient('inproc://%s' % RNG.next_file_name(16),
+                         HashTypes.SHA2, CONTEXT, timeout=0.2)
+        try:
+            with self.assertRaises(UpaxError):
+                client.exists(hash_hex(b'abc', HashTypes.SHA2))
+        finally:
+            client.close()
+
+    def test_inproc(self):
+        """ Requests over inproc://. """
+        for hashtype in HashTypes:
+            self.setUp()
+            self.do_test_protocol('inproc://%s' % RNG.next_file_name(16),
+                                  hashtype)
+
+    def test_ipc(self):
+        """ Requests over ipc://. """
+        os.makedirs(DATA_PATH, exist_ok=True)
+        sock_path = os.path.abspath(os.path.join(
+            DATA_PATH, RNG.next_file_name(8) + '.ipc'))
+        try:
+            self.do_test_protocol('ipc://' + sock_path, HashTypes.SHA2)
+        finally:
+            if os.path.exists(sock_path):
+                os.remove(sock_path)
 
 
 if __name__ == '__main__':